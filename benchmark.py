@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark each phase of `path_shortener.py` on large, seeded, synthetic directory trees generated
+by `generate_test_paths.py`, so that performance regressions are visible.
+
+The phases timed are the same ones `path_shortener.py` runs through, in order:
+copy, walk, classify, plan, rename, namefiles, verify, and report.
+
+Example usage:
+
+```bash
+# Benchmark trees with 10k, 100k, and 1M entries
+./benchmark.py
+
+# Benchmark only a 10k-entry tree, on tmpfs (RAM), and save the results
+./benchmark.py --sizes 10000 --tmpfs --output bench_results.json
+
+# Compare against previously-saved results, exiting with an error if any phase got slower
+./benchmark.py --sizes 10000 --tmpfs --baseline bench_results.json
+
+# Benchmark only the classify and plan phases, in memory, without creating any files
+./benchmark.py --planner_only --sizes 10000 20000 40000
+
+# Same, but on a path list previously written by `generate_test_paths.py --path_list`
+./generate_test_paths.py --seed 1 --num_entries 20000 --path_list paths.jsonl
+./benchmark.py --planner_only --path_list paths.jsonl
+
+# Help menu
+./benchmark.py -h
+```
+"""
+
+# Local imports
+import ansi_colors as colors
+import config
+import generate_test_paths
+import path_shortener
+
+# Third party imports
+# NA
+
+# Python imports
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import sys
+import textwrap
+import time
+
+from pathlib import Path
+
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+PHASES_LIST = ["copy", "walk", "classify", "plan", "rename", "namefiles", "verify", "report"]
+
+
+def time_phase(timings_dict, phase, func, *args, **kwargs):
+    """
+    Call `func(*args, **kwargs)`, storing how long it took, in seconds, into
+    `timings_dict[phase]`. All of its console output is discarded so that it does not distort the
+    timing.
+
+    Returns whatever `func` returns.
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        time_start = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings_dict[phase] = time.perf_counter() - time_start
+
+    return result
+
+
+def time_plan_phase(timings_dict, paths_TO_list, is_dir_list, args):
+    """
+    Time the plan phase, storing the seconds into `timings_dict["plan"]`.
+
+    Returns the `PathPlan`.
+    """
+    if args.jobs > 1:
+        path_plan = time_phase(timings_dict, "plan",
+            path_shortener.plan_paths_in_parallel, paths_TO_list, is_dir_list, args.jobs,
+            optimize=args.optimize_plan)
+    elif args.optimize_plan:
+        path_plan = time_phase(timings_dict, "plan",
+            path_shortener.plan_paths_optimized, paths_TO_list, is_dir_list)
+    else:
+        path_plan = time_phase(timings_dict, "plan",
+            path_shortener.plan_paths, paths_TO_list, is_dir_list)
+
+    return path_plan
+
+
+def run_planner_phases(entries_list, args):
+    """
+    Run only the classify and plan phases of `path_shortener.py` on a path list from
+    `generate_test_paths.py`, entirely in memory, without touching the disk.
+
+    Returns a dict of phase name --> seconds.
+    """
+    print(f"\nRunning the planner phases on {len(entries_list)} entries, in memory...")
+
+    timings_dict = {}
+    shortened_dir = "tree" + config.SHORT_DIR_SUFFIX
+
+    def classify():
+        # Build the same set of paths that walking the copied dir would produce. Since symlinks get
+        # copied as the files they point to, there are no symlinks left to find.
+        all_paths_set = {shortened_dir}
+        is_dir_dict = {shortened_dir: True}
+        for relative_path, entry_type, _ in entries_list:
+            path = os.path.join(shortened_dir, relative_path)
+            all_paths_set.add(path)
+            is_dir_dict[path] = entry_type == "d"
+
+        paths_to_fix_sorted_list, path_stats = path_shortener.get_paths_to_fix(
+            all_paths_set, False, max_path_len_already_used=len(config.SHORT_DIR_SUFFIX),
+            symlink_paths_set=set())
+        paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
+        is_dir_list = [is_dir_dict[path] for path in paths_to_fix_sorted_list]
+        return paths_TO_list, is_dir_list
+
+    paths_TO_list, is_dir_list = time_phase(timings_dict, "classify", classify)
+
+    time_plan_phase(timings_dict, paths_TO_list, is_dir_list, args)
+
+    return timings_dict
+
+
+def run_phases(base_dir, args):
+    """
+    Run all phases of `path_shortener.py` on `base_dir`, which must be in the current working
+    directory, the same way `path_shortener.fix_paths()` does.
+
+    Returns a dict of phase name --> seconds.
+    """
+    timings_dict = {}
+    shortened_dir = base_dir + config.SHORT_DIR_SUFFIX
+    output_dir = os.path.join(shortened_dir, ".eRCaGuy_PathShortener")
+    ps_args = argparse.Namespace(keep_symlinks=False, jobs=args.jobs,
+                                 scan_threads=args.scan_threads, progress=False)
+
+    time_phase(timings_dict, "copy",
+        path_shortener.copy_directory, base_dir, shortened_dir, ps_args)
+
+    all_paths_set = time_phase(timings_dict, "walk",
+        path_shortener.walk_directory_concurrently, shortened_dir, args.scan_threads)
+
+    def classify():
+        paths_to_fix_sorted_list, path_stats = path_shortener.get_paths_to_fix(
+            all_paths_set, False, max_path_len_already_used=len(config.SHORT_DIR_SUFFIX))
+        paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
+        is_dir_list = [path_shortener.paths.is_dir(path) for path in paths_TO_list]
+        return paths_TO_list, is_dir_list
+
+    paths_TO_list, is_dir_list = time_phase(timings_dict, "classify", classify)
+
+    path_plan = time_plan_phase(timings_dict, paths_TO_list, is_dir_list, args)
+
+    time_phase(timings_dict, "rename",
+        path_shortener.apply_renames_to_disk, path_plan.renames_list)
+
+    time_phase(timings_dict, "namefiles",
+        path_shortener.write_namefiles, path_plan.paths_original_list, path_plan.paths_TO_list)
+
+    def verify():
+        all_paths_set2 = path_shortener.walk_directory_concurrently(
+            shortened_dir, args.scan_threads)
+        paths_to_fix_sorted_list2, _ = path_shortener.get_paths_to_fix(all_paths_set2, False)
+        return paths_to_fix_sorted_list2
+
+    paths_to_fix_sorted_list2 = time_phase(timings_dict, "verify", verify)
+    if len(paths_to_fix_sorted_list2) > 0:
+        colors.print_red(f"Error: {len(paths_to_fix_sorted_list2)} paths are still not fixed "
+                         f"after shortening.")
+
+    os.makedirs(output_dir, exist_ok=True)
+    time_phase(timings_dict, "report",
+        path_shortener.write_before_and_after_paths, output_dir, path_plan.paths_original_list,
+        path_plan.paths_TO_list, path_plan.paths_longest_namefiles_list)
+
+    return timings_dict
+
+
+def generate_entries(num_entries, seed):
+    """
+    Generate the entries of a tree with `num_entries` entries, in memory only. See
+    `generate_test_paths.generate_tree_entries()`.
+    """
+    random.seed(seed)
+    entries_list = generate_test_paths.generate_tree_entries(num_entries, max_depth=8,
+        min_width=1, max_width=4, max_files_per_dir=10, max_num_words=10, illegal_char_rate=0.5,
+        symlink_rate=1.0)
+    return entries_list
+
+
+def run_benchmark(num_entries, args):
+    """
+    Generate a tree with `num_entries` entries, then time all phases of `path_shortener.py` on it.
+
+    Returns a dict of phase name --> seconds, plus the time taken to generate the tree, under
+    "generate".
+    """
+    bench_dir = os.path.join(args.work_dir, f"bench_{num_entries}")
+    if os.path.exists(bench_dir):
+        shutil.rmtree(bench_dir)
+    os.makedirs(bench_dir)
+
+    print(f"\nGenerating a tree with {num_entries} entries in \"{bench_dir}\"...")
+    time_start = time.perf_counter()
+    entries_list = generate_entries(num_entries, args.seed)
+    generate_test_paths.create_tree_entries(os.path.join(bench_dir, "tree"), entries_list,
+                                            os.cpu_count())
+    time_generate = time.perf_counter() - time_start
+
+    print("Running the phases...")
+    cwd_bak = os.getcwd()
+    os.chdir(bench_dir)
+    try:
+        timings_dict = run_phases("tree", args)
+    finally:
+        os.chdir(cwd_bak)
+
+    timings_dict["generate"] = time_generate
+
+    if not args.keep:
+        shutil.rmtree(bench_dir)
+
+    return timings_dict
+
+
+def print_results(results_dict, baseline_dict=None, tolerance=0.0):
+    """
+    Print a table of the seconds taken per phase per tree size. If `baseline_dict` is given, also
+    print how each phase compares to it, in bright red if it is slower by more than `tolerance`
+    (a fraction).
+
+    Returns the number of phases which regressed compared to the baseline.
+    """
+    num_regressions = 0
+
+    sizes_list = list(results_dict)
+    # Only the phases which were actually run
+    phases_list = [phase for phase in PHASES_LIST if phase in results_dict[sizes_list[0]]]
+
+    print("\nSeconds per phase:")
+    print(f"  {'phase':10}" + "".join(f"{size:>22}" for size in sizes_list))
+
+    for phase in phases_list + ["total"]:
+        line = f"  {phase:10}"
+        for size in sizes_list:
+            timings_dict = results_dict[size]
+            if phase == "total":
+                seconds = sum(timings_dict[phase] for phase in phases_list)
+            else:
+                seconds = timings_dict[phase]
+            cell = f"{seconds:10.3f}"
+
+            if baseline_dict and size in baseline_dict and phase != "total":
+                seconds_baseline = baseline_dict[size][phase]
+                ratio = seconds / seconds_baseline if seconds_baseline > 0 else 1.0
+                cell += f" ({ratio:5.2f}x)"
+                if ratio > 1 + tolerance:
+                    num_regressions += 1
+                    cell = f"{colors.FBR}{cell}{colors.END}"
+            else:
+                cell += " "*9
+
+            line += " "*(22 - 19) + cell
+
+        print(line)
+
+    print("\nEntries per second, overall (excluding tree generation):")
+    for size in sizes_list:
+        total_seconds = sum(results_dict[size][phase] for phase in phases_list)
+        print(f"  {size:>10}: {int(size)/total_seconds:12.0f}")
+
+    return num_regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent("""\
+            Benchmark each phase of `path_shortener.py` (copy, walk, classify, plan, rename,
+            namefiles, verify, report) on seeded synthetic trees of various sizes.
+        """)
+    )
+
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+        help="Tree sizes, in number of entries, to benchmark. Default: 10000 100000 1000000.")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the generated trees. "
+        "Default: 1.")
+    parser.add_argument("--work_dir", type=str, default=None, help="Scratch dir to generate the "
+        "trees in. Default: a 'bench/' dir next to this script.")
+    parser.add_argument("--tmpfs", action="store_true", help="Use '/dev/shm/eRCaGuy_PathShortener_"
+        "bench' (RAM) as the scratch dir, unless '--work_dir' is also given.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated trees when done.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Same as `path_shortener.py "
+        "--jobs`. Default: 1.")
+    parser.add_argument("--scan_threads", type=int, default=8, help="Same as `path_shortener.py "
+        "--scan_threads`. Default: 8.")
+    parser.add_argument("-O", "--optimize_plan", action="store_true", help="Same as "
+        "`path_shortener.py --optimize_plan`.")
+    parser.add_argument("--planner_only", action="store_true", help="Only benchmark the classify "
+        "and plan phases, on in-memory path lists rather than on real trees, so that no disk I/O "
+        "skews the results.")
+    parser.add_argument("--path_list", type=str, default=None, help="With '--planner_only', "
+        "benchmark the path list in this file, written by `generate_test_paths.py --path_list`, "
+        "instead of generating path lists of the sizes in '--sizes'.")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Save the results to this "
+        "JSON file.")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against results "
+        "previously saved with '--output', and exit with an error if any phase is slower.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Fraction by which a phase "
+        "may be slower than the baseline before it counts as a regression. Default: 0.10.")
+
+    args = parser.parse_args()
+
+    if args.path_list and not args.planner_only:
+        parser.print_usage()
+        colors.print_red("Error: '--path_list' requires '--planner_only'.")
+        sys.exit(EXIT_FAILURE)
+
+    if args.work_dir is None:
+        if args.tmpfs:
+            args.work_dir = "/dev/shm/eRCaGuy_PathShortener_bench"
+        else:
+            args.work_dir = os.path.join(path_shortener.SCRIPT_DIRECTORY, "bench")
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    results_dict = {}  # tree size (str, for JSON) --> dict of phase name --> seconds
+    if args.path_list:
+        with open(args.path_list) as file:
+            entries_list = generate_test_paths.read_path_list(file)
+        results_dict[str(len(entries_list))] = run_planner_phases(entries_list, args)
+
+    elif args.planner_only:
+        for num_entries in args.sizes:
+            entries_list = generate_entries(num_entries, args.seed)
+            results_dict[str(num_entries)] = run_planner_phases(entries_list, args)
+
+    else:
+        for num_entries in args.sizes:
+            results_dict[str(num_entries)] = run_benchmark(num_entries, args)
+
+    baseline_dict = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline_dict = json.load(file)["results"]
+
+    num_regressions = print_results(results_dict, baseline_dict, args.tolerance)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"seed": args.seed, "jobs": args.jobs, "scan_threads": args.scan_threads,
+                       "planner_only": args.planner_only, "results": results_dict},
+                      file, indent=4)
+        print(f"\nResults saved to \"{args.output}\".")
+
+    if num_regressions > 0:
+        colors.print_red(f"\n{num_regressions} phase(s) regressed by more than "
+                         f"{args.tolerance:.0%} compared to \"{args.baseline}\".")
+        sys.exit(EXIT_FAILURE)
+
+
+if __name__ == "__main__":
+    main()
@@ -25,7 +25,9 @@ MAX_ALLOWED_PATH_LEN = WINDOWS_MAX_PATH_LEN - PATH_LEN_ALREADY_USED
 ILLEGAL_WINDOWS_CHARS = "<>:\"\\|?*"
 
 # Length of the hash to append to the end of a file name to make it unique.
-# - If you get name collisions when running this program, **increase this number** until they stop.
+# - Names which would collide with another name in the same dir get a longer hash automatically,
+#   but only those names. If you still get name collisions with files already on the disk when
+#   running this program, **increase this number** until they stop.
 # - If you need to shorten the path further, **decrease this number**.
 HASH_LEN = 3  # Default: 3
 
@@ -38,11 +40,39 @@ HASH_PREFIX_FOR_ILLEGALS = "#"
 
 # Suffix to add to the output shortened directory name.
 # - To further shorten the output dir, use "_" instead of `_short`.
-# - WARNING: NEVER use "" (empty string) as the suffix, as that (I haven't tested this yet though)
-#   may cause the program to overwrite the original files!
+# - This must NOT be "" (empty string), as the copy would then overwrite the original dir. To fix
+#   the original dir itself, use the `--in_place` option instead, which can be undone with
+#   `--undo`.
 SHORT_DIR_SUFFIX = "_short"  # Default: "_short".
 
 
+class Settings:
+    """
+    All of the settings above which affect how paths are fixed, as one object, so that the path
+    shortener can be used as a library, with different settings per job, instead of only through
+    the module-level globals in this file.
+
+    Each setting defaults to the value of the corresponding global above.
+    """
+    def __init__(self,
+                 max_allowed_path_len=MAX_ALLOWED_PATH_LEN,
+                 illegal_windows_chars=ILLEGAL_WINDOWS_CHARS,
+                 hash_len=HASH_LEN,
+                 hash_prefix_for_shortened=HASH_PREFIX_FOR_SHORTENED,
+                 hash_prefix_for_illegals=HASH_PREFIX_FOR_ILLEGALS,
+                 short_dir_suffix=SHORT_DIR_SUFFIX):
+        self.max_allowed_path_len = max_allowed_path_len
+        self.illegal_windows_chars = illegal_windows_chars
+        self.hash_len = hash_len
+        self.hash_prefix_for_shortened = hash_prefix_for_shortened
+        self.hash_prefix_for_illegals = hash_prefix_for_illegals
+        self.short_dir_suffix = short_dir_suffix
+
+    def __repr__(self):
+        settings_str = ", ".join(f"{name}={value!r}" for name, value in vars(self).items())
+        return f"Settings({settings_str})"
+
+
 if __name__ == "__main__":
     print(f"WINDOWS_MAX_PATH_LEN:       {WINDOWS_MAX_PATH_LEN}")
     print(f"EXAMPLE_BASE_PATH_STR:      {EXAMPLE_BASE_PATH_STR}")
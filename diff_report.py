@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Write a report of only the files and dirs which were renamed, grouped by the dir they are in, as
+plain text and as HTML. This is much smaller than the full before and after path listings, which
+list every path that needed fixing, and so stays quick to read, and to `meld`, even for runs with
+hundreds of thousands of paths. This is what `path_shortener.py` writes at the end of each run.
+
+The renames come from `path_shortener.get_dir_renames()`: one
+`(parent_parts, name_old, name_new)` tuple per renamed file or dir, where `parent_parts` is the
+tuple of the *original* names along the path to its parent dir.
+
+Files written:
+- "renames_1_before.txt" and "renames_2_after.txt": the same dir headers, with the old names in
+  one and the new names in the other, line for line, so that a diff tool such as `meld` lines them
+  up and highlights only the renamed parts.
+- "renames_side_by_side.txt": the old and new names next to each other, in columns.
+- "renames.html": the same, as one table per dir, viewable in any browser.
+
+Example usage:
+```python
+import diff_report
+
+renames_by_dir_dict = diff_report.group_renames_by_dir(dir_renames_list)
+diff_report.write_diff_report(output_dir, renames_by_dir_dict)
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import html
+import os
+
+from pathlib import Path
+
+
+RENAMES_BEFORE_FILENAME = "renames_1_before.txt"
+RENAMES_AFTER_FILENAME = "renames_2_after.txt"
+RENAMES_SIDE_BY_SIDE_FILENAME = "renames_side_by_side.txt"
+RENAMES_HTML_FILENAME = "renames.html"
+
+# The old names column of the side-by-side view is padded to the longest old name in each dir,
+# but no wider than this, to keep the view compact.
+MAX_SIDE_BY_SIDE_COLUMN_WIDTH = 60
+
+
+def group_renames_by_dir(dir_renames_list):
+    """
+    Group the renames from `get_dir_renames()` by the original path of the dir they are in.
+
+    Returns a dict of parent dir path string --> list of `(name_old, name_new)` tuples, with the
+    dirs in sorted order, and the renames in each dir sorted by their old names.
+    """
+    renames_by_dir_dict = {}
+    for parent_parts, name_old, name_new in dir_renames_list:
+        renames_by_dir_dict.setdefault(str(Path(*parent_parts)), []).append((name_old, name_new))
+
+    return {dir_path: sorted(renames_by_dir_dict[dir_path])
+            for dir_path in sorted(renames_by_dir_dict)}
+
+
+def write_diff_report(output_dir, renames_by_dir_dict):
+    """
+    Write the report files described at the top of this module into `output_dir`.
+
+    Returns a `(renames_before_filename, renames_after_filename)` tuple, of the 2 files to compare
+    with `meld`.
+    """
+    renames_before_filename = os.path.join(output_dir, RENAMES_BEFORE_FILENAME)
+    renames_after_filename = os.path.join(output_dir, RENAMES_AFTER_FILENAME)
+    rename_count = sum(len(renames_list) for renames_list in renames_by_dir_dict.values())
+    header_str = (f"{rename_count} files and dirs renamed, in {len(renames_by_dir_dict)} dirs.\n"
+                  "Format: dir path (original names)/, then the renamed names in it.\n")
+
+    # 1. The 2 files for `meld`, aligned line for line
+    with (open(renames_before_filename, "w") as file_before,
+          open(renames_after_filename, "w") as file_after):
+
+        file_before.write("BEFORE (original) names:\n" + header_str)
+        file_after.write("AFTER (fixed & shortened) names:\n" + header_str)
+
+        for dir_path, renames_list in renames_by_dir_dict.items():
+            dir_header_str = f"\n{dir_path}/\n"
+            file_before.write(dir_header_str)
+            file_after.write(dir_header_str)
+            for name_old, name_new in renames_list:
+                file_before.write(f"    {name_old}\n")
+                file_after.write(f"    {name_new}\n")
+
+    # 2. The side-by-side text view
+    with open(os.path.join(output_dir, RENAMES_SIDE_BY_SIDE_FILENAME), "w") as file:
+        file.write(header_str)
+        for dir_path, renames_list in renames_by_dir_dict.items():
+            column_width = min(max(len(name_old) for name_old, _ in renames_list),
+                               MAX_SIDE_BY_SIDE_COLUMN_WIDTH)
+            file.write(f"\n{dir_path}/\n")
+            for name_old, name_new in renames_list:
+                file.write(f"    {name_old:<{column_width}}  ->  {name_new}\n")
+
+    # 3. The HTML view
+    with open(os.path.join(output_dir, RENAMES_HTML_FILENAME), "w") as file:
+        file.write("<!DOCTYPE html>\n<html>\n<head>\n<meta charset=\"utf-8\">\n"
+                   "<title>eRCaGuy_PathShortener renames</title>\n"
+                   "<style>\n"
+                   "body { font-family: sans-serif; }\n"
+                   "table { border-collapse: collapse; margin-bottom: 1em; }\n"
+                   "td, th { border: 1px solid #ccc; padding: 2px 8px; font-family: monospace; "
+                   "text-align: left; }\n"
+                   "td.old { background: #fdd; }\n"
+                   "td.new { background: #dfd; }\n"
+                   "</style>\n</head>\n<body>\n")
+        file.write(f"<p>{html.escape(header_str.splitlines()[0])}</p>\n")
+        for dir_path, renames_list in renames_by_dir_dict.items():
+            file.write(f"<h3>{html.escape(dir_path)}/</h3>\n<table>\n"
+                       "<tr><th>Before</th><th>After</th></tr>\n")
+            for name_old, name_new in renames_list:
+                file.write(f"<tr><td class=\"old\">{html.escape(name_old)}</td>"
+                           f"<td class=\"new\">{html.escape(name_new)}</td></tr>\n")
+            file.write("</table>\n")
+        file.write("</body>\n</html>\n")
+
+    return renames_before_filename, renames_after_filename
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""
+Include/exclude filters for the files and dirs to process, so that whole subtrees which are never
+needed on Windows, such as `.git`, `node_modules`, and build caches, can be skipped while walking
+and copying, rather than afterwards. This is what the `--exclude`, `--include`, and
+`--exclude_from` options of `path_shortener.py` use.
+
+Patterns are shell-style globs (see `fnmatch`), like in a `.gitignore` file:
+- A pattern with no "/" in it matches the name of a file or dir at any depth. Ex: "node_modules".
+- A pattern with a "/" in it matches the path relative to the top dir. Ex: "build/*.o".
+- A pattern ending in "/" matches dirs only. Ex: "cache/".
+
+A symlink to a dir counts as a dir, whether or not it is followed, so "cache/" matches a "cache"
+symlink to a dir too.
+
+An excluded dir is skipped along with everything under it. If any include patterns are given, only
+the files matching one of them are kept, though all dirs which aren't excluded are still walked.
+
+Example usage:
+```python
+import filters
+
+path_filter = filters.PathFilter(exclude_patterns_list=[".git", "node_modules", "*.pyc"])
+path_filter.is_excluded("src/node_modules", is_dir=True)  # --> True
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import fnmatch
+import os
+
+
+def read_patterns_file(file):
+    """
+    Read the patterns from an ignore file, one per line, like a `.gitignore` file. Blank lines and
+    lines beginning with "#" are skipped, and lines beginning with "!" are include patterns.
+
+    Returns an `(exclude_patterns_list, include_patterns_list)` tuple.
+    """
+    exclude_patterns_list = []
+    include_patterns_list = []
+    for line in file:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("!"):
+            include_patterns_list.append(line[1:])
+        else:
+            exclude_patterns_list.append(line)
+
+    return exclude_patterns_list, include_patterns_list
+
+
+class PathFilter:
+    def __init__(self, exclude_patterns_list=(), include_patterns_list=()):
+        # (pattern, whether it matches dirs only, whether it matches the whole relative path)
+        self.excludes_list = [self.parse_pattern(pattern) for pattern in exclude_patterns_list]
+        self.includes_list = [self.parse_pattern(pattern) for pattern in include_patterns_list]
+
+    @staticmethod
+    def parse_pattern(pattern):
+        dir_only = pattern.endswith("/")
+        pattern = pattern.strip("/")
+        return pattern, dir_only, "/" in pattern
+
+    def __bool__(self):
+        """
+        False if this filter keeps everything.
+        """
+        return bool(self.excludes_list or self.includes_list)
+
+    def needs_is_dir(self, name):
+        """
+        Whether `is_excluded()` needs to know if the entry called `name` is a dir, to decide. If
+        not, the caller can skip the `stat()` call to find out.
+        """
+        if self.includes_list:
+            return True
+        return any(dir_only and fnmatch.fnmatchcase(name, pattern.rsplit("/", 1)[-1])
+                   for pattern, dir_only, _ in self.excludes_list)
+
+    @staticmethod
+    def matches(patterns_list, relative_path, is_dir):
+        name = relative_path.rsplit("/", 1)[-1]
+        for pattern, dir_only, match_whole_path in patterns_list:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(relative_path if match_whole_path else name, pattern):
+                return True
+        return False
+
+    def is_excluded(self, relative_path, is_dir):
+        """
+        Whether to skip the file or dir at `relative_path`, relative to the top dir being walked or
+        copied, and everything under it.
+        """
+        relative_path = relative_path.replace(os.sep, "/")
+        if self.matches(self.excludes_list, relative_path, is_dir):
+            return True
+        if self.includes_list and not is_dir:
+            return not self.matches(self.includes_list, relative_path, is_dir)
+        return False
+
+    def is_path_excluded(self, path, relative_path):
+        """
+        Same as `is_excluded()`, but checks whether the file or dir at `path` is a dir, following
+        symlinks, only if that is needed to decide.
+        """
+        is_dir = self.needs_is_dir(os.path.basename(path)) and os.path.isdir(path)
+        return self.is_excluded(relative_path, is_dir)
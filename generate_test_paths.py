@@ -3,6 +3,22 @@
 """
 Generate a directory structure with long human-readable folder and file names inside `test_paths/`.
 
+Example usage:
+
+```bash
+# Regenerate the small demo `test_paths/` dir
+./generate_test_paths.py
+
+# Same, but reproducibly
+./generate_test_paths.py --seed 1
+
+# Generate a large, reproducible tree with 100k entries on tmpfs (RAM), using 8 threads
+./generate_test_paths.py --seed 1 --num_entries 100000 --tmpfs --jobs 8
+
+# Help menu
+./generate_test_paths.py -h
+```
+
 References:
 1. https://docs.python.org/3/library/os.html#os.makedirs
 1. https://docs.python.org/3/library/os.path.html#os.path.join
@@ -17,10 +33,14 @@ import config
 # NA
 
 # standard library imports
+import argparse
+import concurrent.futures
+import json
 import os
 import random
 import subprocess
 import sys
+import textwrap
 
 
 # See my answer: https://stackoverflow.com/a/74800814/4561887
@@ -125,6 +145,202 @@ def create_long_name_structure(
     create_nested_dirs(base_dir, 1)
 
 
+def generate_name(max_num_words, illegal_char_rate, extension=""):
+    """
+    Generate a human-readable file or dir name, adding 1 to 3 random illegal Windows chars to the
+    end of it with a probability of `illegal_char_rate`.
+    """
+    random_illegal_chars = ""
+    if random.random() < illegal_char_rate:
+        random_illegal_chars = get_random_chars(config.ILLEGAL_WINDOWS_CHARS, 1, 3)
+
+    name = generate_human_readable_name(max_num_words) + random_illegal_chars + extension
+    return name
+
+
+def make_name_unique(names_set, name, extension=""):
+    """
+    Ensure `name` is not already in `names_set` (the names already used in the same directory) by
+    adding a counter to the end of its stem if needed, and add it to that set.
+    """
+    stem = name.removesuffix(extension)
+
+    counter = 1
+    while name in names_set:
+        name = f"{stem}_{counter}{extension}"
+        counter += 1
+
+    names_set.add(name)
+    return name
+
+
+def generate_unique_name(names_set, max_num_words, illegal_char_rate, extension=""):
+    """
+    Same as `generate_name()`, but ensure the name is unique within `names_set`. See
+    `make_name_unique()`.
+    """
+    name = generate_name(max_num_words, illegal_char_rate, extension)
+    return make_name_unique(names_set, name, extension)
+
+
+def generate_tree_entries(
+        num_entries,
+        max_depth,
+        min_width,
+        max_width,
+        max_files_per_dir,
+        max_num_words,
+        illegal_char_rate,
+        symlink_rate,
+    ):
+    """
+    Generate, in memory only, the entries of a directory tree of up to `num_entries` entries.
+
+    - Each directory gets from `min_width` to `max_width` subdirectories, inclusive, down to a
+      depth of `max_depth`, and from 0 to `max_files_per_dir` files, inclusive.
+    - With a probability of `symlink_rate`, each directory with files in it also gets one symlink
+      to one of its files.
+    - Names are made of 1 to `max_num_words` words, and get illegal Windows chars added to them
+      with a probability of `illegal_char_rate`.
+
+    Directories are expanded in random order rather than breadth-first, so that the tree gets both
+    deep and wide before reaching `num_entries`.
+
+    Use `random.seed()` beforehand to make the output reproducible.
+
+    Returns a list of `(relative_path, entry_type, symlink_target)` tuples, where `entry_type` is
+    "d" for directories, "f" for files, and "l" for symlinks, as in `find -printf "%y"`, and
+    `symlink_target` is None for everything but symlinks. Parent directories always come before
+    their contents in the list.
+    """
+    entries_list = []
+    pending_dirs_list = [("", 0)]  # (relative dir path, depth) of the dirs to fill in still
+
+    while pending_dirs_list and len(entries_list) < num_entries:
+        # Pop a random pending dir
+        i = random.randrange(len(pending_dirs_list))
+        pending_dirs_list[i], pending_dirs_list[-1] = pending_dirs_list[-1], pending_dirs_list[i]
+        dir_path, depth = pending_dirs_list.pop()
+
+        names_set = set()
+
+        # Files
+        extension = ".txt"
+        file_names_list = []
+        for _ in range(random.randint(0, max_files_per_dir)):
+            file_name = generate_unique_name(names_set, max_num_words, illegal_char_rate,
+                                             extension)
+            file_names_list.append(file_name)
+            entries_list.append((os.path.join(dir_path, file_name), "f", None))
+
+        # One symlink to one of the files
+        if file_names_list and random.random() < symlink_rate:
+            target_relative = random.choice(file_names_list)
+            file_name_without_extension = os.path.splitext(target_relative)[0]
+            random_illegal_chars = get_random_chars(config.ILLEGAL_WINDOWS_CHARS, 0, 3)
+            symlink_name = (
+                file_name_without_extension + random_illegal_chars + "_symlink" + extension)
+            symlink_name = make_name_unique(names_set, symlink_name, extension)
+            entries_list.append((os.path.join(dir_path, symlink_name), "l", target_relative))
+
+        # Subdirs
+        if depth < max_depth:
+            for _ in range(random.randint(min_width, max_width)):
+                subdir_name = generate_unique_name(names_set, max_num_words, illegal_char_rate)
+                subdir_path = os.path.join(dir_path, subdir_name)
+                entries_list.append((subdir_path, "d", None))
+                pending_dirs_list.append((subdir_path, depth + 1))
+
+    return entries_list[:num_entries]
+
+
+def create_entries_chunk(base_dir, entries_chunk):
+    """
+    Create the files and symlinks in `entries_chunk` (a chunk of the list returned by
+    `generate_tree_entries()`) on the disk. Their parent dirs must already exist.
+    """
+    for relative_path, entry_type, symlink_target in entries_chunk:
+        path = os.path.join(base_dir, relative_path)
+        if entry_type == "f":
+            with open(path, 'w') as f:
+                f.write("This is a test file.")
+        elif entry_type == "l":
+            os.symlink(symlink_target, path)
+
+
+def create_tree_entries(base_dir, entries_list, num_jobs, chunk_size=1000):
+    """
+    Create all of the entries returned by `generate_tree_entries()` inside `base_dir`, using up to
+    `num_jobs` threads at once.
+    """
+    os.makedirs(base_dir)
+
+    dirs_by_depth_dict = {}  # depth --> list of dir paths at that depth
+    other_entries_list = []
+    for entry in entries_list:
+        relative_path, entry_type, _ = entry
+        if entry_type == "d":
+            depth = relative_path.count(os.sep)
+            dirs_by_depth_dict.setdefault(depth, []).append(os.path.join(base_dir, relative_path))
+        else:
+            other_entries_list.append(entry)
+
+    def make_dirs_chunk(dir_paths_chunk):
+        for dir_path in dir_paths_chunk:
+            os.mkdir(dir_path)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_jobs) as executor:
+        # 1. Create the dirs, one depth level at a time, so that parent dirs always exist before
+        #    their subdirs are created.
+        for depth in sorted(dirs_by_depth_dict):
+            dir_paths_list = dirs_by_depth_dict[depth]
+            futures_list = [executor.submit(make_dirs_chunk, dir_paths_list[i:i + chunk_size])
+                            for i in range(0, len(dir_paths_list), chunk_size)]
+            for future in futures_list:
+                future.result()  # re-raise any exceptions
+
+        # 2. Create all files and symlinks at once
+        futures_list = [
+            executor.submit(create_entries_chunk, base_dir, other_entries_list[i:i + chunk_size])
+            for i in range(0, len(other_entries_list), chunk_size)]
+        for future in futures_list:
+            future.result()
+
+
+def write_path_list(file, entries_list):
+    """
+    Write the entries returned by `generate_tree_entries()` to an open text file, as a path list
+    with one JSON object per line (JSON Lines), instead of creating them on the disk. Ex:
+    ```
+    {"path": "some_dir", "type": "d"}
+    {"path": "some_dir/some_file.txt", "type": "f"}
+    {"path": "some_dir/some_file_symlink.txt", "type": "l", "target": "some_file.txt"}
+    ```
+    """
+    for relative_path, entry_type, symlink_target in entries_list:
+        entry_dict = {"path": relative_path, "type": entry_type}
+        if symlink_target is not None:
+            entry_dict["target"] = symlink_target
+        file.write(json.dumps(entry_dict) + "\n")
+
+
+def read_path_list(file):
+    """
+    Read a path list written by `write_path_list()` from an open text file.
+
+    Returns the same list of `(relative_path, entry_type, symlink_target)` tuples as
+    `generate_tree_entries()`.
+    """
+    entries_list = []
+    for line in file:
+        if not line.strip():
+            continue
+        entry_dict = json.loads(line)
+        entries_list.append((entry_dict["path"], entry_dict["type"], entry_dict.get("target")))
+
+    return entries_list
+
+
 def move_to_recycle_bin(src_path):
     """
     Move the directory to the recycle bin, appending a number if the target already exists.
@@ -144,20 +360,117 @@ def move_to_recycle_bin(src_path):
     print(f"Moved {src_path} to {target_path}\n")
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        description=textwrap.dedent("""\
+            Generate a directory tree with long human-readable folder and file names, some
+            containing illegal Windows chars, plus symlinks, to test `path_shortener.py` on.
+
+            With no options, this regenerates the small demo `test_paths/` dir. Pass
+            '--num_entries' to instead generate a large tree of any size, for benchmarking.
+        """)
+    )
+
+    parser.add_argument("--seed", type=int, default=None, help="Random seed, to make the "
+        "generated tree reproducible. Default: a random seed, which is printed.")
+    parser.add_argument("-o", "--output_dir", type=str, default=None, help="Where to generate the "
+        "tree. It must not exist yet. Default: 'test_paths/' next to this script, which is moved "
+        "to the recycle bin first if it already exists.")
+    parser.add_argument("--tmpfs", action="store_true", help="Generate the tree on tmpfs (RAM) at "
+        "'/dev/shm/test_paths' instead, unless '--output_dir' is also given. This takes disk I/O "
+        "out of the picture.")
+
+    scalable_group = parser.add_argument_group("large tree options",
+        "These only apply when '--num_entries' is given.")
+    scalable_group.add_argument("-n", "--num_entries", type=int, default=None, help="Total number "
+        "of files, dirs, and symlinks to generate.")
+    scalable_group.add_argument("--depth", type=int, default=8, help="Max depth of nested dirs. "
+        "Default: 8.")
+    scalable_group.add_argument("--min_width", type=int, default=1, help="Min number of subdirs "
+        "per dir. Default: 1.")
+    scalable_group.add_argument("--max_width", type=int, default=4, help="Max number of subdirs "
+        "per dir. Default: 4.")
+    scalable_group.add_argument("--max_files_per_dir", type=int, default=10, help="Max number of "
+        "files per dir. Default: 10.")
+    scalable_group.add_argument("--max_num_words", type=int, default=10, help="Max number of "
+        "words to combine into each name, which sets the name lengths. Default: 10.")
+    scalable_group.add_argument("--illegal_char_rate", type=float, default=0.5, help="Fraction "
+        "of names to add illegal Windows chars to. Default: 0.5.")
+    scalable_group.add_argument("--symlink_rate", type=float, default=1.0, help="Fraction of "
+        "dirs with files in them to add a symlink to. Default: 1.0.")
+    scalable_group.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of "
+        "threads to create the entries with. Default: the number of CPU cores.")
+    scalable_group.add_argument("--path_list", type=str, default=None, help="Instead of creating "
+        "the tree on the disk, write its path list, with file/dir/symlink types, to this JSON "
+        "Lines file, or to stdout if '-'. Use this to benchmark the planner without any disk I/O. "
+        "See `./benchmark.py --planner_only`.")
+
+    args = parser.parse_args()
+
+    if args.path_list and args.num_entries is None:
+        parser.print_usage()
+        print("Error: '--path_list' requires '--num_entries'.")
+        sys.exit(1)
+
+    if args.seed is None:
+        args.seed = random.randrange(2**32)
+
+    return args
+
+
 def main():
-    base_dir = os.path.join(SCRIPT_DIRECTORY, "test_paths")
+    args = parse_args()
+
+    # Keep stdout clean for the path list if it is being written there
+    print(f"Random seed: {args.seed}", file=sys.stderr if args.path_list == "-" else sys.stdout)
+    random.seed(args.seed)
+
+    if args.path_list:
+        entries_list = generate_tree_entries(args.num_entries, args.depth, args.min_width,
+            args.max_width, args.max_files_per_dir, args.max_num_words, args.illegal_char_rate,
+            args.symlink_rate)
+
+        if args.path_list == "-":
+            write_path_list(sys.stdout, entries_list)
+        else:
+            with open(args.path_list, "w") as file:
+                write_path_list(file, entries_list)
+            print(f"Path list with {len(entries_list)} entries written to: {args.path_list}")
+        return
+
+    if args.output_dir:
+        base_dir = args.output_dir
+    elif args.tmpfs:
+        base_dir = os.path.join("/dev/shm", "test_paths")
+    else:
+        base_dir = os.path.join(SCRIPT_DIRECTORY, "test_paths")
 
-    # Move the base_dir to the recycle bin if it already exists
     if os.path.exists(base_dir):
+        if base_dir != os.path.join(SCRIPT_DIRECTORY, "test_paths"):
+            print(f"Error: output directory \"{base_dir}\" already exists. Exiting.")
+            sys.exit(1)
+
+        # Move the base_dir to the recycle bin if it already exists
         print(f"Moving existing test directory to the recycle bin: {base_dir}")
         move_to_recycle_bin(base_dir)
 
+    if args.num_entries is not None:
+        entries_list = generate_tree_entries(args.num_entries, args.depth, args.min_width,
+            args.max_width, args.max_files_per_dir, args.max_num_words, args.illegal_char_rate,
+            args.symlink_rate)
+        create_tree_entries(base_dir, entries_list, args.jobs)
+
+        print(f"Test directory structure with {len(entries_list)} entries created at: "
+              f"{base_dir}\n")
+        return
+
     num_folders = 1
     num_files_per_folder = 3
     num_empty_dirs_per_folder = 2
     max_num_words = 10  # Max number of words to combine for folder and file names
     folder_depth = 8  # Depth of nested folders
-    create_long_name_structure(base_dir, num_folders, num_files_per_folder, 
+    create_long_name_structure(base_dir, num_folders, num_files_per_folder,
                                num_empty_dirs_per_folder, max_num_words, folder_depth)
 
     print(f"Test directory structure created at: {base_dir}\n")
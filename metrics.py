@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Export the metrics of a run, such as its path counts, renames, bytes copied, and how long each
+phase took, in machine-readable formats, for monitoring runs over time, such as from cron:
+- The Prometheus text format, for node_exporter's textfile collector. See:
+  https://prometheus.io/docs/instrumenting/exposition_formats/
+- JSON, for everything else.
+
+Both files are written atomically, by writing a temporary file and renaming it over the old one,
+so that a collector never reads a half-written file.
+
+Example usage:
+```python
+import metrics
+
+run_metrics = metrics.Metrics(labels_dict={"dir": "my_dir"})
+run_metrics.add("renames", 12, "Files and dirs renamed.")
+run_metrics.add("phase_duration_seconds", 1.5, "Wall time of each phase.", {"phase": "copy"})
+run_metrics.write(prom_path="my_dir.prom", json_path="my_dir.json")
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import json
+import math
+import os
+
+
+# The prefix of the names of all metrics
+METRIC_NAME_PREFIX = "path_shortener_"
+
+
+def escape_label_value(value):
+    """
+    Escape a label value for the Prometheus text format.
+    """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    """
+    Format a sample value for the Prometheus text format.
+    """
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, float):
+        if math.isnan(value):
+            return "NaN"
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def write_file_atomically(file_path, contents_str):
+    file_path_tmp = f"{file_path}.{os.getpid()}.tmp"
+    with open(file_path_tmp, "w") as file:
+        file.write(contents_str)
+    os.replace(file_path_tmp, file_path)
+
+
+class Metrics:
+    """
+    A set of gauge metrics, each with one sample per set of labels.
+    """
+    def __init__(self, labels_dict=None):
+        """
+        labels_dict: the labels to add to every sample. Ex: `{"dir": "my_dir"}`.
+        """
+        self.labels_dict = dict(labels_dict or {})
+        # metric name --> {"help": help string, "samples": [(labels dict, value), ...]}, in the
+        # order first added
+        self.metrics_dict = {}
+
+    def add(self, name, value, help_str, labels_dict=None):
+        """
+        Add a sample of the metric `METRIC_NAME_PREFIX + name`. Samples with a value of None are
+        skipped.
+        """
+        if value is None:
+            return
+
+        metric = self.metrics_dict.setdefault(METRIC_NAME_PREFIX + name,
+                                              {"help": help_str, "samples": []})
+        metric["samples"].append(({**self.labels_dict, **(labels_dict or {})}, value))
+
+    def to_prometheus_text(self):
+        lines_list = []
+        for name, metric in self.metrics_dict.items():
+            lines_list.append(f"# HELP {name} {metric['help']}")
+            lines_list.append(f"# TYPE {name} gauge")
+            for labels_dict, value in metric["samples"]:
+                labels_str = ",".join(f"{label_name}=\"{escape_label_value(label_value)}\""
+                                      for label_name, label_value in labels_dict.items())
+                if labels_str:
+                    labels_str = "{" + labels_str + "}"
+                lines_list.append(f"{name}{labels_str} {format_value(value)}")
+
+        return "\n".join(lines_list) + "\n"
+
+    def to_dict(self):
+        return {name: [{"labels": labels_dict, "value": value}
+                       for labels_dict, value in metric["samples"]]
+                for name, metric in self.metrics_dict.items()}
+
+    def write(self, prom_path=None, json_path=None):
+        """
+        Write the metrics in the Prometheus text format to `prom_path`, and as JSON to
+        `json_path`, if given.
+        """
+        if prom_path is not None:
+            write_file_atomically(prom_path, self.to_prometheus_text())
+        if json_path is not None:
+            write_file_atomically(json_path, json.dumps(self.to_dict(), indent=4) + "\n")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+Read the list of all paths in a dir, with their types, from a file or stdin, instead of walking
+the dir, such as from the index which a storage system already keeps of every path in it. On
+huge network shares, re-walking the dir only to rediscover that list is the slowest part of a run.
+This is what the `--path_list` option of `path_shortener.py` uses.
+
+Also write a rename plan in the same NUL-delimited form, for `xargs -0` pipelines. This is what
+the `--plan_file` option of `path_shortener.py` uses.
+
+Path list formats, detected automatically:
+- NUL-delimited: one `TYPE<TAB>PATH` record per path, each ending in a NUL char, as written by:
+  ```bash
+  find path/to/dir -mindepth 1 -printf '%y\t%P\0'
+  ```
+- JSON Lines: one `{"path": PATH, "type": TYPE}` object per line, as written by
+  `generate_test_paths.py --path_list`.
+
+Each PATH is relative to the dir, and each TYPE is "d" for dirs, "f" for files, or "l" for
+symlinks, same as `find -printf "%y"`. Any other types, such as "p" for named pipes, are treated
+as files.
+
+Example usage:
+```python
+import path_list
+
+with open("paths.txt", "rb") as file:
+    for relative_path, entry_type in path_list.read_path_list(file):
+        print(entry_type, relative_path)
+
+with open("renames.txt", "wb") as file:
+    path_list.write_rename_plan(file, [("dir/old_name", "dir/new_name")])
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import json
+import os
+
+
+# How many bytes of a path list to read at a time
+READ_CHUNK_SIZE = 1024*1024
+
+# The entry types from `find -printf "%y"` which are treated as themselves. See the top of this
+# module.
+ENTRY_TYPES_LIST = ["d", "f", "l"]
+
+
+def iter_records(file, data=b"", separator=b"\0"):
+    """
+    Yield each record ending in `separator` in the binary `file`, without the separator, starting
+    with the already-read bytes `data`. A last record without a separator at the end is yielded
+    too.
+    """
+    while True:
+        records_list = data.split(separator)
+        data = records_list.pop()
+        yield from records_list
+
+        chunk = file.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+
+    if data:
+        yield data
+
+
+def parse_nul_record(record):
+    """
+    Parse a `TYPE<TAB>PATH` record into a `(relative_path, entry_type)` tuple.
+    """
+    if record[1:2] != b"\t":
+        raise ValueError(f"expected a 'TYPE<TAB>PATH' record, as from "
+                         f"`find dir -mindepth 1 -printf '%y\\t%P\\0'`, not {record[:100]!r}.")
+
+    # `os.fsdecode()` keeps paths which aren't valid UTF-8, same as `os.walk()` does
+    return os.fsdecode(record[2:]), record[0:1].decode("ascii", errors="replace")
+
+
+def parse_json_line(line):
+    """
+    Parse a `{"path": PATH, "type": TYPE}` line into a `(relative_path, entry_type)` tuple.
+    """
+    try:
+        entry_dict = json.loads(line)
+        return entry_dict["path"], entry_dict["type"]
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f"expected a '{{\"path\": PATH, \"type\": TYPE}}' line, not "
+                         f"{line[:100]!r}.") from e
+
+
+def read_path_list(file):
+    """
+    Read a path list in either of the formats described at the top of this module from the binary
+    `file`, such as `sys.stdin.buffer`.
+
+    Yields one `(relative_path, entry_type)` tuple per path, with `entry_type` being one of
+    `ENTRY_TYPES_LIST`, and the "." entry for the dir itself, if listed, left out. Raises a
+    `ValueError` on a malformed record.
+    """
+    data = file.read(READ_CHUNK_SIZE)
+    if b"\0" in data:
+        records_iterator = (parse_nul_record(record)
+                            for record in iter_records(file, data) if record)
+    else:
+        records_iterator = (parse_json_line(line.decode("utf-8", errors="surrogateescape"))
+                            for line in iter_records(file, data, b"\n") if line.strip())
+
+    for relative_path, entry_type in records_iterator:
+        relative_path = os.path.normpath(relative_path)
+        if relative_path == ".":
+            continue
+        if (os.path.isabs(relative_path) or relative_path == os.pardir
+                or relative_path.startswith(os.pardir + os.sep)):
+            raise ValueError(f"path \"{relative_path}\" is not inside of the dir.")
+
+        yield relative_path, entry_type if entry_type in ENTRY_TYPES_LIST else "f"
+
+
+def write_rename_plan(file, renames_list):
+    """
+    Write each `(path_old, path_new)` rename in `renames_list`, in order, to the binary `file`, as
+    the 2 paths, each followed by a NUL char, so that running
+    `xargs -0 -n 2 mv -n --` on the file makes the renames.
+    """
+    for path_old, path_new in renames_list:
+        file.write(os.fsencode(path_old) + b"\0" + os.fsencode(path_new) + b"\0")
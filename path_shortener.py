@@ -36,24 +36,46 @@ References:
 # Local imports
 import ansi_colors as colors
 import config
+import diff_report
+import filters
+import metrics
+import path_list
 import paths
+import progress
+import server
 import Tee
+import throttle
+import watch
 
 # Third party imports
 from sortedcontainers import SortedList
 
 # Python imports
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
 import copy
+import cProfile
+import errno
+import functools
 import hashlib
 import inspect
+import io
+import json
 import os
 import pprint
+import pstats
 import re  # regular expressions
+import resource
 import shutil
+import stat
 import subprocess
 import sys
 import textwrap
+import time
+import tracemalloc
 
 from pathlib import Path
 
@@ -69,31 +91,304 @@ EXIT_SUCCESS = 0
 EXIT_FAILURE = 1
 
 
-def copy_directory(src, dst, args):
+class PathShortenerError(Exception):
+    """
+    Raised when the paths can't be fixed. The CLI prints the message and exits, while users of the
+    `PathShortener` library class can catch it instead.
+    """
+
+
+class PathTooLongError(PathShortenerError):
+    """
+    Raised when a path is still too long even after shortening all of its segments as far as
+    possible.
+    """
+
+
+class NameCollisionError(PathShortenerError):
+    """
+    Raised when a fixed or shortened name, or its namefile, collides with one which already exists.
+    """
+
+
+# How many bytes to read and write at once when copying the data of a sparse file
+SPARSE_COPY_CHUNK_SIZE = 1024*1024
+
+
+def get_allocated_bytes(stat_result):
+    """
+    Get the number of bytes which a file actually takes up on the disk, which is less than its
+    apparent size (`st_size`) if it is sparse, ie: has holes which were never written to.
+    """
+    # `st_blocks` is always in 512-byte units, no matter the filesystem's block size
+    return min(stat_result.st_size, stat_result.st_blocks*512)
+
+
+def is_sparse(stat_result):
+    return get_allocated_bytes(stat_result) < stat_result.st_size
+
+
+def copy_sparse_file(src, dst, timer=None):
+    """
+    Copy the contents of the sparse file `src` to `dst`, copying only its data extents, found with
+    `os.lseek()` and `SEEK_DATA`/`SEEK_HOLE`, and leaving its holes as holes in `dst`, rather than
+    writing them out as zeros like `shutil.copyfile()` does. The time waited for `io_throttle` is
+    counted in the `PhaseTimer` `timer`, if given.
+
+    Returns the number of bytes of data actually copied. Raises an `OSError` with errno `EINVAL`
+    if the filesystem of `src` can't find holes.
+    """
+    num_bytes_copied = 0
+    with open(src, "rb") as file_src, open(dst, "wb") as file_dst:
+        fd_src = file_src.fileno()
+        fd_dst = file_dst.fileno()
+        size = os.fstat(fd_src).st_size
+
+        offset = 0
+        while offset < size:
+            try:
+                data_start = os.lseek(fd_src, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    break  # only a hole is left, up to the end of the file
+                raise
+            data_end = os.lseek(fd_src, data_start, os.SEEK_HOLE)
+
+            for chunk_start in range(data_start, data_end, SPARSE_COPY_CHUNK_SIZE):
+                chunk = os.pread(fd_src, min(SPARSE_COPY_CHUNK_SIZE, data_end - chunk_start),
+                                 chunk_start)
+                throttle_io(timer, num_ops=0, num_bytes=len(chunk))
+                os.pwrite(fd_dst, chunk, chunk_start)
+                num_bytes_copied += len(chunk)
+
+            offset = data_end
+
+        # Re-create the hole at the end, if any
+        os.ftruncate(fd_dst, size)
+
+    return num_bytes_copied
+
+
+def copy_file_in_chunks(src, dst, timer=None):
+    """
+    Same as `shutil.copyfile()`, but copy `SPARSE_COPY_CHUNK_SIZE` bytes at a time, within the
+    limits of `io_throttle`, rather than all at once in the kernel, which can't be throttled. The
+    time waited is counted in the `PhaseTimer` `timer`, if given.
+
+    Returns the number of bytes copied.
+    """
+    num_bytes_copied = 0
+    with open(src, "rb") as file_src, open(dst, "wb") as file_dst:
+        while chunk := file_src.read(SPARSE_COPY_CHUNK_SIZE):
+            throttle_io(timer, num_ops=0, num_bytes=len(chunk))
+            file_dst.write(chunk)
+            num_bytes_copied += len(chunk)
+
+    return num_bytes_copied
+
+
+def copy_file_and_count(src, dst, progress_reporter, timer, copy_counts=None):
+    """
+    Same as `shutil.copy2()`, but also count the files and bytes copied in the `PhaseTimer`
+    `timer`, and report the progress.
+
+    Sparse files are copied with `copy_sparse_file()`, so only their data is copied, and their
+    holes stay holes. The bytes of data actually copied, and the apparent size of the files, are
+    added to `copy_counts`, a `collections.Counter`, if given, as "bytes_copied" and
+    "bytes_apparent", and the number of sparse files as "sparse_files".
+
+    The copy is limited by `io_throttle`, which, if it limits the bytes per second, makes the data
+    get copied in chunks.
+    """
+    throttle_io(timer)
+    stat_result = os.stat(src)
+    num_bytes = None
+    if hasattr(os, "SEEK_DATA") and is_sparse(stat_result):
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        try:
+            num_bytes = copy_sparse_file(src, dst, timer)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+        else:
+            shutil.copystat(src, dst)
+            timer.count("sparse_files_copied")
+            if copy_counts is not None:
+                copy_counts["sparse_files"] += 1
+
+    if num_bytes is None and io_throttle.bytes_bucket is not None:
+        if os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        num_bytes = copy_file_in_chunks(src, dst, timer)
+        shutil.copystat(src, dst)
+    elif num_bytes is None:
+        dst = shutil.copy2(src, dst)
+        num_bytes = stat_result.st_size
+
+    timer.count("files_copied")
+    timer.count("bytes_copied", num_bytes)
+    timer.count("bytes_apparent", stat_result.st_size)
+    if copy_counts is not None:
+        copy_counts["bytes_copied"] += num_bytes
+        copy_counts["bytes_apparent"] += stat_result.st_size
+    progress_reporter.update(num_bytes=num_bytes)
+    return dst
+
+
+# How to copy a file or dir which is reached more than once, through symlinks, when
+# '--keep_symlinks' is NOT used. See `copy_directory()`.
+DUPLICATES_MODES_LIST = ["copy", "stub", "hardlink"]
+
+
+def get_file_id(path, timer):
+    """
+    Get the `(st_dev, st_ino)` of the file or dir at `path`, following symlinks, which is the same
+    for all paths to it, through symlinks or hardlinks. The stat call is counted in the
+    `PhaseTimer` `timer`.
+    """
+    stat_result = os.stat(path)
+    timer.count("stat_calls")
+    return (stat_result.st_dev, stat_result.st_ino)
+
+
+def copy_directory(src, dst, args, only_names_set=None, timer=None):
+    """
+    Copy the `src` dir to `dst`, which must not exist yet. If `only_names_set` is given, copy only
+    the top-level entries of `src` with these names. The files and dirs excluded by
+    `args.path_filter`, a `filters.PathFilter`, if any, are skipped, without listing the excluded
+    dirs at all. The operations are counted in the `PhaseTimer` `timer`, if given.
+
+    Unless `args.keep_symlinks` is True, symlinks are copied as the files or dirs they point to.
+    Each file or dir reached more than once, through symlinks (or hardlinks, for files), is copied
+    only the first time, depending on `args.duplicates` (see `DUPLICATES_MODES_LIST`):
+    - "copy" (default): copy every repeat in full.
+    - "stub": each repeat of a file is made a hardlink to its first copy, and each repeat of a dir,
+      including a symlink to a dir above it, is replaced with a plain text stub file saying where
+      its contents were copied from.
+    - "hardlink": same, but each repeat of a dir is re-created, with all of its files hardlinked to
+      their first copies.
+    """
     src_path = Path(src)
     dst_path = Path(dst)
 
     original_src = src
     original_dst = dst
 
+    if timer is None:
+        timer = PhaseTimer()
+
     if not src_path.exists():
-        colors.print_red(f"Error: Source directory \"{src}\" does not exist. Exiting.")
-        exit(EXIT_FAILURE)
+        raise PathShortenerError(f"Source directory \"{src}\" does not exist.")
 
     if dst_path.exists():
-        colors.print_red(f"Error: Destination directory \"{dst}\" already exists.\n"
-                       + f"You may need to manually remove that directory. Exiting.")
-        exit(EXIT_FAILURE)
+        raise PathShortenerError(f"Destination directory \"{dst}\" already exists.\n"
+                                 + f"You may need to manually remove that directory.")
 
     # symlinks which have a missing or broken target path they point to
     broken_symlinks_list_of_tuples = []
 
+    duplicates_mode = getattr(args, "duplicates", "copy")
+    path_filter = getattr(args, "path_filter", None)
+    if args.keep_symlinks:
+        duplicates_mode = "copy"
+
+    # `(st_dev, st_ino)` of each file copied --> the path of its first copy
+    copied_files_dict = {}
+    # `(st_dev, st_ino)` of each dir copied --> the source path it was first copied from
+    copied_dirs_dict = {}
+    # (src, dst, first src) tuples, for each symlink to a dir which was already copied, to replace
+    # with a stub file
+    dir_stubs_list_of_tuples = []
+    num_files_hardlinked = 0
+    # "bytes_copied", "bytes_apparent", and "sparse_files". See `copy_file_and_count()`.
+    copy_counts = collections.Counter()
+
+    # The total is only an estimate, since symlinks to dirs get copied as whole dirs
+    progress_reporter = progress.ProgressReporter(
+        "copy", total_entries=getattr(args, "source_path_count", None), enabled=args.progress)
+
+    def count_dir(dir_path, names_list):
+        """
+        Called by `shutil.copytree()` once per directory, to decide what to ignore in it. This is
+        used to count the directories copied, to ignore the top-level entries not in
+        `only_names_set`, and to ignore the entries excluded by `path_filter`.
+        """
+        progress_reporter.update()
+        throttle_io(timer)  # for creating the dir
+        names_to_ignore_set = set()
+        if only_names_set is not None and dir_path == os.fspath(src_path):
+            names_to_ignore_set = set(names_list) - only_names_set
+
+        if path_filter:
+            relative_dir = dir_path[len(os.fspath(src_path)) + 1:]
+            for name in names_list:
+                if path_filter.is_path_excluded(os.path.join(dir_path, name),
+                                                os.path.join(relative_dir, name)):
+                    names_to_ignore_set.add(name)
+
+        if duplicates_mode != "stub":
+            return names_to_ignore_set
+
+        copied_dirs_dict.setdefault(get_file_id(dir_path, timer), dir_path)
+
+        # Register the real dirs first, so that a symlink to a sibling dir becomes the stub,
+        # rather than the dir itself
+        symlinked_dirs_list = []
+        for name in names_list:
+            path = os.path.join(dir_path, name)
+            if name in names_to_ignore_set or not os.path.isdir(path):
+                continue
+            if os.path.islink(path):
+                symlinked_dirs_list.append((name, path))
+            else:
+                copied_dirs_dict.setdefault(get_file_id(path, timer), path)
+
+        for name, path in symlinked_dirs_list:
+            first_src = copied_dirs_dict.setdefault(get_file_id(path, timer), path)
+            if first_src != path:
+                names_to_ignore_set.add(name)
+                dir_stubs_list_of_tuples.append(
+                    (path, os.path.join(dst_path, os.path.relpath(path, src_path)), first_src))
+
+        return names_to_ignore_set
+
+    def copy_file(src, dst):
+        """
+        Copy a file for `shutil.copytree()`, or hardlink it to its first copy if it was already
+        copied.
+        """
+        nonlocal num_files_hardlinked
+
+        if duplicates_mode == "copy":
+            return copy_file_and_count(src, dst, progress_reporter, timer, copy_counts)
+
+        file_id = get_file_id(src, timer)
+        first_dst = copied_files_dict.get(file_id)
+        if first_dst is not None:
+            throttle_io(timer)
+            try:
+                os.link(first_dst, dst)
+            except OSError:
+                # Ex: the destination filesystem doesn't support hardlinks, so copy it instead
+                pass
+            else:
+                num_files_hardlinked += 1
+                timer.count("files_hardlinked")
+                progress_reporter.update()
+                return dst
+
+        dst = copy_file_and_count(src, dst, progress_reporter, timer, copy_counts)
+        copied_files_dict.setdefault(file_id, dst)
+        return dst
+
     # Do the copy! Handle broken symlinks or missing src files which somehow got deleted or moved
     # during the copy.
 
     try:
         shutil.copytree(
-            src_path, dst_path, symlinks=args.keep_symlinks, ignore_dangling_symlinks=False)
+            src_path, dst_path, symlinks=args.keep_symlinks, ignore=count_dir,
+            ignore_dangling_symlinks=False, copy_function=copy_file)
 
     # Handle errors with missing files or broken symlinks
     # - NB: `shutil.Error`'s exception argument at index 0 (`shutil.Error.args[0]`) contains
@@ -117,44 +412,31 @@ def copy_directory(src, dst, args):
 
             # Ensure that all errors are Error numbers I have seen before and know how to handle.
             match_obj = re.search(r"^\[Errno (\d+)\]", error_str)
-            errno = int(match_obj.group(1))
+            error_num = int(match_obj.group(1))
 
-            if errno == 2:
+            if error_num == 2:
                 # Check if the error is a missing file or a broken symlink, and save them
                 is_broken_symlink = False
                 if os.path.islink(src):
                     is_broken_symlink = True
                     broken_symlinks_list_of_tuples.append((src, dst, error_str))
                 else:
-                    print_red("Error: missing file. This is unexpected. I only expected "
-                            "broken symlinks. Somehow a file was moved or deleted during the copy.")
-                    colors.print_red(f"  error: {error_str}")
-                    colors.print_red(f"  src: {src}")
-                    colors.print_red(f"  dst: {dst}")
-                    exit(EXIT_FAILURE)
-
-            # TODO: run the `find` command below automatically to look for circular symlinks BEFORE
-            # the copy! And...probably handle them gracefully automatically too. <==================
+                    raise PathShortenerError(
+                        "Missing file. This is unexpected. I only expected broken symlinks. "
+                        "Somehow a file was moved or deleted during the copy.\n"
+                        f"  error: {error_str}\n"
+                        f"  src: {src}\n"
+                        f"  dst: {dst}")
+
+            # NB: `preflight_copy()` normally finds circular symlinks before the copy starts, so
+            # this only happens if it was skipped, or if a symlink changed during the copy.
             #
             # This warning (errno 40) happens when there are circular symlinks and it copies
             # circular symlinks repeatedly.
             # - TODO: figure out how to handle this one automatically instead of requiring user
             #   intervention.
-            elif errno == 40:
+            elif error_num == 40:
                 command_to_run = f"find \"{original_src}\" -follow -printf \"\""
-                colors.print_red()
-                colors.print_red(
-                    f"Error in {SCRIPT_FILENAME}: errno {errno}: circular "
-                    f"symlinks detected. This is a known issue with `shutil.copytree()`. "
-                    f"Run:"
-                )
-                colors.print_blue(f"{command_to_run}")
-                colors.print_red(f"...to find the circular symlinks. Then, **manually fix "
-                    f"them**, remove \"{original_dst}\", and try again."
-                )
-                colors.print_red("OR, use the `--keep_symlinks` flag to keep symlinks as symlinks "
-                    "instead of copying them as files or folders.")
-                colors.print_red("Exiting.")
 
                 # TODO: get our script to do this. Meanwhile, just print the find command for us to
                 # run manually.
@@ -163,15 +445,23 @@ def copy_directory(src, dst, args):
                 # colors.print_blue(result.stdout)
                 # colors.print_red(result.stderr)
 
-                exit(EXIT_FAILURE)
+                raise PathShortenerError(
+                    f"errno {error_num}: circular symlinks detected. This is a known issue with "
+                    f"`shutil.copytree()`. Run:\n"
+                    f"{command_to_run}\n"
+                    f"...to find the circular symlinks. Then, **manually fix them**, remove "
+                    f"\"{original_dst}\", and try again.\n"
+                    f"OR, use the `--keep_symlinks` flag to keep symlinks as symlinks instead of "
+                    f"copying them as files or folders.")
 
             else:
                 colors.print_yellow(f"error: {error_str}")
                 colors.print_yellow(f"src: {src}")
                 colors.print_yellow(f"dst: {dst}")
-                colors.print_red(f"Error in {SCRIPT_FILENAME}: Unexpected errno: {errno}. Exiting.")
-                exit(EXIT_FAILURE)
+                raise PathShortenerError(f"Unexpected errno: {error_num}.")
+
 
+    progress_reporter.finish()
 
     # For each broken symlink, create a file with this name at the destination location, containing
     # appropriate error messages
@@ -183,9 +473,24 @@ def copy_directory(src, dst, args):
                        f"source location: {alignment_spaces}'{src}'\n\n"
                        f"error_str: {error_str}\n")
 
+    # For each symlink to a dir which was already copied, create a stub file with its name instead
+    for stub_src, stub_dst, first_src in dir_stubs_list_of_tuples:
+        with open(stub_dst, "w") as file:
+            file.write(f"This file was auto-generated by `{SCRIPT_FILENAME}` in place of the "
+                       f"following symlink to a directory, since that directory was already "
+                       f"copied from another path:\n\n"
+                       f"source location: '{stub_src}'\n"
+                       f"symlink target:  '{os.readlink(stub_src)}'\n"
+                       f"copied from:     '{first_src}'\n")
+        timer.count("files_written")
+
     print()
     print(f"Copied \"{src}\" to \"{dst}\".")
 
+    print(f"* Copied {progress.format_bytes(copy_counts['bytes_copied'])} of data, for an "
+          f"apparent size of {progress.format_bytes(copy_counts['bytes_apparent'])}, with "
+          f"{copy_counts['sparse_files']} sparse files copied without filling in their holes.")
+
     color = colors.FGR  # green
     if len(broken_symlinks_list_of_tuples) > 0:
         color = colors.FBY  # bright yellow
@@ -198,12 +503,259 @@ def copy_directory(src, dst, args):
             f"in the new directory in place of the symlinks, with corresponding error "
             f"messages written into these autogenerated files.{colors.END}")
 
+    if num_files_hardlinked > 0 or len(dir_stubs_list_of_tuples) > 0:
+        print(f"* {num_files_hardlinked} files reached more than once were hardlinked to their "
+              f"first copy, and {len(dir_stubs_list_of_tuples)} symlinks to dirs already copied "
+              f"were replaced with stub files, instead of copying them again.")
+
     print(f"* Note: if valid symlinks were in the source directory, and '--keep_symlinks' was NOT "
           f"used, their targets were copied as real files instead of as symlinks.")
 
     return broken_symlinks_list_of_tuples
 
 
+# The max number of each kind of problem found by `preflight_copy()` to list in its error message
+MAX_PREFLIGHT_PROBLEMS_TO_LIST = 10
+
+
+class PreflightResult:
+    """
+    The result of `preflight_copy()`.
+    """
+    def __init__(self):
+        self.entry_count = 0
+        # The total size of all files which will be copied, with symlinks followed unless
+        # `--keep_symlinks` is used, not counting the holes in sparse files. A file reached
+        # through many symlinks is only counted once, unless every repeat will be copied in full
+        # (see `copy_directory()`).
+        self.byte_count = 0
+        # `(st_dev, st_ino)` --> size, of each file in one dir, to count each file only once
+        self.file_sizes_dict = {}
+        self.free_byte_count = None  # at the destination
+        # (symlink path, target path) tuples, for each symlink which points to one of the dirs
+        # which contain it, or to another symlink in a loop
+        self.symlink_cycles_list = []
+        # (path, reason) tuples, for each file or dir which cannot be read or listed
+        self.unreadable_paths_list = []
+        # These don't stop the copy: `copy_directory()` replaces them with plain text files.
+        self.broken_symlinks_list = []
+
+    def print(self):
+        print("Preflight:")
+        print(f"  entry_count: {self.entry_count}")
+        print(f"  bytes to copy: {progress.format_bytes(self.byte_count)}")
+        print(f"  free at destination: {progress.format_bytes(self.free_byte_count)}")
+        print(f"  broken_symlink_count: {len(self.broken_symlinks_list)}")
+
+    def has_problems(self):
+        return bool(self.symlink_cycles_list or self.unreadable_paths_list
+                    or self.byte_count > self.free_byte_count)
+
+    def get_problems_str(self):
+        """
+        Describe all problems found, listing up to `MAX_PREFLIGHT_PROBLEMS_TO_LIST` paths of each
+        kind.
+        """
+        lines_list = []
+
+        def add_paths(title, items_list, format_item):
+            if not items_list:
+                return
+            lines_list.append(f"{len(items_list)} {title}:")
+            for item in items_list[:MAX_PREFLIGHT_PROBLEMS_TO_LIST]:
+                lines_list.append(f"  {format_item(item)}")
+            if len(items_list) > MAX_PREFLIGHT_PROBLEMS_TO_LIST:
+                lines_list.append(
+                    f"  ...and {len(items_list) - MAX_PREFLIGHT_PROBLEMS_TO_LIST} more.")
+
+        add_paths("circular symlinks found", self.symlink_cycles_list,
+                  lambda item: f"\"{item[0]}\" -> \"{item[1]}\"")
+        add_paths("unreadable files or dirs found", self.unreadable_paths_list,
+                  lambda item: f"\"{item[0]}\": {item[1]}")
+        if self.byte_count > self.free_byte_count:
+            lines_list.append(
+                f"Not enough free space at the destination: the copy needs "
+                f"{progress.format_bytes(self.byte_count)}, but only "
+                f"{progress.format_bytes(self.free_byte_count)} is free.")
+
+        return "\n".join(lines_list)
+
+    def to_dict(self):
+        return {
+            "entry_count": self.entry_count,
+            "byte_count": self.byte_count,
+            "free_byte_count": self.free_byte_count,
+            "symlink_cycles": [list(item) for item in self.symlink_cycles_list],
+            "unreadable_paths": [list(item) for item in self.unreadable_paths_list],
+            "broken_symlinks": self.broken_symlinks_list,
+        }
+
+
+def preflight_scan_directory(dir_path, ancestors_set, keep_symlinks, duplicates_mode,
+                             only_names_set=None, path_filter=None, prefix_len=0):
+    """
+    List a single directory for `preflight_copy()`, the same way `shutil.copytree()` will see it
+    when copying: following symlinks unless `keep_symlinks` is True.
+
+    ancestors_set: the `(st_dev, st_ino)` of `dir_path` and of every dir it was reached through,
+    including through symlinks. A symlink to any of them would make the copy recurse forever,
+    unless `duplicates_mode` is "stub", in which case it is copied as a stub file instead.
+
+    The entries excluded by `path_filter` are skipped, the same as in `scan_directory()`.
+
+    Returns a `(preflight_result, subdirs_list)` tuple, where `preflight_result` is a
+    `PreflightResult` for this directory only, without the free space, and `subdirs_list` is a list
+    of `(subdir_path, ancestors_set)` tuples for the dirs to scan next.
+    """
+    preflight_result = PreflightResult()
+    subdirs_list = []
+
+    try:
+        with os.scandir(dir_path) as entries_iterator:
+            entries_list = list(entries_iterator)
+    except OSError as e:
+        preflight_result.unreadable_paths_list.append((dir_path, e.strerror))
+        return preflight_result, subdirs_list
+
+    for entry in entries_list:
+        if only_names_set is not None and entry.name not in only_names_set:
+            continue
+
+        if path_filter and path_filter.is_path_excluded(entry.path, entry.path[prefix_len:]):
+            continue
+
+        preflight_result.entry_count += 1
+
+        try:
+            is_symlink = entry.is_symlink()
+            if is_symlink and keep_symlinks:
+                # Copied as a symlink, so nothing to follow or read
+                continue
+
+            stat_result = os.stat(entry.path)  # follows symlinks
+        except OSError as e:
+            if e.errno == errno.ENOENT and entry.is_symlink():
+                preflight_result.broken_symlinks_list.append(entry.path)
+            elif e.errno == errno.ELOOP:
+                preflight_result.symlink_cycles_list.append(
+                    (entry.path, os.readlink(entry.path)))
+            else:
+                preflight_result.unreadable_paths_list.append((entry.path, e.strerror))
+            continue
+
+        if stat.S_ISDIR(stat_result.st_mode):
+            dir_key = (stat_result.st_dev, stat_result.st_ino)
+            if dir_key in ancestors_set:
+                if duplicates_mode != "stub":
+                    preflight_result.symlink_cycles_list.append(
+                        (entry.path, os.path.realpath(entry.path)))
+            elif not os.access(entry.path, os.R_OK | os.X_OK):
+                preflight_result.unreadable_paths_list.append(
+                    (entry.path, "cannot list the directory"))
+            else:
+                subdirs_list.append((entry.path, ancestors_set | {dir_key}))
+        else:
+            # Sparse files are copied without filling in their holes
+            num_bytes = get_allocated_bytes(stat_result)
+            if duplicates_mode == "copy":
+                preflight_result.byte_count += num_bytes
+            else:
+                preflight_result.file_sizes_dict[(stat_result.st_dev, stat_result.st_ino)] = (
+                    num_bytes)
+            if not os.access(entry.path, os.R_OK):
+                preflight_result.unreadable_paths_list.append((entry.path, "cannot read the file"))
+
+    return preflight_result, subdirs_list
+
+
+def preflight_copy(src, dst, keep_symlinks, num_threads=8, only_names_set=None,
+                   duplicates_mode="copy", path_filter=None, timer=None):
+    """
+    Before `copy_directory()` copies `src` to `dst`, walk `src` the same way the copy will, listing
+    up to `num_threads` directories at once, to find, in seconds rather than after a long copy:
+    1. Circular symlinks, which would make the copy recurse until it fails with errno 40. Each dir
+       is identified by its `(st_dev, st_ino)`, so a symlink to any dir above it is caught no
+       matter which path it uses.
+    1. Files and dirs which can't be read or listed.
+    1. Whether the files to copy fit in the free space at the destination.
+
+    Broken symlinks are only counted, since the copy replaces them with plain text files.
+
+    `duplicates_mode` is how `copy_directory()` will copy files and dirs reached more than once.
+    See `DUPLICATES_MODES_LIST`. The files and dirs excluded by `path_filter`, a
+    `filters.PathFilter`, are skipped, the same as the copy skips them.
+
+    If `only_names_set` is given, only check the top-level entries of `src` with these names, the
+    same as `copy_directory()`. The dirs listed are counted in the `PhaseTimer` `timer`, if given.
+
+    Returns a `PreflightResult`. Raises a `PathShortenerError` if any problems were found.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+
+    if not os.path.isdir(src):
+        raise PathShortenerError(f"Source directory \"{src}\" does not exist.")
+
+    if os.path.exists(dst):
+        raise PathShortenerError(f"Destination directory \"{dst}\" already exists.\n"
+                                 + f"You may need to manually remove that directory.")
+
+    if keep_symlinks:
+        duplicates_mode = "copy"
+
+    preflight_result = PreflightResult()
+    counted_file_ids_set = set()
+    prefix_len = len(os.path.join(src, ""))  # includes the trailing separator
+    stat_result = os.stat(src)
+    ancestors_set = frozenset({(stat_result.st_dev, stat_result.st_ino)})
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(num_threads, 1)) as executor:
+        # The work queue of directories currently being listed
+        futures_set = {executor.submit(preflight_scan_directory, src, ancestors_set,
+                                       keep_symlinks, duplicates_mode, only_names_set,
+                                       path_filter, prefix_len)}
+
+        while futures_set:
+            done_futures, futures_set = concurrent.futures.wait(
+                futures_set, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done_futures:
+                dir_result, subdirs_list = future.result()
+                timer.count("dirs_listed")
+                timer.count("stat_calls", dir_result.entry_count)
+
+                preflight_result.entry_count += dir_result.entry_count
+                preflight_result.byte_count += dir_result.byte_count
+                for file_id, num_bytes in dir_result.file_sizes_dict.items():
+                    if file_id not in counted_file_ids_set:
+                        counted_file_ids_set.add(file_id)
+                        preflight_result.byte_count += num_bytes
+                preflight_result.symlink_cycles_list.extend(dir_result.symlink_cycles_list)
+                preflight_result.unreadable_paths_list.extend(dir_result.unreadable_paths_list)
+                preflight_result.broken_symlinks_list.extend(dir_result.broken_symlinks_list)
+
+                for subdir_path, subdir_ancestors_set in subdirs_list:
+                    futures_set.add(executor.submit(preflight_scan_directory, subdir_path,
+                                                    subdir_ancestors_set, keep_symlinks,
+                                                    duplicates_mode, None, path_filter,
+                                                    prefix_len))
+
+    # `dst` doesn't exist yet, so check the free space of the dir it will be created in
+    preflight_result.free_byte_count = shutil.disk_usage(
+        os.path.dirname(os.path.abspath(dst))).free
+
+    if preflight_result.has_problems():
+        problems_str = preflight_result.get_problems_str()
+        if preflight_result.symlink_cycles_list:
+            problems_str += ("\nFix the circular symlinks, or use the `--keep_symlinks` flag to "
+                             "keep symlinks as symlinks instead of copying them as files or "
+                             "folders.")
+        raise PathShortenerError("Preflight check failed, so nothing was copied.\n"
+                                 + problems_str)
+
+    return preflight_result
+
+
 # class AnyStruct:
 #     """
 #     A class to store any data structure.
@@ -225,6 +777,218 @@ def copy_directory(src, dst, args):
 #         self.shortened_path = None
 
 
+# The number of largest allocation sites to report at the end of each phase, with `--mem_report`
+NUM_TOP_ALLOCATION_SITES = 5
+
+
+def get_rss_bytes():
+    """
+    Return the current resident set size (RSS) of this process, in bytes, or None if it can't be
+    read (no `/proc` filesystem).
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            num_pages = int(file.read().split()[1])
+    except OSError:
+        return None
+
+    return num_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_max_rss_bytes(who=resource.RUSAGE_SELF):
+    """
+    Return the max RSS so far, in bytes, of this process (`resource.RUSAGE_SELF`), or of its
+    largest finished child process (`resource.RUSAGE_CHILDREN`).
+    """
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux reports this in KiB, but macOS in bytes
+    if sys.platform != "darwin":
+        max_rss *= 1024
+    return max_rss
+
+
+class MemStats:
+    """
+    The memory usage of this process at the end of one phase of a run, plus the largest Python
+    allocation sites still alive at that point, as traced by `tracemalloc`.
+    """
+    def __init__(self):
+        self.rss_bytes = get_rss_bytes()
+        # Max RSS over the whole run so far, not just this phase, as the kernel can't reset it
+        self.max_rss_bytes = get_max_rss_bytes()
+        # Max RSS of the largest finished child process, such as the workers used by `--jobs`
+        self.max_child_rss_bytes = get_max_rss_bytes(resource.RUSAGE_CHILDREN)
+        self.traced_bytes, self.traced_peak_bytes = tracemalloc.get_traced_memory()
+
+        # A list of (site, size_bytes, count) tuples, largest first, where `site` is
+        # "filename:lineno"
+        self.top_allocations_list = []
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ])
+        for statistic in snapshot.statistics("lineno")[:NUM_TOP_ALLOCATION_SITES]:
+            frame = statistic.traceback[0]
+            self.top_allocations_list.append(
+                (f"{frame.filename}:{frame.lineno}", statistic.size, statistic.count))
+
+    def to_dict(self):
+        return {
+            "rss_bytes": self.rss_bytes,
+            "max_rss_bytes": self.max_rss_bytes,
+            "max_child_rss_bytes": self.max_child_rss_bytes,
+            "traced_bytes": self.traced_bytes,
+            "traced_peak_bytes": self.traced_peak_bytes,
+            "top_allocations": [
+                {"site": site, "size_bytes": size_bytes, "count": count}
+                for site, size_bytes, count in self.top_allocations_list
+            ],
+        }
+
+
+class PhaseStats:
+    """
+    The wall time, CPU time, and counts of syscall-heavy operations of one phase of a run.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.wall_time_sec = 0.0
+        # User + system CPU time, including that of finished child processes, such as the workers
+        # used by `--jobs`.
+        self.cpu_time_sec = 0.0
+        self.op_counts_dict = {}  # operation name --> count
+        # A `MemStats` object, with `--mem_report` only
+        self.mem_stats = None
+
+    def to_dict(self):
+        phase_dict = {
+            "name": self.name,
+            "wall_time_sec": self.wall_time_sec,
+            "cpu_time_sec": self.cpu_time_sec,
+            "op_counts": self.op_counts_dict,
+        }
+        if self.mem_stats is not None:
+            phase_dict["memory"] = self.mem_stats.to_dict()
+
+        return phase_dict
+
+
+# How many renames to make between each "rename_batch" event. See `PhaseTimer`.
+RENAME_EVENT_BATCH_SIZE = 1000
+
+
+class PhaseTimer:
+    """
+    Time each phase of a run, and count the syscall-heavy operations (dirs listed, stat calls,
+    files copied, renames, files written, etc.) done in each phase.
+
+    Hooks added with `add_hook()` are called with an event dict at the start and end of each
+    phase, and for each batch of `RENAME_EVENT_BATCH_SIZE` renames, so that external collectors can
+    observe a run as it goes. Each event dict has an "event" key, of "phase_start", "phase_end", or
+    "rename_batch", a "phase" key, and a "time" key, of the Unix time it was sent at. Phase end
+    events also have the "wall_time_sec", "cpu_time_sec", and "op_counts" of the phase, and rename
+    batch events have the "renames_done" and "renames_total" so far.
+
+    Each run, or `--serve` or batch job, has its own timer, which it passes down to everything it
+    calls, so that jobs running at once don't mix up their counts, or send each other's events.
+
+    Ex:
+    ```py
+    phase_timer = PhaseTimer()
+    phase_timer.add_hook(lambda event_dict: print(event_dict))
+    with phase_timer.phase("copy"):
+        ...
+        phase_timer.count("files_copied")
+    ```
+    """
+    def __init__(self):
+        self.phase_stats_list = []
+        self.op_counts = collections.Counter()  # running totals, by operation name
+        self.hooks_list = []
+        self.time_start = time.time()
+
+    def count(self, op_name, num=1):
+        self.op_counts[op_name] += num
+
+    def add_hook(self, hook):
+        self.hooks_list.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks_list.remove(hook)
+
+    def send_event(self, event_name, phase_name, **items_dict):
+        """
+        Call each hook with an event dict. A hook which raises is removed, with a warning, so that
+        a broken collector doesn't stop the run.
+        """
+        if not self.hooks_list:
+            return
+
+        event_dict = {"event": event_name, "phase": phase_name, "time": time.time(),
+                      **items_dict}
+        for hook in list(self.hooks_list):
+            try:
+                hook(event_dict)
+            except Exception as e:
+                colors.print_yellow(f"WARNING: removing the event hook {hook!r}, since it "
+                                    f"raised: {e!r}")
+                self.hooks_list.remove(hook)
+
+    @staticmethod
+    def start_mem_report():
+        """
+        Start tracing Python memory allocations, so that each phase from now on also records its
+        memory usage in a `MemStats` object. This slows the run down quite a bit.
+        """
+        tracemalloc.start()
+
+    @staticmethod
+    def get_cpu_time():
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase_stats = PhaseStats(name)
+        op_counts_start = self.op_counts.copy()
+        wall_time_start = time.perf_counter()
+        cpu_time_start = self.get_cpu_time()
+        if tracemalloc.is_tracing():
+            # So that the traced peak is that of this phase only
+            tracemalloc.reset_peak()
+        self.send_event("phase_start", name)
+
+        try:
+            yield phase_stats
+        finally:
+            phase_stats.wall_time_sec = time.perf_counter() - wall_time_start
+            phase_stats.cpu_time_sec = self.get_cpu_time() - cpu_time_start
+            phase_stats.op_counts_dict = dict(self.op_counts - op_counts_start)
+            if tracemalloc.is_tracing():
+                phase_stats.mem_stats = MemStats()
+            self.phase_stats_list.append(phase_stats)
+            self.send_event("phase_end", name, wall_time_sec=phase_stats.wall_time_sec,
+                            cpu_time_sec=phase_stats.cpu_time_sec,
+                            op_counts=phase_stats.op_counts_dict)
+
+
+# The limits on the bytes and file system operations per second of the copy, rename, and namefile
+# workers, shared by all of them. See `throttle_io()`. Default: no limits.
+io_throttle = throttle.IoThrottle()
+
+
+def throttle_io(timer, num_ops=1, num_bytes=0):
+    """
+    Wait until `io_throttle` allows `num_ops` more file system operations, moving `num_bytes` bytes
+    of data, and count the time waited in the `PhaseTimer` `timer`, if given.
+    """
+    if io_throttle:
+        wait_ms = round(io_throttle.wait(num_ops, num_bytes)*1000)
+        if timer is not None:
+            timer.count("throttle_wait_ms", wait_ms)
+
+
 class PathStats:
     def __init__(self):
         self.max_allowed_path_len = None
@@ -234,6 +998,9 @@ class PathStats:
         self.symlink_path_count = None
         self.illegal_windows_char_path_count = None
         self.paths_to_fix_count = None
+        # A list of `PhaseStats` objects for the whole run, if this is the main stats object of the
+        # run.
+        self.phase_stats_list = None
 
     def print(self):
         print("Path stats:")
@@ -245,6 +1012,98 @@ class PathStats:
         print(f"  illegal_windows_char_path_count: {self.illegal_windows_char_path_count}")
         print(f"  paths_to_fix_count: {self.paths_to_fix_count}")
 
+    def print_phase_stats(self):
+        print("Phase stats:")
+        print(f"  {'phase':16} {'wall (s)':>10} {'cpu (s)':>10}  operations")
+
+        wall_time_total_sec = 0.0
+        cpu_time_total_sec = 0.0
+        for phase_stats in self.phase_stats_list:
+            op_counts_str = ", ".join(
+                f"{op_name}: {count}" for op_name, count in phase_stats.op_counts_dict.items())
+            print(f"  {phase_stats.name:16} {phase_stats.wall_time_sec:10.3f} "
+                  f"{phase_stats.cpu_time_sec:10.3f}  {op_counts_str}")
+            wall_time_total_sec += phase_stats.wall_time_sec
+            cpu_time_total_sec += phase_stats.cpu_time_sec
+
+        print(f"  {'total':16} {wall_time_total_sec:10.3f} {cpu_time_total_sec:10.3f}")
+
+    def print_mem_stats(self):
+        """
+        Print the memory usage at the end of each phase, and the largest allocation sites still
+        alive then. Only phases run with `--mem_report` have memory stats.
+        """
+        phase_stats_list = [phase_stats for phase_stats in self.phase_stats_list
+                            if phase_stats.mem_stats is not None]
+        if not phase_stats_list:
+            return
+
+        def format_bytes(num_bytes):
+            return "n/a" if num_bytes is None else progress.format_bytes(num_bytes)
+
+        print("Memory stats (at the end of each phase; max RSS is over the whole run so far):")
+        print(f"  {'phase':16} {'rss':>11} {'max rss':>11} {'max child':>11} {'traced':>11} "
+              f"{'traced peak':>11}")
+        for phase_stats in phase_stats_list:
+            mem_stats = phase_stats.mem_stats
+            print(f"  {phase_stats.name:16} {format_bytes(mem_stats.rss_bytes):>11} "
+                  f"{format_bytes(mem_stats.max_rss_bytes):>11} "
+                  f"{format_bytes(mem_stats.max_child_rss_bytes):>11} "
+                  f"{format_bytes(mem_stats.traced_bytes):>11} "
+                  f"{format_bytes(mem_stats.traced_peak_bytes):>11}")
+
+        print("Largest allocation sites still alive at the end of each phase:")
+        for phase_stats in phase_stats_list:
+            print(f"  {phase_stats.name}:")
+            for site, size_bytes, count in phase_stats.mem_stats.top_allocations_list:
+                print(f"    {format_bytes(size_bytes):>11} in {count:8} blocks  {site}")
+
+    def to_dict(self):
+        stats_dict = {
+            "max_allowed_path_len": self.max_allowed_path_len,
+            "max_len": self.max_len,
+            "total_path_count": self.total_path_count,
+            "too_long_path_count": self.too_long_path_count,
+            "symlink_path_count": self.symlink_path_count,
+            "illegal_windows_char_path_count": self.illegal_windows_char_path_count,
+            "paths_to_fix_count": self.paths_to_fix_count,
+        }
+        if self.phase_stats_list is not None:
+            stats_dict["phases"] = [phase_stats.to_dict() for phase_stats in self.phase_stats_list]
+
+        return stats_dict
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        """
+        The inverse of `to_dict()`, except for the phase stats, which are left out.
+        """
+        path_stats = cls()
+        for name, value in stats_dict.items():
+            if name != "phases":
+                setattr(path_stats, name, value)
+
+        return path_stats
+
+    @classmethod
+    def combine(cls, path_stats_list):
+        """
+        Combine the stats of many dirs into one: the counts are summed, and the lengths are the max
+        over all dirs.
+        """
+        combined_path_stats = cls()
+        combined_path_stats.max_allowed_path_len = max(
+            (path_stats.max_allowed_path_len for path_stats in path_stats_list), default=None)
+        combined_path_stats.max_len = max(
+            (path_stats.max_len for path_stats in path_stats_list), default=None)
+
+        for name in ["total_path_count", "too_long_path_count", "symlink_path_count",
+                     "illegal_windows_char_path_count", "paths_to_fix_count"]:
+            setattr(combined_path_stats, name,
+                    sum(getattr(path_stats, name) for path_stats in path_stats_list))
+
+        return combined_path_stats
+
 
 def print_global_variables(module):
     """
@@ -299,17 +1158,32 @@ def print_global_variables(module):
 #     sorted_dict[key].append(value)
 
 
-def walk_directory(path):
+def walk_directory(path, path_filter=None, timer=None):
     """
     Walk a directory and return all unique paths in a Python set (hash set).
+
+    If `path_filter`, a `filters.PathFilter`, is given, the files and dirs it excludes are skipped,
+    and the excluded dirs are never listed. The dirs listed are counted in the `PhaseTimer`
+    `timer`, if given.
     """
+    if timer is None:
+        timer = PhaseTimer()
 
     all_paths_set = set()
+    prefix_len = len(os.path.join(path, ""))  # includes the trailing separator
 
     for root_dir, subdirs, files in os.walk(path):
         # print(f"Root dir: {root_dir}\t(Len: {len(root_dir)})")
+        timer.count("dirs_listed")
         all_paths_set.add(root_dir)
 
+        if path_filter:
+            # Prune the excluded dirs in place, so that `os.walk()` doesn't walk into them
+            subdirs[:] = [dirname for dirname in subdirs if not path_filter.is_excluded(
+                os.path.join(root_dir, dirname)[prefix_len:], is_dir=True)]
+            files = [filename for filename in files if not path_filter.is_excluded(
+                os.path.join(root_dir, filename)[prefix_len:], is_dir=False)]
+
         for dirname in subdirs:
             subdir_path = os.path.join(root_dir, dirname)
             # print(f"  Subdir: {subdir_path}\t(Len: {len(subdir_path)})")
@@ -323,6 +1197,151 @@ def walk_directory(path):
     return all_paths_set
 
 
+def scan_directory(dir_path, path_filter=None, prefix_len=0):
+    """
+    List a single directory, the same way `os.walk()` does (ie: without following symlinks to
+    directories).
+
+    Returns a `(entries_list, subdirs_list)` tuple, where `entries_list` contains the paths of all
+    files, dirs, and symlinks inside `dir_path`, and `subdirs_list` contains only the paths of the
+    real (non-symlink) directories in it to scan next. If `dir_path` cannot be listed,
+    `entries_list` is None, just like `os.walk()` skips directories it cannot list.
+
+    If `path_filter`, a `filters.PathFilter`, is given, the entries it excludes are left out. Their
+    paths, with the first `prefix_len` chars removed, are relative to the top dir being walked. A
+    symlink to a dir is checked as a dir, the same as `os.walk()` lists it with the dirs, even
+    though it isn't scanned.
+    """
+    entries_list = []
+    subdirs_list = []
+
+    try:
+        with os.scandir(dir_path) as entries_iterator:
+            for entry in entries_iterator:
+                try:
+                    is_dir = entry.is_dir()  # follows symlinks
+                    is_real_dir = is_dir and not entry.is_symlink()
+                except OSError:
+                    is_dir = is_real_dir = False
+
+                if path_filter and path_filter.is_excluded(entry.path[prefix_len:], is_dir):
+                    continue
+
+                entries_list.append(entry.path)
+                if is_real_dir:
+                    subdirs_list.append(entry.path)
+
+    except OSError:
+        return None, []
+
+    return entries_list, subdirs_list
+
+
+def walk_directory_concurrently(path, num_threads, path_filter=None, timer=None):
+    """
+    Same as `walk_directory()`, but list up to `num_threads` directories at once.
+
+    Each directory listing on a high-latency network mount (SMB, NFS, etc.) waits for a full
+    network round trip, so listing many directories at once instead of one at a time can make the
+    walk many times faster there.
+    """
+    if num_threads <= 1:
+        return walk_directory(path, path_filter, timer)
+    if timer is None:
+        timer = PhaseTimer()
+
+    all_paths_set = set()
+    prefix_len = len(os.path.join(path, ""))  # includes the trailing separator
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        # The work queue of directories currently being listed
+        futures_dict = {executor.submit(scan_directory, path, path_filter, prefix_len): path}
+
+        while futures_dict:
+            done_futures, _ = concurrent.futures.wait(
+                futures_dict, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            for future in done_futures:
+                dir_path = futures_dict.pop(future)
+                entries_list, subdirs_list = future.result()
+                if entries_list is None:
+                    continue
+
+                timer.count("dirs_listed")
+                all_paths_set.add(dir_path)
+                all_paths_set.update(entries_list)
+
+                for subdir_path in subdirs_list:
+                    futures_dict[executor.submit(
+                        scan_directory, subdir_path, path_filter, prefix_len)] = subdir_path
+
+    return all_paths_set
+
+
+def read_paths_from_list(file, dir_path, path_filter=None, timer=None):
+    """
+    Read the paths in `dir_path`, and their types, from a path list in the binary `file`, instead
+    of walking `dir_path`. See 'path_list.py'. The files and dirs which `path_filter` excludes are
+    left out, along with everything under the excluded dirs, same as when walking. Since the list
+    doesn't say what a symlink points to, a symlink is checked on disk, if the filter needs to
+    know whether it is a dir.
+
+    Returns a dict of path --> entry type ("d", "f", or "l"), whose keys are the same paths that
+    `walk_directory()` returns, including `dir_path` itself. The paths read are counted in the
+    `PhaseTimer` `timer`, if given.
+    """
+    types_dict = {dir_path: "d"}
+    # relative path of each dir checked --> whether it, or a dir above it, is excluded
+    dirs_excluded_dict = {"": False}
+
+    def is_dir_excluded(relative_dir):
+        excluded = dirs_excluded_dict.get(relative_dir)
+        if excluded is None:
+            excluded = (is_dir_excluded(os.path.dirname(relative_dir))
+                        or path_filter.is_excluded(relative_dir, is_dir=True))
+            dirs_excluded_dict[relative_dir] = excluded
+        return excluded
+
+    try:
+        for relative_path, entry_type in path_list.read_path_list(file):
+            path = os.path.join(dir_path, relative_path)
+            if path_filter:
+                if is_dir_excluded(os.path.dirname(relative_path)):
+                    continue
+                if entry_type == "l":
+                    if path_filter.is_path_excluded(path, relative_path):
+                        continue
+                elif path_filter.is_excluded(relative_path, entry_type == "d"):
+                    continue
+            types_dict[path] = entry_type
+    except ValueError as e:
+        raise PathShortenerError(f"Invalid path list: {e}") from e
+
+    if timer is not None:
+        timer.count("paths_read", len(types_dict) - 1)
+    return types_dict
+
+
+def get_paths_after_renames(all_paths_set, dir_renames_list):
+    """
+    Get the paths in `all_paths_set` as they are after making the renames from
+    `get_dir_renames()`, without walking the dir again.
+
+    Returns a set of paths.
+    """
+    # original path parts of each renamed file or dir --> its new name
+    names_new_dict = {(*parent_parts, name_old): name_new
+                      for parent_parts, name_old, name_new in dir_renames_list}
+
+    all_paths_set2 = set()
+    for path in all_paths_set:
+        parts = Path(path).parts
+        all_paths_set2.add(str(Path(*(names_new_dict.get(parts[:i + 1], name)
+                                      for i, name in enumerate(parts)))))
+
+    return all_paths_set2
+
+
 # def install():
 #     """
 #     Install this script into ~/bin for the user.
@@ -362,21 +1381,149 @@ def parse_args():
         """)
     )
 
-    parser.add_argument("dir", type=str, nargs='?', help="Path to directory to operate on")
+    parser.add_argument("dirs", metavar="dir", type=str, nargs='*', help="Path to directory to "
+        "operate on. Pass more than one to fix them all in one run, as a batch.")
+    parser.add_argument("--dirs_from", metavar="FILE", help="Also fix all dirs listed in FILE, "
+        "one per line, or in stdin if FILE is '-'. Blank lines and lines beginning with '#' are "
+        "skipped.")
+    parser.add_argument("--roots_in_flight", type=int, default=4, help="When fixing more than "
+        "one dir: the number of dirs to fix at once. All of them share one pool of '--jobs' "
+        "planning processes. Default: 4.")
     # `action="store_true"` means that if the flag is present, the value will be set to `True`.
     # Otherwise, it will be `False`.
     # parser.add_argument("-F", action="store_true", help="Force the run to NOT be a dry run")
     # parser.add_argument("-I", '--install', action="store_true",
     #                     help="Install this program into ~/bin for you.")
     parser.add_argument("-m", "--meld", action="store_true", help="Use 'meld' to compare "
-                        "the original paths with the new paths when done. Requires meld "
-                        "to be installed.")
+                        "the original names with the new names of the renamed files and dirs, "
+                        "grouped by dir, when done. Requires meld to be installed.")
     parser.add_argument("-k", "--keep_symlinks", action="store_true", help="Keep all symlinks as "
         "symlinks rather than copying them as files or folders. This can help if you have "
         "circular symlink issues. **TODO:** rather than keeping symlinks as symlinks, find "
         "a better way to handle circularly-linked symlinks to folders. NB: this option is "
         "also generally recommended when fixing git repositories, as the intent is generally to "
         "keep symlinks as symlinks in the repo.")
+    parser.add_argument("--exclude", metavar="PATTERN", action="append", default=[], help="Skip "
+        "the files and dirs matching this glob pattern, such as '.git' or 'node_modules', "
+        "entirely: they are not copied, walked, or fixed. A pattern with a '/' in it matches the "
+        "path relative to 'dir', and one ending in '/' matches dirs only. May be given many "
+        "times.")
+    parser.add_argument("--include", metavar="PATTERN", action="append", default=[], help="Only "
+        "copy and fix the files matching this glob pattern, such as '*.pdf'. All dirs which aren't "
+        "excluded are still walked. May be given many times.")
+    parser.add_argument("--exclude_from", metavar="FILE", help="Also read '--exclude' patterns "
+        "from FILE, one per line, like a '.gitignore' file. Blank lines and lines beginning with "
+        "'#' are skipped, and lines beginning with '!' are '--include' patterns.")
+    parser.add_argument("--in_place", action="store_true", help="Fix the paths in 'dir' itself, "
+        "instead of in a copy of it. Since nothing is copied, symlinks are kept as symlinks. An "
+        "undo journal is written into the '.eRCaGuy_PathShortener' dir inside 'dir' first, so "
+        "that the renames and namefiles can be undone with '--undo'.")
+    parser.add_argument("--undo", action="store_true", help="Undo the last '--in_place' run on "
+        "'dir' which was not undone yet: delete the namefiles it wrote, and rename everything back "
+        "to its original name. Run it again to undo the run before that.")
+    parser.add_argument("--duplicates", choices=DUPLICATES_MODES_LIST, default="copy", help="When "
+        "'--keep_symlinks' is NOT used: how to copy a file or dir reached more than once, through "
+        "symlinks. 'copy': copy every repeat in full. 'stub': hardlink each repeat of a file to "
+        "its first copy, and replace each repeat of a dir, and each symlink to a dir above it, "
+        "with a plain text stub file saying where it was copied from. 'hardlink': same, but "
+        "re-create each repeat of a dir, with its files hardlinked. Default: 'copy'.")
+    parser.add_argument("--no_preflight", dest="preflight", action="store_false", help="Don't "
+        "check the source dir for circular symlinks, unreadable files and dirs, and enough free "
+        "space at the destination before copying it. These checks walk the source dir once, "
+        "following symlinks the same way the copy does.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes to "
+        "use to plan the path fixes. The paths are partitioned by top-level subdirectory, and each "
+        "partition is planned in parallel. Use 0 to use all CPU cores. Default: 1.")
+    parser.add_argument("-O", "--optimize_plan", action="store_true", help="Plan the fixes for "
+        "the whole tree at once, preferring to shorten the dirs shared by the most paths, to make "
+        "as few renames and namefiles as possible, instead of fixing one path at a time from its "
+        "right-most name. Reports the savings compared to the default plan. Planning takes "
+        "longer.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Print debugging info for "
+        "every path as it is planned. With many 'dir's, print the before and after paths of each "
+        "instead, which are otherwise only written into its output dir.")
+    parser.add_argument("--no_progress", dest="progress", action="store_false", help="Don't "
+        "report the progress (entries and bytes done, rate, and ETA) of the long-running phases. "
+        "On a terminal, progress is shown on a single updating line; when the output is "
+        "redirected, a status line is printed every 10 seconds instead.")
+    parser.add_argument("--profile", action="store_true", help="Profile the run with 'cProfile', "
+        "and write the hot spots to 'profile.txt', and the raw stats to 'profile.prof', in the "
+        "output '.eRCaGuy_PathShortener' dir. Only the main process is profiled.")
+    parser.add_argument("--mem_report", action="store_true", help="Trace memory usage with "
+        "'tracemalloc', and report the RSS, the traced and peak traced memory, and the largest "
+        "allocation sites, at the end of each phase, in 'before_and_after_paths.txt' and "
+        "'stats.json' in the output '.eRCaGuy_PathShortener' dir. This slows the run down "
+        "considerably. Only the main process is traced; worker processes only show up in the max "
+        "child RSS.")
+    parser.add_argument("--metrics_file", metavar="FILE", help="Also write the metrics of the run "
+        "(path counts, renames, bytes copied, name collisions resolved, and the time and "
+        "operations of each phase) to FILE, in the Prometheus text format, such as into the dir "
+        "of node_exporter's textfile collector. Unlike the 'metrics.prom' and 'metrics.json' "
+        "files always written into the output '.eRCaGuy_PathShortener' dir, this is written even "
+        "if the run fails, with 'path_shortener_run_success' set to 0.")
+    parser.add_argument("--events_file", metavar="FILE", help="Append an event to FILE, as a "
+        "JSON line, at the start and end of each phase, and after each batch of renames, for "
+        "external collectors to follow the run as it goes.")
+    parser.add_argument("--serve", metavar="SOCKET_PATH", help="Instead of fixing 'dir', run as "
+        "a long-lived daemon which listens on the Unix socket at SOCKET_PATH for jobs, so that "
+        "each job skips Python startup. Jobs are sent as JSON lines, and progress events and "
+        "results are streamed back the same way. See 'server.py' for the protocol, and to submit "
+        "jobs. The '--jobs' and '--scan_threads' options set the defaults for each job.")
+    parser.add_argument("--workers", type=int, default=4, help="With '--serve': the number of "
+        "jobs to run at once. Default: 4.")
+    parser.add_argument("--max_queued_jobs", type=int, default=100, help="With '--serve': the "
+        "number of jobs which may wait for a free worker. Jobs beyond that are rejected. "
+        "Default: 100.")
+    parser.add_argument("--watch", action="store_true", help="After fixing 'dir' into "
+        "'dir_short', keep watching 'dir' for changes, with inotify, and keep 'dir_short' in sync, "
+        "re-fixing only the top-level entries of 'dir' which changed. Runs until Ctrl + C.")
+    parser.add_argument("--debounce_sec", type=float, default=0.5, help="With '--watch': wait for "
+        "this many seconds without changes before syncing, so that bursts of changes, such as "
+        "from copying in a big export, are synced together. Default: 0.5.")
+    parser.add_argument("--poll", action="store_true", help="With '--watch': poll for changes "
+        "instead of using inotify, such as for network mounts, where inotify doesn't see changes "
+        "made by other machines. This is also used automatically if inotify is unavailable.")
+    parser.add_argument("--poll_interval_sec", type=float, default=1.0, help="With '--poll': how "
+        "often to check for changes. Default: 1.0.")
+    parser.add_argument("--scan_threads", type=int, default=8, help="Number of directories to "
+        "list at once when walking the directory tree. Increase this for high-latency network "
+        "mounts (SMB, NFS, etc.). Use 1 to walk the tree serially. Default: 8.")
+    parser.add_argument("--verify_content", action="store_true", help="After fixing the paths, "
+        "check that every copied file has the same contents as its source, by hashing both, even "
+        "if it was renamed. Any mismatches are listed in "
+        f"'dir_short/{OUTPUT_DIR_NAME}/{CONTENT_MISMATCHES_FILENAME}'.")
+    parser.add_argument("--verify_threads", type=int, default=8, help="Number of files to hash "
+        "at once for '--verify_content'. Default: 8.")
+    parser.add_argument("--budgets", metavar="LEN[,LEN...]", help="Instead of fixing 'dir' for "
+        "the `PATH_LEN_ALREADY_USED` in 'config.py', compare fixing it for each of these path "
+        "lengths already used, such as by the base paths of several destinations, from one walk "
+        "of 'dir'. The paths to fix, renames, namefiles, and max path len for each are printed, "
+        "and written to 'dir_short_budgets.json'. Symlinks are kept as symlinks. Ex: "
+        "'--budgets 55,100,143'.")
+    parser.add_argument("--budgets_copy", action="store_true", help="With '--budgets': also copy "
+        "'dir' into 'dir_short_LEN' for each LEN, and fix each copy.")
+    parser.add_argument("--path_list", metavar="FILE", help="Instead of walking 'dir', read the "
+        "paths in it, and whether each is a file ('f'), dir ('d'), or symlink ('l'), from FILE "
+        "('-' for stdin), such as from an index your storage system already keeps. FILE holds "
+        "either NUL-delimited 'TYPE<TAB>PATH' records, as from "
+        "`find dir -mindepth 1 -printf '%%y\\t%%P\\0'`, or JSON lines of "
+        "'{\"path\": PATH, \"type\": TYPE}', with each PATH relative to 'dir'. Only works with "
+        "'--in_place' or '--plan_file', since a copy has to be walked anyway.")
+    parser.add_argument("--plan_file", metavar="FILE", help="Only plan how to fix the paths in "
+        "'dir' in place, without changing anything, and write the renames to FILE ('-' for "
+        "stdout), in the order to make them, as NUL-delimited pairs of absolute old and new "
+        "paths. Ex: `... --plan_file - dir | xargs -0 -n 2 mv -n --`. Namefiles are not "
+        "written.")
+    parser.add_argument("--max_bytes_per_sec", metavar="RATE", help="Limit the data copied, "
+        "and written to namefiles, to RATE bytes per second, across all copy, rename, and "
+        "namefile workers, such as to not saturate a shared file server. RATE may end in K, M, "
+        "or G (powers of 1024). Ex: '50M'. Default: no limit.")
+    parser.add_argument("--max_ops_per_sec", metavar="RATE", help="Limit the file system "
+        "operations (files and dirs copied, renames, and namefiles written) to RATE per second, "
+        "across all copy, rename, and namefile workers. Ex: '200'. Default: no limit.")
+    parser.add_argument("--idle_io", action="store_true", help="Run with the 'idle' I/O "
+        "scheduling class, via `ionice -c 3`, so that the local disk serves this tool only when "
+        "nothing else needs it.")
 
     # Parse arguments; note: this automatically exits the program here if the arguments are invalid
     # or if the user requested the help menu.
@@ -393,6 +1540,184 @@ def parse_args():
     # if args.install:
     #     install()
 
+    if args.jobs < 0:
+        parser.print_usage()
+        colors.print_red("Error: '--jobs' must be >= 0.")
+        exit(EXIT_FAILURE)
+    elif args.jobs == 0:
+        args.jobs = os.cpu_count()
+
+    if args.scan_threads < 1:
+        parser.print_usage()
+        colors.print_red("Error: '--scan_threads' must be >= 1.")
+        exit(EXIT_FAILURE)
+
+    if args.verify_threads < 1:
+        parser.print_usage()
+        colors.print_red("Error: '--verify_threads' must be >= 1.")
+        exit(EXIT_FAILURE)
+
+    for option_name in ["max_bytes_per_sec", "max_ops_per_sec"]:
+        if getattr(args, option_name) is not None:
+            try:
+                setattr(args, option_name, throttle.parse_rate(getattr(args, option_name)))
+            except ValueError:
+                parser.print_usage()
+                colors.print_red(f"Error: '--{option_name}' must be a number > 0, optionally "
+                                 f"ending in K, M, or G.")
+                exit(EXIT_FAILURE)
+
+    args.budgets_list = []
+    if args.budgets:
+        try:
+            args.budgets_list = [int(budget) for budget in args.budgets.split(",")]
+        except ValueError:
+            args.budgets_list = None
+        if (not args.budgets_list
+                or not all(0 <= budget < config.WINDOWS_MAX_PATH_LEN
+                           for budget in args.budgets_list)):
+            parser.print_usage()
+            colors.print_red(f"Error: '--budgets' must be a comma-separated list of path lengths "
+                             f"from 0 to {config.WINDOWS_MAX_PATH_LEN - 1}.")
+            exit(EXIT_FAILURE)
+        # Remove duplicates, keeping the order
+        args.budgets_list = list(dict.fromkeys(args.budgets_list))
+        # The budgets are planned from one walk of the source, which doesn't follow symlinks
+        args.keep_symlinks = True
+    elif args.budgets_copy:
+        parser.print_usage()
+        colors.print_red("Error: '--budgets_copy' only works with '--budgets'.")
+        exit(EXIT_FAILURE)
+
+    args.path_types_dict = None
+    if args.plan_file == "-":
+        # Keep stdout for the plan only, for pipelines, and print everything else to stderr
+        args.plan_stdout = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    # Since the working dir is changed below
+    for option_name in ["metrics_file", "events_file"]:
+        if getattr(args, option_name):
+            setattr(args, option_name, os.path.abspath(getattr(args, option_name)))
+    for option_name in ["path_list", "plan_file"]:
+        if getattr(args, option_name) not in (None, "-"):
+            setattr(args, option_name, os.path.abspath(getattr(args, option_name)))
+
+    args.exclude_patterns_list = list(args.exclude)
+    args.include_patterns_list = list(args.include)
+    if args.exclude_from:
+        try:
+            with open(args.exclude_from) as file:
+                exclude_patterns_list, include_patterns_list = filters.read_patterns_file(file)
+        except OSError as e:
+            colors.print_red(f"Error: cannot read '--exclude_from' file: {e}")
+            exit(EXIT_FAILURE)
+        args.exclude_patterns_list += exclude_patterns_list
+        args.include_patterns_list += include_patterns_list
+    args.path_filter = filters.PathFilter(args.exclude_patterns_list, args.include_patterns_list)
+
+    args.dirs_list = [dir.rstrip("/") for dir in args.dirs]
+    if args.dirs_from:
+        try:
+            with (sys.stdin if args.dirs_from == "-" else open(args.dirs_from)) as file:
+                for line in file:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        args.dirs_list.append(line.rstrip("/"))
+        except OSError as e:
+            colors.print_red(f"Error: cannot read '--dirs_from' file: {e}")
+            exit(EXIT_FAILURE)
+
+    if args.serve:
+        if args.dirs_list:
+            parser.print_usage()
+            colors.print_red("Error: don't pass a 'dir' with '--serve'. Send it in each job "
+                             "instead.")
+            exit(EXIT_FAILURE)
+        if args.workers < 1:
+            parser.print_usage()
+            colors.print_red("Error: '--workers' must be >= 1.")
+            exit(EXIT_FAILURE)
+        if args.max_queued_jobs < 0:
+            parser.print_usage()
+            colors.print_red("Error: '--max_queued_jobs' must be >= 0.")
+            exit(EXIT_FAILURE)
+
+        return args
+
+    args.batch = len(args.dirs_list) > 1
+    if args.batch:
+        if args.roots_in_flight < 1:
+            parser.print_usage()
+            colors.print_red("Error: '--roots_in_flight' must be >= 1.")
+            exit(EXIT_FAILURE)
+        for option_name in ["meld", "profile", "mem_report", "undo", "metrics_file",
+                            "events_file", "budgets", "path_list", "plan_file"]:
+            if getattr(args, option_name):
+                parser.print_usage()
+                colors.print_red(f"Error: '--{option_name}' only works with a single 'dir'.")
+                exit(EXIT_FAILURE)
+
+        if args.watch:
+            parser.print_usage()
+            colors.print_red("Error: '--watch' only works with a single 'dir'.")
+            exit(EXIT_FAILURE)
+
+        # Remove duplicates, keeping the order, since fixing the same dir twice at once would fail
+        args.dirs_list = list(dict.fromkeys(os.path.abspath(dir) for dir in args.dirs_list))
+        return args
+
+    args.dir = args.dirs_list[0] if args.dirs_list else None
+
+    if args.watch:
+        if args.debounce_sec < 0 or args.poll_interval_sec <= 0:
+            parser.print_usage()
+            colors.print_red("Error: '--debounce_sec' must be >= 0, and '--poll_interval_sec' "
+                             "must be > 0.")
+            exit(EXIT_FAILURE)
+        for option_name in ["meld", "profile", "mem_report", "in_place", "undo",
+                            "verify_content", "metrics_file", "events_file", "path_list",
+                            "plan_file"]:
+            if getattr(args, option_name):
+                parser.print_usage()
+                colors.print_red(f"Error: '--{option_name}' doesn't work with '--watch'.")
+                exit(EXIT_FAILURE)
+
+    if args.in_place:
+        if args.undo:
+            parser.print_usage()
+            colors.print_red("Error: use only one of '--in_place' and '--undo'.")
+            exit(EXIT_FAILURE)
+        if args.verify_content:
+            parser.print_usage()
+            colors.print_red("Error: '--verify_content' checks the copy against the original "
+                             "dir, so it doesn't work with '--in_place'.")
+            exit(EXIT_FAILURE)
+        # Symlinks can only be replaced with real files by copying
+        args.keep_symlinks = True
+
+    if args.plan_file:
+        for option_name in ["in_place", "undo", "meld", "verify_content"]:
+            if getattr(args, option_name):
+                parser.print_usage()
+                colors.print_red(f"Error: '--{option_name}' doesn't work with '--plan_file'.")
+                exit(EXIT_FAILURE)
+        # The plan is for fixing `dir` in place, and symlinks can only be replaced by copying
+        args.keep_symlinks = True
+
+    if args.path_list and not (args.in_place or args.plan_file):
+        parser.print_usage()
+        colors.print_red("Error: '--path_list' only works with '--in_place' or '--plan_file'.")
+        exit(EXIT_FAILURE)
+
+    if args.budgets:
+        for option_name in ["watch", "in_place", "undo", "meld", "verify_content", "path_list",
+                            "plan_file"]:
+            if getattr(args, option_name):
+                parser.print_usage()
+                colors.print_red(f"Error: '--{option_name}' doesn't work with '--budgets'.")
+                exit(EXIT_FAILURE)
+
     if not args.dir:
         # Print the short help menu and an error message, and exit.
         # - Note: the default behavior if the positional argument is missing and `nargs` is NOT set
@@ -406,11 +1731,6 @@ def parse_args():
         colors.print_red("Error: missing required argument 'dir'")
         exit(EXIT_FAILURE)
 
-    # Strip any trailing slashes from the directory path
-    # print(f"args.dir before: {args.dir}")  # debugging
-    args.dir = args.dir.rstrip("/")
-    # print(f"args.dir after:  {args.dir}")  # debugging
-
     args.parent_dir = os.path.dirname(args.dir)
 
     # is parent_dir empty?
@@ -467,7 +1787,8 @@ def add_unique_to_sorted_list(sorted_list, value):
         sorted_list.add(value)
 
 
-def get_paths_to_fix(all_paths_set, keep_symlinks, max_path_len_already_used=0):
+def get_paths_to_fix(all_paths_set, keep_symlinks, max_path_len_already_used=0,
+                     symlink_paths_set=None, settings=None, timer=None):
     """
     Get the paths that need to be fixed and return them in a sorted list reverse-sorted by path
     length.
@@ -476,11 +1797,22 @@ def get_paths_to_fix(all_paths_set, keep_symlinks, max_path_len_already_used=0):
     # 1. If the path is too long
     # 2. If there are symlinks in the path
     # 3. If there are illegal Windows characters in the path
+
+    symlink_paths_set: the set of paths in `all_paths_set` which are symlinks, if already known,
+    such as for a path list which does not exist on the disk. If None, each path is checked on the
+    disk instead.
+
+    settings: a `config.Settings` object. Default: the settings in 'config.py'.
+
+    timer: a `PhaseTimer` to count the stat calls in, if given.
     """
+    if settings is None:
+        settings = config.Settings()
+
     paths_to_fix_sorted_list = SortedList(key=lambda path: -len(path))
     path_stats = PathStats()
 
-    path_stats.max_allowed_path_len = config.MAX_ALLOWED_PATH_LEN - max_path_len_already_used
+    path_stats.max_allowed_path_len = settings.max_allowed_path_len - max_path_len_already_used
     path_stats.max_len = 0
     path_stats.total_path_count = len(all_paths_set)
     path_stats.too_long_path_count = 0
@@ -499,12 +1831,17 @@ def get_paths_to_fix(all_paths_set, keep_symlinks, max_path_len_already_used=0):
         # Check if the path is a symlink, but only if `keep_symlinks` is false
         if not keep_symlinks:
             # Check if a path is a symlink
-            if os.path.islink(path):
+            if symlink_paths_set is None:
+                is_symlink = os.path.islink(path)
+            else:
+                is_symlink = path in symlink_paths_set
+
+            if is_symlink:
                 path_stats.symlink_path_count += 1
                 add_to_list = True
 
         # Check if the path has illegal Windows characters
-        if any(char in path for char in config.ILLEGAL_WINDOWS_CHARS):
+        if any(char in path for char in settings.illegal_windows_chars):
             path_stats.illegal_windows_char_path_count += 1
             add_to_list = True
 
@@ -513,9 +1850,97 @@ def get_paths_to_fix(all_paths_set, keep_symlinks, max_path_len_already_used=0):
 
     path_stats.paths_to_fix_count = len(paths_to_fix_sorted_list)
 
+    if not keep_symlinks and symlink_paths_set is None and timer is not None:
+        timer.count("stat_calls", len(all_paths_set))
+
     return paths_to_fix_sorted_list, path_stats
 
 
+class PathClassification:
+    """
+    All paths in a dir, checked once by `classify_paths()`, so that the paths to fix for any
+    number of max allowed path lengths can then be found without checking each path again.
+    """
+    def __init__(self):
+        # All paths, reverse-sorted by path length, so that the paths too long for any max allowed
+        # path length are always at the start of this list
+        self.paths_sorted_list = []
+        # The paths which need to be fixed no matter their length: the symlinks, unless they are
+        # kept, and the paths with illegal Windows characters
+        self.always_fix_set = set()
+        self.symlink_path_count = 0
+        self.illegal_windows_char_path_count = 0
+
+    def count_too_long(self, max_allowed_path_len):
+        """
+        Count the paths longer than `max_allowed_path_len`, with a binary search.
+        """
+        return bisect.bisect_left(self.paths_sorted_list, -max_allowed_path_len,
+                                  key=lambda path: -len(path))
+
+    def get_paths_to_fix(self, max_allowed_path_len):
+        """
+        Same as `get_paths_to_fix()`, with a max allowed path length of `max_allowed_path_len`.
+
+        Returns a `(paths_to_fix_sorted_list, path_stats)` tuple.
+        """
+        too_long_path_count = self.count_too_long(max_allowed_path_len)
+
+        paths_to_fix_sorted_list = SortedList(
+            self.paths_sorted_list[:too_long_path_count], key=lambda path: -len(path))
+        paths_to_fix_sorted_list.update(path for path in self.always_fix_set
+                                        if len(path) <= max_allowed_path_len)
+
+        path_stats = PathStats()
+        path_stats.max_allowed_path_len = max_allowed_path_len
+        path_stats.max_len = len(self.paths_sorted_list[0]) if self.paths_sorted_list else 0
+        path_stats.total_path_count = len(self.paths_sorted_list)
+        path_stats.too_long_path_count = too_long_path_count
+        path_stats.symlink_path_count = self.symlink_path_count
+        path_stats.illegal_windows_char_path_count = self.illegal_windows_char_path_count
+        path_stats.paths_to_fix_count = len(paths_to_fix_sorted_list)
+
+        return paths_to_fix_sorted_list, path_stats
+
+    def get_max_len_not_fixed(self, max_allowed_path_len):
+        """
+        Get the length of the longest path which does not need to be fixed with a max allowed path
+        length of `max_allowed_path_len`, or 0 if there is none.
+        """
+        for path in self.paths_sorted_list[self.count_too_long(max_allowed_path_len):]:
+            if path not in self.always_fix_set:
+                return len(path)
+
+        return 0
+
+
+def classify_paths(all_paths_set, keep_symlinks, settings=None, timer=None):
+    """
+    Same as `get_paths_to_fix()`, but for any number of max allowed path lengths at once.
+
+    Returns a `PathClassification` object.
+    """
+    if settings is None:
+        settings = config.Settings()
+
+    classification = PathClassification()
+    classification.paths_sorted_list = sorted(all_paths_set, key=lambda path: -len(path))
+
+    for path in all_paths_set:
+        if not keep_symlinks and os.path.islink(path):
+            classification.symlink_path_count += 1
+            classification.always_fix_set.add(path)
+
+        if any(char in path for char in settings.illegal_windows_chars):
+            classification.illegal_windows_char_path_count += 1
+            classification.always_fix_set.add(path)
+
+    if not keep_symlinks and timer is not None:
+        timer.count("stat_calls", len(all_paths_set))
+
+    return classification
+
+
 def print_paths_list(paths_TO_list):
     print("\nIndex: Len: Path element list")
 
@@ -554,14 +1979,245 @@ def hash_to_hex(input_string, hex_len):
     return hex_digest
 
 
+# How many hex chars longer than `settings.hash_len` a `NameAllocator` makes a hash to avoid a name
+# collision, before falling back to a counter suffix instead
+MAX_HASH_LEN_EXTRA = 4
+
+
+class NameAllocator:
+    """
+    Allocate the new names of the files and dirs renamed by a plan, one dir at a time, so that no
+    two entries in the same dir are given the same name.
+
+    Each new name is first made with a hash of `settings.hash_len` hex chars. If that name is
+    already taken by another entry in the same dir, only the colliding name gets a longer hash, up
+    to `MAX_HASH_LEN_EXTRA` chars longer, and then a counter suffix, until it is unique. So a run
+    never has to be redone with a larger `HASH_LEN` because of a collision within the plan.
+
+    The entries in each dir are all the ones in `paths_original_list`, plus the ones in
+    `all_paths_set`, if given, which should be all paths in the dir being fixed, so that no new
+    name collides with an entry which is already short enough and so isn't renamed. Without it,
+    any collision with those is still only found when the renames are made. The original names
+    always stay taken, so that no rename has to wait for another.
+
+    The hash of each original path is computed once, and cached. Each path in
+    `duplicate_paths_dict`, if given, from `get_duplicate_paths_dict()`, is hashed as the path of
+    the first file of its duplicate group instead, so that all of the group's files share one hash,
+    and so get the same new name wherever they are shortened by the same amount.
+    """
+    def __init__(self, settings, paths_original_list, all_paths_set=None,
+                 duplicate_paths_dict=None):
+        self.settings = settings
+        # full original path --> its full hex hash digest
+        self.hash_digests_dict = {}
+        # full original path of a duplicate --> the full original path to hash instead
+        self.hash_paths_dict = duplicate_paths_dict or {}
+        # original path of a dir --> {name taken in it: original name of the entry which has it}
+        self.owners_dict = {}
+        # full original path of each renamed entry --> (its current new name, what it needed to be
+        # unique: None, "lengthened" for a longer hash, or "counter_suffixed" for a counter suffix)
+        self.names_dict = {}
+
+        for path in paths_original_list:
+            # `str(Path())` to join the names the same way the callers make `full_path_original`
+            dir_path = str(Path(path[0]))
+            for name in path[1:]:
+                self.owners_dict.setdefault(dir_path, {})[name] = name
+                dir_path = os.path.join(dir_path, name)
+
+        # Only the dirs with entries to rename need to know their other entries
+        for path in all_paths_set or ():
+            dir_path, name = os.path.split(path)
+            owners = self.owners_dict.get(dir_path)
+            if owners is not None:
+                owners.setdefault(name, name)
+
+    def get_hash(self, full_path_original, hash_len):
+        """
+        Same as `hash_to_hex(full_path_original, hash_len)`, but cached, and of the path of the
+        first file of its duplicate group, if any.
+        """
+        full_path_original = self.hash_paths_dict.get(full_path_original, full_path_original)
+        hash_digest = self.hash_digests_dict.get(full_path_original)
+        if hash_digest is None:
+            hash_digest = hash_to_hex(full_path_original, hashlib.sha256().digest_size*2)
+            self.hash_digests_dict[full_path_original] = hash_digest
+
+        return hash_digest[:hash_len]
+
+    def allocate(self, full_path_original, make_name_func):
+        """
+        Allocate a new name for the file or dir at `full_path_original`, freeing the last name
+        allocated for it, if any. `make_name_func(hash_str)` makes the name from a hash string.
+
+        Returns the new name.
+        """
+        dir_path, name_original = os.path.split(full_path_original)
+        owners = self.owners_dict.setdefault(dir_path, {})
+
+        name_current, _ = self.names_dict.get(full_path_original, (None, None))
+        if name_current is not None and owners.get(name_current) == name_original:
+            del owners[name_current]
+
+        hash_len = self.settings.hash_len
+        name_new = make_name_func(self.get_hash(full_path_original, hash_len))
+        collision_fix = None
+        if owners.get(name_new, name_original) != name_original:
+            collision_fix = "lengthened"
+            for hash_len in range(hash_len + 1, hash_len + MAX_HASH_LEN_EXTRA + 1):
+                name_new = make_name_func(self.get_hash(full_path_original, hash_len))
+                if owners.get(name_new, name_original) == name_original:
+                    break
+            else:
+                collision_fix = "counter_suffixed"
+                hash_str = self.get_hash(full_path_original, self.settings.hash_len)
+                counter = 2
+                while True:
+                    name_new = make_name_func(f"{hash_str}-{counter}")
+                    if owners.get(name_new, name_original) == name_original:
+                        break
+                    counter += 1
+
+        owners[name_new] = name_original
+        self.names_dict[full_path_original] = (name_new, collision_fix)
+        return name_new
+
+    def count_collisions(self, timer):
+        """
+        Add the counts of final names which had to be lengthened to be unique, by a longer hash or
+        else by a counter suffix, to the current phase's counts in the `PhaseTimer` `timer`, if
+        given. A name allocated more than once, as the plan is refined, is counted only once, by
+        its last allocation.
+        """
+        if timer is None:
+            return
+        collision_fixes = collections.Counter(
+            collision_fix for _, collision_fix in self.names_dict.values() if collision_fix)
+        if collision_fixes["lengthened"]:
+            timer.count("names_lengthened", collision_fixes["lengthened"])
+        if collision_fixes["counter_suffixed"]:
+            timer.count("names_counter_suffixed", collision_fixes["counter_suffixed"])
+
+
+def get_duplicate_paths_dict(paths_list, is_dir_list, parent_dir="", timer=None):
+    """
+    Group the files in `paths_list`, each a list of path elements relative to `parent_dir`, which
+    are hardlinks to the same file, by `(st_dev, st_ino)`, and have the same name, such as the
+    repeats of a file which `copy_directory()` hardlinked to its first copy. See
+    `DUPLICATES_MODES_LIST`. The first file of each group, in list order, is the one whose naming
+    the rest of the group reuses. See `NameAllocator`. The stat calls are counted in the
+    `PhaseTimer` `timer`, if given.
+
+    Returns a dict of the full path of each file which is a repeat --> the full path of the first
+    file of its group, with the paths joined the same way as the planners join them.
+    """
+    first_paths_dict = {}  # (st_dev, st_ino, name) --> full path of the first file
+    duplicate_paths_dict = {}
+    for path, is_dir in zip(paths_list, is_dir_list):
+        if is_dir:
+            continue
+
+        full_path = str(Path(*path))
+        try:
+            stat_result = os.lstat(os.path.join(parent_dir, full_path))
+        except OSError:
+            continue
+        finally:
+            if timer is not None:
+                timer.count("stat_calls")
+        if stat_result.st_nlink < 2:
+            continue
+
+        first_path = first_paths_dict.setdefault(
+            (stat_result.st_dev, stat_result.st_ino, path[-1]), full_path)
+        if first_path != full_path:
+            duplicate_paths_dict[full_path] = first_path
+
+    return duplicate_paths_dict
+
+
+def make_hash_name(make_name_func, full_path_original, settings, name_allocator=None):
+    """
+    Make a name with `make_name_func(hash_str)`, with a hash of `full_path_original`: a unique one
+    from `name_allocator`, if given, or else one with a plain hash of `settings.hash_len` chars.
+    """
+    if name_allocator is None:
+        return make_name_func(hash_to_hex(full_path_original, settings.hash_len))
+    return name_allocator.allocate(full_path_original, make_name_func)
+
+
+def replace_illegal_chars_in_name(name, is_dir, full_path_original, settings,
+                                  name_allocator=None):
+    """
+    Replace any illegal Windows chars in the file or dir name `name`, and add a hash of its full
+    original path to the end of its name (or stem, for files) to keep it unique. If a
+    `NameAllocator` is given, the new name is allocated from it, so it is unique in its dir.
+
+    Returns `name` unchanged if it has no illegal chars.
+    """
+    name_new = replace_chars(name, settings.illegal_windows_chars, "_")
+    if name_new == name:
+        return name
+
+    def make_name(hash_str):
+        hash_str = settings.hash_prefix_for_illegals + hash_str
+
+        if not is_dir:
+            # It's a file, so handle stems (where "file.txt" is in format "stem.suffix")
+            path_new = Path(name_new)
+            return str(path_new.with_stem(path_new.stem + hash_str))
+
+        # It's a directory, so even if it has periods in the dir name, it has no stems to handle!
+        return name_new + hash_str
+
+    return make_hash_name(make_name, full_path_original, settings, name_allocator)
+
+
+def shorten_name(name, is_dir, allowed_segment_len, full_path_original, settings,
+                 name_allocator=None):
+    """
+    Shorten the file or dir name `name` to `allowed_segment_len` chars, plus a hash of its full
+    original path to keep it unique. For files, only the stem is shortened, and the suffix is kept.
+    If a `NameAllocator` is given, the new name is allocated from it, so it is unique in its dir.
+
+    Returns `name` unchanged if it is already short enough that shortening it would not help.
+    """
+    path = Path(name)
+
+    # Only files have stems; Ex: "file.txt" is in format "stem.suffix"
+    if not is_dir:
+        # For files
+        stem_old = path.stem        # ex: "some_file"
+    else:
+        # For directories
+        stem_old = name
+
+    # NB: +1 for the char before the hash. Ex: "@abcd"
+    if len(stem_old) <= allowed_segment_len + settings.hash_len + 1:
+        return name
+
+    def make_name(hash_str):
+        # Shorten the stem. If the hash had to be made longer to be unique, keep that many fewer
+        # chars of the stem, so that the name stays the same length.
+        num_chars_to_keep = max(allowed_segment_len - (len(hash_str) - settings.hash_len), 0)
+        stem_new = (stem_old[:num_chars_to_keep] + settings.hash_prefix_for_shortened
+                    + hash_str)
+
+        if not is_dir:
+            return str(path.with_stem(stem_new))
+        return stem_new
+
+    return make_hash_name(make_name, full_path_original, settings, name_allocator)
+
+
 shorten_segment_call_cnt = 0
 def shorten_segment_and_update_longest_namefiles_list(i_row, i_column,
-                    paths_original_list, paths_FROM_list,
+                    paths_original_list, is_dir_list,
                     paths_TO_list, paths_longest_namefiles_list,
-                    allowed_segment_len):
+                    allowed_segment_len, settings, verbose=False, name_allocator=None):
     """
     Shorten the segment in-place inside the paths_TO_list, while also updating the
-    paths_longest_namefiles_list.
+    paths_longest_namefiles_list. The new name is allocated from `name_allocator`, if given.
 
     OLD PLACEHOLDER CODE:
     Trivial example to just return a 0-prefixed, fixed-len incrementing number as a string:
@@ -576,41 +2232,17 @@ def shorten_segment_and_update_longest_namefiles_list(i_row, i_column,
     # 1. Shorten the segment in the paths_TO_list
 
     segment_long = paths_TO_list[i_row][i_column]
-    path_TO = Path(segment_long)
 
     i_last_column = len(paths_TO_list[i_row]) - 1
 
     is_dir = True
     if i_column == i_last_column:
-        is_dir = paths.is_dir(paths_FROM_list[i_row])
+        is_dir = is_dir_list[i_row]
 
-    # Only files have stems; Ex: "file.txt" is in format "stem.suffix"
-    if not is_dir:
-        # For files
-        stem_old = path_TO.stem        # ex: "some_file"
-    else:
-        # For directories
-        stem_old = str(path_TO)
-
-    stem_new = stem_old
-
-    # NB: +1 for the char before the hash. Ex: "@abcd"
-    if len(stem_old) > allowed_segment_len + config.HASH_LEN + 1:
-        # Hash the full original path to better ensure uniqueness
-        full_path_original = str(Path(*(paths_original_list[i_row][0:i_column + 1])))
-        # print(f"full_path_original: {full_path_original}")  # debugging
-
-        # Shorten the stem
-        stem_new = (stem_old[:allowed_segment_len] + config.HASH_PREFIX_FOR_SHORTENED
-                    + hash_to_hex(full_path_original, config.HASH_LEN))
-
-    # Only files have stems; Ex: "file.txt" is in format "stem.suffix"
-    if not is_dir:
-        # For files
-        segment_short = str(path_TO.with_stem(stem_new))
-    else:
-        # For directories
-        segment_short = stem_new
+    # Hash the full original path to better ensure uniqueness
+    full_path_original = str(Path(*(paths_original_list[i_row][0:i_column + 1])))
+    segment_short = shorten_name(
+        segment_long, is_dir, allowed_segment_len, full_path_original, settings, name_allocator)
 
     paths_TO_list[i_row][i_column] = segment_short
 
@@ -661,11 +2293,12 @@ def shorten_segment_and_update_longest_namefiles_list(i_row, i_column,
                 paths_longest_namefiles_list[i_row] = namefile_full_path_new
 
                 # debugging
-                colors.print_yellow("NOTE: USING NON-RIGHT-MOST-COLUMN NAMEFILE PATH since "
-                                    "this one is longer!")
-                print(f"len_old: {len_old}")
-                print(f"len_new: {len_new}")
-                print(f"namefile_full_path_new: {namefile_full_path_new}")
+                if verbose:
+                    colors.print_yellow("NOTE: USING NON-RIGHT-MOST-COLUMN NAMEFILE PATH since "
+                                        "this one is longer!")
+                    print(f"len_old: {len_old}")
+                    print(f"len_new: {len_new}")
+                    print(f"namefile_full_path_new: {namefile_full_path_new}")
 
     path_len = paths.get_len(paths_longest_namefiles_list[i_row])
 
@@ -692,110 +2325,99 @@ HASH_LEN_RECOMMENDATION = ("  Increase the `HASH_LEN` in 'config.py' to reduce t
                          + "  this in your original directory.")
 
 
-def write_namefile_to_disk(namefiles_list, namefile_path, name_old, is_dir):
+def write_namefile_to_disk(namefiles_list, namefile_path, name_old, is_dir, timer=None):
     """
-    Write a namefile to the disk.
+    Write a namefile to the disk, counting it in the `PhaseTimer` `timer`, if given.
     """
+    file_or_dir = "directory" if is_dir else "file"
+    contents_str = f"Original {file_or_dir} name:\n{name_old}\n"
+    throttle_io(timer, num_ops=2, num_bytes=len(contents_str))  # the `stat()` and the write
+
     if namefile_path.exists():
-        colors.print_red(f"Error: Namefile \"{namefile_path}\" already exists.")
-        colors.print_red(HASH_LEN_RECOMMENDATION)
-        # TODO: consider gracefully handling these name collisions instead of exiting here.
-        colors.print_red("Exiting.")
-        exit(EXIT_FAILURE)
+        # TODO: consider gracefully handling these name collisions instead of raising here.
+        raise NameCollisionError(f"Namefile \"{namefile_path}\" already exists.\n"
+                                 + HASH_LEN_RECOMMENDATION)
     else:
         # Create the namefile on the disk
         with open(namefile_path, "w") as file:
-            file_or_dir = "directory" if is_dir else "file"
-            file.write(f"Original {file_or_dir} name:\n"
-                     + f"{name_old}\n")
+            file.write(contents_str)
+        if timer is not None:
+            timer.count("files_written")
 
     namefiles_list.append(namefile_path)
 
 
-def fix_paths(args, max_path_len_already_used):
+class PathPlan:
     """
-    Fix the paths in `paths_to_fix_sorted_list`:
-
-    1. Replace symlinks with real files.
-    2. Replace illegal Windows characters with valid ones.
-    3. Shorten the paths to a length that is acceptable on Windows.
-
-    all_paths_set: a set of all original paths in the directory
-
-    paths_original_list   # how the paths first were before doing any renaming
-    paths_FROM_list       # rename paths FROM this
-    paths_TO_list         # rename paths TO this
-    # (removed) paths_noillegals_list # how the paths will look after removing illegal chars,
-                          # but withOUT shortening
-    paths_longest_namefiles_list # A list of the right-most namefiles ONLY, where namefiles are the
-                          #   "my_file_name@ABCD_NAME.txt" and
-                          #   "my_dir_name@ABCD/!my_dir_name@ABCD_NAME.txt" type
-                          #   files which will store the full name of the original
-                          #   file or dir prior to removing illegal chars or shortening.
-                          # - Only the right-most namefiles are needed in this list since
-                          #   they are the longest ones in any given path which will
-                          #   determine the max path length for that path.
-                          # - The path is still stored as a list of path elements, same as the
-                          #   other lists above.
-
+    The planned (but not yet applied) fixes for a list of paths to fix. See `plan_paths()`.
     """
+    def __init__(self):
+        # See the descriptions of these lists in `fix_paths()`.
+        self.paths_original_list = []
+        self.paths_TO_list = []
+        self.paths_longest_namefiles_list = []
+        # The renames to perform on the disk, in order, as a list of
+        # `(path_chunk_old, path_chunk_new)` tuples of `Path` objects.
+        self.renames_list = []
+        # Only set by `plan_paths()`: the row in `paths_TO_list` which each rename was planned for,
+        # so that the plans of partitions can be merged back in the same order. See
+        # `plan_paths_in_parallel()`.
+        self.renames_rows_list = None
+        # The dir which all of the paths above are relative to. "" means the current working dir.
+        self.parent_dir = ""
+        # Only set by `plan_paths_optimized()`: how many files and dirs this plan renames, and how
+        # many namefiles it writes, and the same for the greedy plan from `plan_paths()`, to
+        # report the savings. The greedy counts are None if the greedy plan failed.
+        self.rename_count = None
+        self.namefile_count = None
+        self.greedy_rename_count = None
+        self.greedy_namefile_count = None
+
+
+def plan_paths(paths_TO_list, is_dir_list, verbose=False, progress_reporter=None, settings=None,
+               all_paths_set=None, timer=None, duplicate_paths_dict=None):
+    """
+    Plan how to fix all paths in `paths_TO_list`, without touching the disk.
 
-    # Note: this also automatically fixes the symlinks by replacing them with real files.
-    print("\nCopying files to a new directory...")
-    shortened_dir = args.base_dir + config.SHORT_DIR_SUFFIX
-    broken_symlinks_list_of_tuples = copy_directory(args.base_dir, shortened_dir, args)
-
-    paths_all_set, paths_to_fix_sorted_list, path_stats = walk_dir_and_exit_if_done(
-        shortened_dir, args.keep_symlinks)
-
-    # TODO: `paths_all_set` can later be used to avoid path collisions
-    # as new, corrected paths are generated. For now, though, it isn't being used.
-
-    output_dir = os.path.join(shortened_dir, ".eRCaGuy_PathShortener")
-    os.makedirs(output_dir, exist_ok=True)
-
-    # Write the broken symlinks to a file
-    with open (os.path.join(output_dir, "broken_symlinks.txt"), "w") as file:
-        if (len(broken_symlinks_list_of_tuples) > 0):
-            file.write(f"{len(broken_symlinks_list_of_tuples)} broken symlinks found:\n\n")
-
-            i = 0
-            for src, dst, error_str in broken_symlinks_list_of_tuples:
-                file.write(f"{i}:\n")
-                file.write(f"  - src:   {src}\n")
-                file.write(f"  - dst:   {dst}\n")
-                file.write(f"  - error: {error_str}\n")
-                file.write("\n")
-                i += 1
-
-        else:
-            file.write("No broken symlinks found.\n")
-
-    # # debugging
-    # print("\nPaths all set:")
-    # for path in paths_all_set:
-    #     print(path)
-
-    # Copy the sorted list into a regular list of parts (lists) to operate on.
-    # - Paths will be renamed TO this.
-    paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
-
-    # fix the root path
-
-    for path in paths_TO_list:
-        path[0] = shortened_dir
+    Inputs:
+    - paths_TO_list: a list of paths to fix, reverse-sorted by path length, where each path is
+      stored as a list of path elements. This list is modified in-place.
+    - is_dir_list: a list of bools, one per row in `paths_TO_list`, stating whether or not the
+      right-most element of that path is a directory.
+    - verbose: print debugging info for every path as it is planned.
+    - progress_reporter: a `progress.ProgressReporter` to update once per path.
+    - settings: a `config.Settings` object. Default: the settings in 'config.py'.
+    - all_paths_set: all paths in the dir, in the same form as the paths in `paths_TO_list`, so
+      that no new name collides with an existing entry which isn't renamed. See `NameAllocator`.
+    - timer: a `PhaseTimer` to count the names which had to be lengthened to be unique in, if
+      given.
+    - duplicate_paths_dict: the files which are repeats of another file, from
+      `get_duplicate_paths_dict()`, to reuse the naming of that file for. See `NameAllocator`.
+
+    Returns a `PathPlan` object. Raises a `PathTooLongError` if a path can't be shortened enough.
+    """
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("plan", enabled=False)
+    if settings is None:
+        settings = config.Settings()
 
-    # # debugging
-    # print("\nPaths TO list:", end="")
-    # print_paths_list(paths_TO_list)
+    path_plan = PathPlan()
+    path_plan.paths_TO_list = paths_TO_list
+    path_plan.renames_rows_list = []
 
     # Store the original paths for later.
     # This is how the paths first were before doing any renaming.
     paths_original_list = copy.deepcopy(paths_TO_list)
-    # Other lists: see descriptions above.
+    # Other lists: see descriptions in `fix_paths()`.
     paths_FROM_list = copy.deepcopy(paths_TO_list)
     paths_longest_namefiles_list = copy.deepcopy(paths_TO_list)
 
+    path_plan.paths_original_list = paths_original_list
+    path_plan.paths_longest_namefiles_list = paths_longest_namefiles_list
+
+    # Give each renamed file or dir a name which is unique in its dir
+    name_allocator = NameAllocator(settings, paths_original_list, all_paths_set,
+                                   duplicate_paths_dict)
 
     # Fix all paths: including illegal Windows characters and path length, all at once in one
     # pass, row by row and column by column
@@ -809,8 +2431,9 @@ def fix_paths(args, max_path_len_already_used):
     #   1. Go to the next column to the left. Repeat: replace illegal chars, then shorten it, etc.
     #   1. When done with all columns, check the path length. If still too long, shorten paths
     #      even more, starting at the right-most column.
-    #   1. ONCE THE PATH has all illegal chars removed, AND is short enough, make that change to the
-    #      disk one column at a time, starting at the end (right-most) column.
+    #   1. ONCE THE PATH has all illegal chars removed, AND is short enough, record that change
+    #      one column at a time, starting at the left-most column, so it can be made to the disk
+    #      later by `apply_renames_to_disk()`, which replays them bottom-up, once per file or dir.
     #   1. If it is the last (far right) column and that path is a dir, NOT a file, then you must
     #      also propagate that change across all other paths in the list at this parent path AND
     #      column index since that dir was just renamed and we need to account for it elsewhere
@@ -819,13 +2442,9 @@ def fix_paths(args, max_path_len_already_used):
     #   1. If it is any column < last_column_i, then you must propagate that change across all other
     #      paths in the list at this parent path AND column index since that dir was just renamed
     #      and we need to account for it elsewhere in our list.
-    # 1. Done: all paths are fixed, and all changes have been propagated to the disk.
-    # 1. Double-check that all paths are now valid and short enough by walking the directory tree
-    #    and checking each path length one last time.
-
-    print()
+    # 1. Done: all paths are fixed, and all changes have been recorded in the plan.
 
-    # 1. Fix paths in the FROM and TO lists, and on the disk
+    # 1. Fix paths in the FROM and TO lists
     for i_row, path in enumerate(paths_TO_list):
         num_columns = len(path)
         i_last_column = num_columns - 1
@@ -833,48 +2452,29 @@ def fix_paths(args, max_path_len_already_used):
         path_len = paths.get_len(path_longest)
 
         # debugging
-        colors.print_blue(f"\nPath: {i_row:4}: {path_len:4}:       {path}")
-        print(f"  num_columns: {num_columns}")
-        print(f"  i_last_column: {i_last_column}")
-        print(f"  path_len: {path_len}")
+        if verbose:
+            colors.print_blue(f"\nPath: {i_row:4}: {path_len:4}:       {path}")
+            print(f"  num_columns: {num_columns}")
+            print(f"  i_last_column: {i_last_column}")
+            print(f"  path_len: {path_len}")
 
         # 1. Replace illegal Windows characters for ALL columns, adding a namefile for each
         #    right-most column if a rename is needed.
         i_column = i_last_column
         while i_column >= 0:
             name_old = path[i_column]
-            path[i_column] = replace_chars(path[i_column], config.ILLEGAL_WINDOWS_CHARS, "_")
-            name_new = path[i_column]
-
-            # Add hashes to all renamed paths
-            if name_old != name_new:
-                full_path_original = str(Path(*(paths_original_list[i_row][0:i_column + 1])))
 
-                # # debugging
-                # print(f"name_old: {name_old}")
-                # print(f"name_new: {name_new}")
-                # print(f"full_path_original: {full_path_original}")
-
-                # Assume it's a directory, as it can only possibly be a file if it's the right-most
-                # column.
-                is_dir = True
-                if i_column == i_last_column:
-                    is_dir = paths.is_dir(paths_FROM_list[i_row])  # will store False for files
-
-                hash_str = (config.HASH_PREFIX_FOR_ILLEGALS +
-                            hash_to_hex(full_path_original, config.HASH_LEN))
+            # Assume it's a directory, as it can only possibly be a file if it's the right-most
+            # column.
+            is_dir = True
+            if i_column == i_last_column:
+                is_dir = is_dir_list[i_row]  # will store False for files
 
-                if not is_dir:
-                    # It's a file, so handle stems (where "file.txt" is in format "stem.suffix")
-                    stem_new = Path(name_new).stem
-                    stem_new += hash_str
-                    path_new = Path(name_new).with_stem(stem_new)
-                    path[i_column] = str(path_new)
-                else:
-                    # It's a directory, so even if it has periods in the dir name, it has no stems
-                    # to handle!
-                    path[i_column] = name_new + hash_str
+            full_path_original = str(Path(*(paths_original_list[i_row][0:i_column + 1])))
+            path[i_column] = replace_illegal_chars_in_name(
+                name_old, is_dir, full_path_original, settings, name_allocator)
 
+            if path[i_column] != name_old:
                 # Create a namefile for the right-most column if it was renamed to remove illegal
                 # Windows characters.
                 # - If the path was renamed, then it will need a namefile to store its original
@@ -897,12 +2497,13 @@ def fix_paths(args, max_path_len_already_used):
         #   path is short enough, OR until this value reaches 0, at which point it cannot be
         #   shortened any further.
         max_segment_len = max(len(segment) for segment in path)
-        print(f"  max_segment_len: {max_segment_len}") # debugging
+        if verbose:
+            print(f"  max_segment_len: {max_segment_len}") # debugging
         allowed_segment_len = max_segment_len
         # Always run at least once in order to check namefiles for names that were fixed above
-        path_len = config.MAX_ALLOWED_PATH_LEN + 1
+        path_len = settings.max_allowed_path_len + 1
 
-        while (path_len > config.MAX_ALLOWED_PATH_LEN
+        while (path_len > settings.max_allowed_path_len
                and allowed_segment_len > 0):
             i_column = i_last_column
             # Use `> 0` so that we do NOT shorten the base dir; ex: "whatever_short/"
@@ -910,11 +2511,11 @@ def fix_paths(args, max_path_len_already_used):
                 # Shorten the segment in-place inside the paths_TO_list
                 path_len = shorten_segment_and_update_longest_namefiles_list(
                     i_row, i_column,
-                    paths_original_list, paths_FROM_list,
+                    paths_original_list, is_dir_list,
                     paths_TO_list, paths_longest_namefiles_list,
-                    allowed_segment_len)
+                    allowed_segment_len, settings, verbose, name_allocator)
 
-                if path_len <= config.MAX_ALLOWED_PATH_LEN:
+                if path_len <= settings.max_allowed_path_len:
                     break
 
                 i_column -= 1
@@ -922,32 +2523,29 @@ def fix_paths(args, max_path_len_already_used):
             allowed_segment_len -= 1
 
         # debugging
-        print(f"  Original path:        {paths_original_list[i_row]}")
-        print(f"  FROM path:            {paths_FROM_list[i_row]}")
-        print(f"  TO (shortened) path:  {path}")
-
-        if path_len > config.MAX_ALLOWED_PATH_LEN:
-            colors.print_red(f"Error: Path is still too long after shortening "
-                f"(path_len = {path_len}; config.MAX_ALLOWED_PATH_LEN = "
-                f"{config.MAX_ALLOWED_PATH_LEN}).")
-
-            colors.print_yellow(f"Potential fix: consider reducing `PATH_LEN_ALREADY_USED` "
-                f"in 'config.py' if you don't need to shorten the paths so much. Or, "
-                f"decrease `HASH_LEN` to shorten the paths further.")
+        if verbose:
+            print(f"  Original path:        {paths_original_list[i_row]}")
+            print(f"  FROM path:            {paths_FROM_list[i_row]}")
+            print(f"  TO (shortened) path:  {path}")
 
-            colors.print_red(f"  Original path:        {paths_original_list[i_row]}")
-            colors.print_red(f"  FROM path:            {paths_FROM_list[i_row]}")
-            colors.print_red(f"  TO (shortened) path:  {path}")
-
-            # TODO: consider not exiting here. Perhaps I want to keep on going and let the user
+        if path_len > settings.max_allowed_path_len:
+            # TODO: consider not raising here. Perhaps I want to keep on going and let the user
             # manually fix any insufficiently-shortened paths themselves afterwards.
-            colors.print_red("Exiting.")
-            exit(EXIT_FAILURE)
+            raise PathTooLongError(
+                f"Path is still too long after shortening "
+                f"(path_len = {path_len}; max_allowed_path_len = "
+                f"{settings.max_allowed_path_len}).\n"
+                f"Potential fix: consider reducing `PATH_LEN_ALREADY_USED` "
+                f"in 'config.py' if you don't need to shorten the paths so much. Or, "
+                f"decrease `HASH_LEN` to shorten the paths further.\n"
+                f"  Original path:        {paths_original_list[i_row]}\n"
+                f"  FROM path:            {paths_FROM_list[i_row]}\n"
+                f"  TO (shortened) path:  {path}")
 
-        # Propagate the path changes across all paths in the FROM, TO, and namefiles lists, AND ON
-        # THE DISK, from L to R in the columns.
-        # - Also look for name collisions.
-        # - And create namefiles for any files or dirs that were renamed.
+        # Propagate the path changes across all paths in the FROM, TO, and namefiles lists, from L
+        # to R in the columns, and record the renames to later make on the disk.
+        # - Name collisions are checked for again when the renames are made on the disk.
+        # - Namefiles for any files or dirs that were renamed are created later, too.
 
         # For all columns in this path, from L to R
         for i_column in range(num_columns):
@@ -959,36 +2557,878 @@ def fix_paths(args, max_path_len_already_used):
 
             if path_chunk_new != path_chunk_old:
 
-                # Fix it (for both files *and* folders!) on the disk
+                # 1. Record the rename (for both files *and* folders!) to later make on the disk
+                path_plan.renames_list.append((path_chunk_old, path_chunk_new))
+                path_plan.renames_rows_list.append(i_row)
 
-                # 1. Check for name collisions
-                if path_chunk_new.exists():
-                    colors.print_red(f"Error: Path chunk \"{path_chunk_new}\" already exists. "
-                            + f"Cannot perform the rename.")
-                    colors.print_red(HASH_LEN_RECOMMENDATION)
-                    # TODO: consider gracefully handling these name collisions instead of exiting
-                    # here.
-                    colors.print_red("Exiting.")
-                    exit(EXIT_FAILURE)
-
-                # 2. Perform the actual rename **on the disk!**
-                path_chunk_old.rename(path_chunk_new)
-
-                # Do NOT create namefiles here. Do it below, instead, after ALL paths have been
-                # shortened sufficiently, and renamed on the disk.
-
-                # 3. If the path chunk is a directory, it could exist in other paths in the list,
+                # 2. If the path chunk is a directory, it could exist in other paths in the list,
                 # so fix (rename) it in all other places in these lists:
-                if path_chunk_new.is_dir():
+                if i_column < i_last_column or is_dir_list[i_row]:
                     update_paths_in_list(paths_FROM_list, path, path_chunk_list_old, i_column)
                     update_paths_in_list(paths_TO_list, path, path_chunk_list_old, i_column)
                     update_paths_in_list(
                         paths_longest_namefiles_list, path, path_chunk_list_old, i_column)
 
-    # 2. AFTER shortening & renaming all paths above on the disk, write the namefiles to the disk.
-    # - This copies a lot of the logic from just above, but must be done last to avoid this bug:
-    # - Ths is a bug fix for the bug described in commit 1c373ffe3640eef5ee422b0e6e42d7f1513634c6:
-    #   > path_shortener.py et al: identify & reproduce a bug!
+        progress_reporter.update()
+
+    name_allocator.count_collisions(timer)
+
+    return path_plan
+
+
+class PlanNode:
+    """
+    A file or dir in the tree of paths to fix built by `plan_paths_optimized()`.
+    """
+    __slots__ = ("name_original", "name", "name_new", "is_dir", "parent", "children_dict",
+                 "full_path_original", "len_to", "name_cut", "reduction", "namefile_len_extra",
+                 "namefile_len_extra_cut", "d_set", "costs_dict", "cut_choices_dict",
+                 "allowed_segment_len")
+
+    def __init__(self, name_original, parent):
+        self.name_original = name_original
+        # The name after replacing any illegal Windows chars, and after shortening, once planned
+        self.name = name_original
+        self.name_new = name_original
+        self.is_dir = True
+        self.parent = parent
+        self.children_dict = {}  # original name --> child `PlanNode`
+        self.full_path_original = ""
+        # The length of the path to this node, with `name`, before any shortening
+        self.len_to = 0
+        # The name when shortened as much as possible
+        self.name_cut = name_original
+        # How many chars shortening this node as much as possible removes from every path
+        # through it. 0 if it can't be shortened.
+        self.reduction = 0
+        # How much longer than the path to this node the path of its namefile is, with `name`, and
+        # with `name_cut`. None if it needs no namefile.
+        self.namefile_len_extra = None
+        self.namefile_len_extra_cut = None
+        # The possible amounts that the dirs above this one are shortened by, in total, and the
+        # min cost of the subtree under (and including) this node for each of them, and whether
+        # to shorten this node to get that cost.
+        self.d_set = set()
+        self.costs_dict = {}
+        self.cut_choices_dict = {}
+        # How many chars of the name to keep when shortening it, or None if not shortened
+        self.allowed_segment_len = None
+
+    def get_path_new(self):
+        """
+        Get the path to this node, with the new names, as a list of path elements.
+        """
+        path = []
+        node = self
+        while node.parent is not None:
+            path.append(node.name_new)
+            node = node.parent
+        path.reverse()
+        return path
+
+    def iter_subtree(self):
+        """
+        Yield this node and all nodes under it, parents before children.
+        """
+        nodes_to_visit_list = [self]
+        while nodes_to_visit_list:
+            node = nodes_to_visit_list.pop()
+            yield node
+            nodes_to_visit_list.extend(node.children_dict.values())
+
+
+def get_rename_and_namefile_counts(path_plan, is_dir_list):
+    """
+    Count the files and dirs which `path_plan` renames, each once, no matter how many times it is
+    renamed, and the namefiles which will be written for them: 1 per file and 2 per dir.
+
+    Returns a `(rename_count, namefile_count)` tuple.
+    """
+    is_dir_dict = {}  # original path parts of each renamed file or dir --> whether it is a dir
+    for i_row, (path_original, path_TO) in enumerate(
+            zip(path_plan.paths_original_list, path_plan.paths_TO_list)):
+        i_last_column = len(path_TO) - 1
+        for i_column, name in enumerate(path_TO):
+            if name != path_original[i_column]:
+                is_dir_dict[tuple(path_original[0:i_column + 1])] = (
+                    i_column < i_last_column or is_dir_list[i_row])
+
+    namefile_count = sum(2 if is_dir else 1 for is_dir in is_dir_dict.values())
+    return len(is_dir_dict), namefile_count
+
+
+# The fewest chars of a name to keep when shortening it, same as the lowest
+# `allowed_segment_len` which `plan_paths()` tries.
+MIN_ALLOWED_SEGMENT_LEN = 1
+
+
+def get_namefile_path_len(len_to, name, is_dir):
+    """
+    Get the length of the path of the namefile which stores the original name of a renamed file or
+    dir, given the length of the path to it, `len_to`, and its new `name`. For dirs, this is the
+    namefile inside of the dir, which is the longer of its two namefiles.
+    """
+    return len_to - len(name) + len(paths.make_namefile_name(name, is_dir))
+
+
+def plan_paths_optimized(paths_TO_list, is_dir_list, verbose=False, progress_reporter=None,
+                         settings=None, all_paths_set=None, timer=None, duplicate_paths_dict=None):
+    """
+    Same as `plan_paths()`, but plan the fixes for the whole tree of paths at once, to make as few
+    renames, and write as few namefiles, as possible.
+
+    `plan_paths()` fixes one path at a time, longest first, shortening from the right-most column,
+    so a deep dir shared by thousands of files gets no priority over the files' own names, and
+    each of those files is renamed, and gets a namefile, instead. This instead finds the set of
+    files and dirs to shorten which fixes all paths at the lowest cost, where the cost of
+    shortening a file is 2 (1 rename + 1 namefile), and of a dir is 3 (1 rename + 2 namefiles),
+    preferring the shared dirs which fix the most paths at once. Files and dirs which must be
+    renamed anyway, to replace illegal Windows chars, are free to shorten too.
+
+    How:
+    1. Build a tree of all of the paths, with one `PlanNode` per file or dir.
+    1. Find the lowest cost with dynamic programming over the tree, bottom-up, where the state is
+       how many chars the dirs above a node were shortened by in total. Each node is either left
+       as-is or shortened as much as `plan_paths()` could shorten it, to its first
+       `MIN_ALLOWED_SEGMENT_LEN` chars plus a hash. Every path and namefile path must fit.
+    1. Then, top-down, so that shared dirs keep the most of their names, give each shortened node
+       back as many chars as still fit.
+
+    The greedy plan from `plan_paths()` is also made, to report the savings in the returned plan's
+    `rename_count`, `namefile_count`, `greedy_rename_count`, and `greedy_namefile_count`, and is
+    returned instead if it is somehow better, or if a name had to be made longer to be unique in
+    its dir, and that left a path too long.
+    """
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("plan", enabled=False)
+    if settings is None:
+        settings = config.Settings()
+
+    max_len = settings.max_allowed_path_len
+    paths_original_list = copy.deepcopy(paths_TO_list)
+
+    greedy_plan = None
+    greedy_error = None
+    try:
+        greedy_plan = plan_paths(copy.deepcopy(paths_TO_list), is_dir_list, settings=settings,
+                                 all_paths_set=all_paths_set,
+                                 duplicate_paths_dict=duplicate_paths_dict)
+    except PathTooLongError as e:
+        greedy_error = e
+    else:
+        greedy_plan.rename_count, greedy_plan.namefile_count = get_rename_and_namefile_counts(
+            greedy_plan, is_dir_list)
+        greedy_plan.greedy_rename_count = greedy_plan.rename_count
+        greedy_plan.greedy_namefile_count = greedy_plan.namefile_count
+
+    def use_greedy_plan():
+        # Keep the caller's list up-to-date, same as `plan_paths()` does.
+        paths_TO_list[:] = greedy_plan.paths_TO_list
+        greedy_plan.paths_TO_list = paths_TO_list
+        return greedy_plan
+
+    # 1. Build the tree. `root` is a placeholder above the base dirs (column 0), which, like in
+    #    `plan_paths()`, are never shortened.
+    root = PlanNode("", None)
+    row_nodes_list = []  # the node at the end of each path
+    for i_row, path in enumerate(paths_original_list):
+        node = root
+        for i_column, name in enumerate(path):
+            child = node.children_dict.get(name)
+            if child is None:
+                child = PlanNode(name, node)
+                child.full_path_original = str(Path(*path[0:i_column + 1]))
+                node.children_dict[name] = child
+            node = child
+
+        node.is_dir = is_dir_list[i_row]
+        row_nodes_list.append(node)
+
+    nodes_list = list(root.iter_subtree())[1:]
+    for node in nodes_list:
+        node.name = replace_illegal_chars_in_name(
+            node.name_original, node.is_dir, node.full_path_original, settings)
+        node.name_new = node.name
+        if node.parent is root:
+            node.len_to = len(node.name)
+        else:
+            node.len_to = node.parent.len_to + len(os.sep) + len(node.name)
+            node.name_cut = shorten_name(node.name, node.is_dir, MIN_ALLOWED_SEGMENT_LEN,
+                                         node.full_path_original, settings)
+            node.reduction = len(node.name) - len(node.name_cut)
+            node.namefile_len_extra_cut = get_namefile_path_len(0, node.name_cut, node.is_dir)
+
+        if node.name != node.name_original:
+            node.namefile_len_extra = get_namefile_path_len(0, node.name, node.is_dir)
+
+    # 2. Find the lowest cost. Shortening the dirs above a node by more than `d_max` chars in total
+    #    can't make any path or namefile path under it fit any better, so cap it there.
+    d_max = max(max(node.len_to, get_namefile_path_len(node.len_to, node.name, node.is_dir))
+                for node in nodes_list) - max_len
+    d_max = max(d_max, 0)
+
+    root.d_set = {0}
+    for node in root.iter_subtree():
+        d_set_children = set()
+        for d in node.d_set:
+            d_set_children.add(d)
+            if node.reduction > 0:
+                d_set_children.add(min(d + node.reduction, d_max))
+        for child in node.children_dict.values():
+            child.d_set.update(d_set_children)
+
+    def get_cost(node, d, cut):
+        """
+        Get the cost of `node` when the dirs above it were shortened by `d` chars in total, and it
+        is (`cut` is True) or isn't shortened itself, or None if that leaves a path under it too
+        long. Uses the costs already found for its children.
+        """
+        len_to = node.len_to - d
+        namefile_len_extra = node.namefile_len_extra
+        if cut:
+            len_to -= node.reduction
+            namefile_len_extra = node.namefile_len_extra_cut
+
+        if len_to > max_len:
+            return None
+        if namefile_len_extra is not None and len_to + namefile_len_extra > max_len:
+            return None
+
+        cost = 0
+        if cut and node.name == node.name_original:
+            cost = 3 if node.is_dir else 2
+
+        d_children = min(d + node.reduction, d_max) if cut else d
+        for child in node.children_dict.values():
+            cost_child = child.costs_dict.get(d_children)
+            if cost_child is None:
+                return None
+            cost += cost_child
+
+        return cost
+
+    for node in reversed(nodes_list):
+        for d in node.d_set:
+            cost = get_cost(node, d, cut=False)
+            cut = False
+            if node.reduction > 0:
+                cost_cut = get_cost(node, d, cut=True)
+                if cost_cut is not None and (cost is None or cost_cut < cost):
+                    cost = cost_cut
+                    cut = True
+
+            if cost is not None:
+                node.costs_dict[d] = cost
+                node.cut_choices_dict[d] = cut
+
+    if any(0 not in node.costs_dict for node in root.children_dict.values()):
+        # Not all paths can be made to fit this way
+        if greedy_error is not None:
+            raise greedy_error
+        progress_reporter.update(len(paths_TO_list))
+        return use_greedy_plan()
+
+    # Pick which nodes to shorten, top-down, following the choices which gave the lowest cost
+    d_dict = {child: 0 for child in root.children_dict.values()}  # node --> `d` above it
+    cut_nodes_list = []
+    for node in nodes_list:
+        d = d_dict[node]
+        cut = node.cut_choices_dict[d]
+        if cut:
+            node.allowed_segment_len = MIN_ALLOWED_SEGMENT_LEN
+            node.name_new = node.name_cut
+            cut_nodes_list.append(node)
+            d = min(d + node.reduction, d_max)
+        for child in node.children_dict.values():
+            d_dict[child] = d
+
+    # 3. Give each shortened node back as many chars of its name as still fit, top-down, so that
+    #    dirs shared by many paths keep the most. Then allocate the final names, so that they are
+    #    unique in their dirs.
+    name_allocator = NameAllocator(settings, paths_original_list, all_paths_set,
+                                   duplicate_paths_dict)
+    for node in cut_nodes_list:
+        len_to_node = paths.get_len(node.get_path_new())
+
+        # Every path and namefile path under this node grows by 1 char per char given back, except
+        # for its own namefile, which has its name in it twice
+        slack = max_len - get_namefile_path_len(len_to_node, node.name_new, node.is_dir)
+        slack = min(max_len - len_to_node, slack // 2)
+
+        lens_to_visit_list = [(child, len_to_node) for child in node.children_dict.values()]
+        while lens_to_visit_list:
+            node2, len_to_parent = lens_to_visit_list.pop()
+            len_to = len_to_parent + len(os.sep) + len(node2.name_new)
+            slack = min(slack, max_len - len_to)
+            if node2.name_new != node2.name_original:
+                slack = min(slack, max_len - get_namefile_path_len(
+                    len_to, node2.name_new, node2.is_dir))
+            lens_to_visit_list.extend(
+                (child, len_to) for child in node2.children_dict.values())
+
+        # Keep it shortened, though, since that is what the cost was found for
+        allowed_segment_len_max = len(Path(node.name).stem if not node.is_dir else node.name)
+        allowed_segment_len_max -= settings.hash_len + 2
+        node.allowed_segment_len = min(MIN_ALLOWED_SEGMENT_LEN + max(slack, 0),
+                                       allowed_segment_len_max)
+        node.name_new = shorten_name(node.name, node.is_dir, node.allowed_segment_len,
+                                     node.full_path_original, settings, name_allocator)
+
+    # Also give the files and dirs which are only renamed to replace illegal chars names which are
+    # unique in their dirs. The names above were already allocated this way.
+    for node in nodes_list:
+        if node.name_new == node.name and node.name != node.name_original:
+            node.name_new = replace_illegal_chars_in_name(
+                node.name_original, node.is_dir, node.full_path_original, settings,
+                name_allocator)
+    name_allocator.count_collisions(timer)
+
+    # 4. Make the plan, in the same format as `plan_paths()` does
+    path_plan = PathPlan()
+    path_plan.paths_original_list = paths_original_list
+    path_plan.paths_TO_list = paths_TO_list
+
+    # The names were only allocated after the lowest cost was found, and a name which collided got
+    # a longer hash, or a counter suffix, which the lengths above didn't account for, so check the
+    # final lengths again
+    too_long_path_list = None
+    len_too_long = 0
+    for i_row, node in enumerate(row_nodes_list):
+        nodes_in_row_list = []
+        while node is not root:
+            nodes_in_row_list.append(node)
+            node = node.parent
+        nodes_in_row_list.reverse()
+
+        path = [node.name_new for node in nodes_in_row_list]
+        paths_TO_list[i_row][:] = path
+
+        # The longest of the path itself and the namefile paths in it
+        path_longest = path
+        len_longest = paths.get_len(path)
+        len_to = -len(os.sep)
+        for i_column, node in enumerate(nodes_in_row_list):
+            len_to += len(os.sep) + len(node.name_new)
+            if node.name_new != node.name_original:
+                namefile_len = get_namefile_path_len(len_to, node.name_new, node.is_dir)
+                if namefile_len > len_longest:
+                    path_longest = path[0:i_column] + [
+                        paths.make_namefile_name(node.name_new, node.is_dir)]
+                    len_longest = namefile_len
+        path_plan.paths_longest_namefiles_list.append(list(path_longest))
+
+        if len_longest > max_len and too_long_path_list is None:
+            too_long_path_list = path_longest
+            len_too_long = len_longest
+
+    if too_long_path_list is not None:
+        if greedy_error is not None:
+            raise PathTooLongError(
+                f"Path is still too long after shortening "
+                f"(path_len = {len_too_long}; max_allowed_path_len = {max_len}), since its new "
+                f"names had to be made longer to be unique in their dirs.\n"
+                f"Potential fix: decrease `HASH_LEN` in 'config.py' to shorten the paths further.\n"
+                f"  TO (shortened) path:  {too_long_path_list}")
+        progress_reporter.update(len(paths_TO_list))
+        return use_greedy_plan()
+
+    # Parents before children, so each rename's path already has the new names of the dirs above
+    for node in nodes_list:
+        if node.name_new != node.name_original:
+            parent_parts_new = node.parent.get_path_new()
+            path_plan.renames_list.append((Path(*parent_parts_new, node.name_original),
+                                           Path(*parent_parts_new, node.name_new)))
+
+    path_plan.rename_count, path_plan.namefile_count = get_rename_and_namefile_counts(
+        path_plan, is_dir_list)
+
+    if greedy_plan is not None:
+        path_plan.greedy_rename_count = greedy_plan.greedy_rename_count
+        path_plan.greedy_namefile_count = greedy_plan.greedy_namefile_count
+
+        if (greedy_plan.rename_count + greedy_plan.namefile_count
+                < path_plan.rename_count + path_plan.namefile_count):
+            path_plan = use_greedy_plan()
+
+    if verbose:
+        print(f"Optimized plan: {path_plan.rename_count} renames and "
+              f"{path_plan.namefile_count} namefiles.")
+
+    progress_reporter.update(len(paths_TO_list))
+
+    return path_plan
+
+
+def plan_paths_worker(paths_TO_list, is_dir_list, verbose, settings, optimize=False,
+                      all_paths_set=None, duplicate_paths_dict=None):
+    """
+    Run `plan_paths()`, or `plan_paths_optimized()` if `optimize` is True, inside of a worker
+    process, capturing its output instead of letting it interleave with the output of other
+    workers.
+
+    Returns a `(path_plan, output_str, error)` tuple, where `path_plan` is None, and `error` is the
+    `PathShortenerError` raised, if `plan_paths()` failed.
+    """
+    path_plan = None
+    error = None
+    output = io.StringIO()
+
+    with contextlib.redirect_stdout(output):
+        try:
+            plan_paths_func = plan_paths_optimized if optimize else plan_paths
+            path_plan = plan_paths_func(paths_TO_list, is_dir_list, verbose, settings=settings,
+                                        all_paths_set=all_paths_set,
+                                        duplicate_paths_dict=duplicate_paths_dict)
+        except PathShortenerError as e:
+            error = e
+
+    return path_plan, output.getvalue(), error
+
+
+def partition_rows_by_subtree(paths_TO_list, num_partitions):
+    """
+    Partition the rows of `paths_TO_list` into up to `num_partitions` groups which can be planned
+    independently of each other.
+
+    Renames only propagate to other paths which share the same parent path, and the base dir (column
+    0) is never renamed, so all paths which share the same top-level entry (column 1) must be
+    planned together, but paths in different top-level subtrees never affect each other.
+
+    Returns a list of lists of row indices. The row indices inside of each partition are kept in
+    ascending order so that each partition is still planned longest path first.
+    """
+    subtrees_dict = {}
+    for i_row, path in enumerate(paths_TO_list):
+        top_level_name = path[1] if len(path) > 1 else ""
+        subtrees_dict.setdefault(top_level_name, []).append(i_row)
+
+    # Greedily balance the subtrees across the partitions: assign each subtree, largest first, to
+    # whichever partition currently has the fewest rows.
+    partitions_list = [[] for _ in range(min(num_partitions, len(subtrees_dict)))]
+    for rows_list in sorted(subtrees_dict.values(), key=len, reverse=True):
+        smallest_partition = min(partitions_list, key=len)
+        smallest_partition.extend(rows_list)
+
+    for rows_list in partitions_list:
+        rows_list.sort()
+
+    return partitions_list
+
+
+def partition_all_paths_set(all_paths_set, paths_TO_list, partitions_list):
+    """
+    Split `all_paths_set`, all paths in the dir, into one set per partition of rows from
+    `partition_rows_by_subtree()`, so that each worker only gets the paths it needs to know about:
+    the ones in its own top-level subtrees, plus the top-level entries (column 1), since every
+    partition may rename entries in the base dir.
+
+    Returns a list of sets, one per partition, in partition order.
+    """
+    i_partition_dict = {}  # top-level name --> index of the partition which plans its subtree
+    for i_partition, rows_list in enumerate(partitions_list):
+        for i_row in rows_list:
+            if len(paths_TO_list[i_row]) > 1:
+                i_partition_dict[paths_TO_list[i_row][1]] = i_partition
+
+    paths_sets_list = [set() for _ in partitions_list]
+    for path in all_paths_set:
+        parts = Path(path).parts
+        if len(parts) <= 2:
+            for paths_set in paths_sets_list:
+                paths_set.add(path)
+        elif parts[1] in i_partition_dict:
+            paths_sets_list[i_partition_dict[parts[1]]].add(path)
+
+    return paths_sets_list
+
+
+def check_for_top_level_collisions(path_plan):
+    """
+    Check that no two different top-level entries (column 1) were planned to be renamed to the
+    same new name. When planning in parallel, each top-level subtree is planned in isolation, so
+    this is the one place where their results could collide.
+    """
+    original_names_dict = {}  # new top-level name --> original top-level name
+    for path_original, path_TO in zip(path_plan.paths_original_list, path_plan.paths_TO_list):
+        if len(path_TO) < 2:
+            continue
+
+        name_original = original_names_dict.setdefault(path_TO[1], path_original[1])
+        if name_original != path_original[1]:
+            raise NameCollisionError(
+                f"Top-level entries \"{name_original}\" and \"{path_original[1]}\" would both "
+                f"be renamed to \"{path_TO[1]}\".")
+
+
+def plan_partitions(executor, partitions_list, paths_TO_list, is_dir_list, verbose, settings,
+                    progress_reporter, optimize=False, all_paths_set=None,
+                    duplicate_paths_dict=None):
+    """
+    Plan each partition of rows from `partition_rows_by_subtree()` as a separate task on the
+    process pool `executor`, updating the progress as each one finishes.
+
+    Returns a list of the `plan_paths_worker()` results, one per partition, in partition order.
+    """
+    if all_paths_set is None:
+        paths_sets_list = [None]*len(partitions_list)
+    else:
+        paths_sets_list = partition_all_paths_set(all_paths_set, paths_TO_list, partitions_list)
+
+    futures_list = []
+    for rows_list, paths_set in zip(partitions_list, paths_sets_list):
+        future = executor.submit(plan_paths_worker,
+                                 [paths_TO_list[i_row] for i_row in rows_list],
+                                 [is_dir_list[i_row] for i_row in rows_list],
+                                 verbose, settings, optimize, paths_set, duplicate_paths_dict)
+        futures_list.append(future)
+
+    partition_sizes_dict = {future: len(rows_list)
+                            for future, rows_list in zip(futures_list, partitions_list)}
+    for future in concurrent.futures.as_completed(futures_list):
+        progress_reporter.update(partition_sizes_dict[future])
+
+    return [future.result() for future in futures_list]
+
+
+def plan_paths_in_parallel(paths_TO_list, is_dir_list, num_jobs, verbose=False,
+                           progress_reporter=None, settings=None, executor=None, optimize=False,
+                           all_paths_set=None, timer=None, duplicate_paths_dict=None):
+    """
+    Same as `plan_paths()`, or `plan_paths_optimized()` if `optimize` is True, but partition the
+    paths by top-level subtree and plan each partition in a separate worker process, using up to
+    `num_jobs` processes. Then merge the results back together, in the original row order.
+
+    The progress is updated once per partition, as each one finishes.
+
+    executor: a `concurrent.futures.ProcessPoolExecutor` to plan on, such as one shared by many
+    directories. Default: create a new one with `num_jobs` processes, just for this call.
+
+    all_paths_set: see `plan_paths()`. Each worker only gets the part of it which it needs. See
+    `partition_all_paths_set()`.
+
+    timer: see `plan_paths()`. Only used when planning in this process.
+
+    duplicate_paths_dict: see `plan_paths()`. Since each duplicate only reuses the hash of the
+    first file of its group, not its plan, the two may be planned in different partitions.
+    """
+    partitions_list = partition_rows_by_subtree(paths_TO_list, num_jobs)
+
+    if len(partitions_list) <= 1:
+        plan_paths_func = plan_paths_optimized if optimize else plan_paths
+        path_plan = plan_paths_func(paths_TO_list, is_dir_list, verbose, progress_reporter,
+                                    settings, all_paths_set, timer, duplicate_paths_dict)
+        check_for_top_level_collisions(path_plan)
+        return path_plan
+
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("plan", enabled=False)
+
+    if verbose:
+        print(f"Planning {len(paths_TO_list)} paths in {len(partitions_list)} partitions, "
+              f"using {num_jobs} jobs...")
+
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_jobs) as executor:
+            results_list = plan_partitions(executor, partitions_list, paths_TO_list, is_dir_list,
+                                           verbose, settings, progress_reporter, optimize,
+                                           all_paths_set, duplicate_paths_dict)
+    else:
+        results_list = plan_partitions(executor, partitions_list, paths_TO_list, is_dir_list,
+                                       verbose, settings, progress_reporter, optimize,
+                                       all_paths_set, duplicate_paths_dict)
+
+    # Merge the partial plans back together
+    num_rows = len(paths_TO_list)
+    path_plan = PathPlan()
+    path_plan.paths_original_list = [None]*num_rows
+    path_plan.paths_TO_list = [None]*num_rows
+    path_plan.paths_longest_namefiles_list = [None]*num_rows
+    renames_by_row_list = []  # (row in `paths_TO_list`, rename) tuples
+
+    for rows_list, (partial_plan, output_str, error) in zip(partitions_list, results_list):
+        print(output_str, end="")
+        if error is not None:
+            raise error
+
+        for i, i_row in enumerate(rows_list):
+            path_plan.paths_original_list[i_row] = partial_plan.paths_original_list[i]
+            path_plan.paths_TO_list[i_row] = partial_plan.paths_TO_list[i]
+            path_plan.paths_longest_namefiles_list[i_row] = (
+                partial_plan.paths_longest_namefiles_list[i])
+
+        # The renames in different partitions are in different subtrees, so they can be made in any
+        # order relative to each other, so long as the order within each partition is kept. Still,
+        # put them back in row order where the rows are known, so that the plan is the same as
+        # `plan_paths()` would make. Otherwise, after the partition's last row.
+        renames_rows_list = partial_plan.renames_rows_list
+        if renames_rows_list is None:
+            renames_rows_list = [len(rows_list) - 1]*len(partial_plan.renames_list)
+        renames_by_row_list.extend((rows_list[i], rename) for i, rename
+                                   in zip(renames_rows_list, partial_plan.renames_list))
+
+    renames_by_row_list.sort(key=lambda row_and_rename: row_and_rename[0])  # stable
+    path_plan.renames_list = [rename for _, rename in renames_by_row_list]
+    if not optimize:
+        path_plan.renames_rows_list = [i_row for i_row, _ in renames_by_row_list]
+
+    if optimize:
+        partial_plans_list = [partial_plan for partial_plan, _, _ in results_list]
+        for count_name in ["rename_count", "namefile_count", "greedy_rename_count",
+                           "greedy_namefile_count"]:
+            counts_list = [getattr(partial_plan, count_name) for partial_plan in partial_plans_list]
+            if None not in counts_list:
+                setattr(path_plan, count_name, sum(counts_list))
+
+    try:
+        check_for_top_level_collisions(path_plan)
+    except NameCollisionError as e:
+        # The subtrees were each planned without knowing the new names in the others, so plan
+        # them all together instead, so that the top-level names are allocated together too.
+        colors.print_yellow(f"WARNING: {e}\nPlanning all paths in one process instead, to give "
+                            f"them unique names.")
+        plan_paths_func = plan_paths_optimized if optimize else plan_paths
+        return plan_paths_func(paths_TO_list, is_dir_list, verbose, settings=settings,
+                               all_paths_set=all_paths_set, timer=timer,
+                               duplicate_paths_dict=duplicate_paths_dict)
+
+    # Keep the caller's list up-to-date, same as `plan_paths()` does.
+    paths_TO_list[:] = path_plan.paths_TO_list
+    path_plan.paths_TO_list = paths_TO_list
+
+    return path_plan
+
+
+# Max number of dir file descriptors which `DirFdCache` keeps open at once
+MAX_OPEN_DIR_FDS = 64
+
+# Whether renames can be made relative to open dir file descriptors on this OS. See
+# `apply_renames_to_disk()`.
+DIR_FD_RENAMES_SUPPORTED = os.open in os.supports_dir_fd and os.rename in os.supports_dir_fd
+
+
+def get_dir_renames(renames_list):
+    """
+    Turn the renames planned by `plan_paths()`, which must be made in order, since each one's path
+    already has the new names from the renames before it, into exactly one rename per renamed file
+    or dir, straight from its original name to its final name.
+
+    Returns a list of `(parent_parts, name_old, name_new)` tuples, where `parent_parts` is the tuple
+    of the *original* names along the path to the parent dir. The list is sorted deepest first
+    (post-order), so that no dir is renamed until everything under it has been, and so each
+    `parent_parts` path is still valid when its rename is made.
+    """
+    # parent dir original parts --> {current name of a renamed child: child's original parts}
+    renamed_children_dict = {}
+    # original parts of each renamed file or dir --> its final name
+    final_names_dict = {}
+
+    for path_chunk_old, path_chunk_new in renames_list:
+        parts_old = Path(path_chunk_old).parts
+        name_new = Path(path_chunk_new).name
+
+        # Find the original path of the file or dir being renamed, one name at a time, since any
+        # of its parent dirs, or the file or dir itself, may already have been renamed.
+        parts_original = ()
+        for name in parts_old:
+            renamed_children = renamed_children_dict.get(parts_original)
+            child_parts_original = renamed_children.get(name) if renamed_children else None
+            if child_parts_original is None:
+                child_parts_original = parts_original + (name,)
+            parts_original = child_parts_original
+
+        renamed_children = renamed_children_dict.setdefault(parts_original[:-1], {})
+        renamed_children.pop(parts_old[-1], None)
+        renamed_children[name_new] = parts_original
+        final_names_dict[parts_original] = name_new
+
+    dir_renames_list = [(parts_original[:-1], parts_original[-1], name_new)
+                        for parts_original, name_new in final_names_dict.items()
+                        if parts_original[-1] != name_new]
+    # `sort()` is stable, so renames at the same depth stay in the order they were planned
+    dir_renames_list.sort(key=lambda dir_rename: len(dir_rename[0]), reverse=True)
+    return dir_renames_list
+
+
+class DirFdCache:
+    """
+    Open dir file descriptors, by path, each one opened relative to its parent dir's file
+    descriptor, so the OS only ever has to look up one name at a time, and paths longer than
+    PATH_MAX still work. Up to `max_open` are kept open, closing the least-recently-used first.
+    Each dir opened is counted in the `PhaseTimer` `timer`, if given.
+    """
+    def __init__(self, parent_dir="", max_open=MAX_OPEN_DIR_FDS, timer=None):
+        self.max_open = max_open
+        self.timer = timer
+        self.root_fd = os.open(parent_dir or os.curdir, os.O_RDONLY | os.O_DIRECTORY)
+        self.fds_dict = collections.OrderedDict()  # path parts --> open file descriptor
+
+    def get_fd(self, parts):
+        """
+        Return an open file descriptor for the dir at `parts`, relative to `parent_dir`.
+        """
+        # Start from the deepest parent dir which is already open
+        num_parts_open = len(parts)
+        while num_parts_open > 0 and parts[:num_parts_open] not in self.fds_dict:
+            num_parts_open -= 1
+
+        if num_parts_open == 0:
+            fd = self.root_fd
+        else:
+            fd = self.fds_dict[parts[:num_parts_open]]
+            self.fds_dict.move_to_end(parts[:num_parts_open])
+
+        for i in range(num_parts_open, len(parts)):
+            fd = os.open(parts[i], os.O_RDONLY | os.O_DIRECTORY, dir_fd=fd)
+            if self.timer is not None:
+                self.timer.count("dirs_opened")
+            self.fds_dict[parts[:i + 1]] = fd
+
+            if len(self.fds_dict) > self.max_open:
+                _, fd_oldest = self.fds_dict.popitem(last=False)
+                os.close(fd_oldest)
+
+        return fd
+
+    def forget(self, parts):
+        """
+        Close the file descriptor for the dir at `parts`, if open, such as since it was renamed.
+        """
+        fd = self.fds_dict.pop(parts, None)
+        if fd is not None:
+            os.close(fd)
+
+    def close(self):
+        for fd in self.fds_dict.values():
+            os.close(fd)
+        self.fds_dict.clear()
+        os.close(self.root_fd)
+
+
+def send_rename_batch_event(timer, progress_reporter, renames_total=None, force=False):
+    """
+    Send a "rename_batch" event to the hooks of the `PhaseTimer` `timer` after every
+    `RENAME_EVENT_BATCH_SIZE` renames counted by `progress_reporter`, and for the last partial
+    batch when `force` is True.
+    """
+    renames_done = progress_reporter.entries_done
+    if force:
+        if renames_done % RENAME_EVENT_BATCH_SIZE == 0:
+            return  # already sent, or no renames at all
+    elif renames_done % RENAME_EVENT_BATCH_SIZE != 0:
+        return
+
+    if renames_total is None:
+        renames_total = progress_reporter.total_entries
+    timer.send_event("rename_batch", progress_reporter.phase_name,
+                     renames_done=renames_done, renames_total=renames_total)
+
+
+def apply_renames_to_disk(renames_list, progress_reporter=None, parent_dir="", timer=None):
+    """
+    Perform the renames planned by `plan_paths()` on the disk. The paths in `renames_list` are
+    relative to `parent_dir`. The renames are counted in the `PhaseTimer` `timer`, if given.
+
+    Each file or dir is renamed exactly once, deepest first, with `os.rename()` relative to an open
+    file descriptor of its parent dir, rather than by full path. See `get_dir_renames()` and
+    `DirFdCache`. On OSes which can't do that, the renames are made in order, by full path, instead.
+    """
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("rename", enabled=False)
+    if timer is None:
+        timer = PhaseTimer()
+
+    if not DIR_FD_RENAMES_SUPPORTED:
+        apply_renames_to_disk_by_path(renames_list, progress_reporter, parent_dir, timer)
+        return
+
+    dir_renames_list = get_dir_renames(renames_list)
+    progress_reporter.total_entries = len(dir_renames_list)
+
+    dir_fd_cache = DirFdCache(parent_dir, timer=timer)
+    try:
+        for parent_parts, name_old, name_new in dir_renames_list:
+            parent_dir_fd = dir_fd_cache.get_fd(parent_parts)
+            throttle_io(timer, num_ops=2)  # the `stat()` and the rename
+
+            # 1. Check for name collisions
+            timer.count("stat_calls")
+            try:
+                os.stat(name_new, dir_fd=parent_dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                pass
+            else:
+                path_chunk_new = Path(parent_dir, *parent_parts, name_new)
+                # The planner gives each new name which is unique among all entries in its dir, so
+                # this only happens if the dir changed after it was scanned. Never overwrite it.
+                raise NameCollisionError(f"Path chunk \"{path_chunk_new}\" already exists. "
+                                         + f"Cannot perform the rename.\n"
+                                         + HASH_LEN_RECOMMENDATION)
+
+            # 2. Perform the actual rename **on the disk!**
+            os.rename(name_old, name_new, src_dir_fd=parent_dir_fd, dst_dir_fd=parent_dir_fd)
+            timer.count("renames")
+            progress_reporter.update()
+            send_rename_batch_event(timer, progress_reporter)
+
+            # Everything under this dir was already renamed, so its file descriptor, which is
+            # cached under its old name, is no longer needed.
+            dir_fd_cache.forget(parent_parts + (name_old,))
+    finally:
+        dir_fd_cache.close()
+
+    send_rename_batch_event(timer, progress_reporter, force=True)
+
+    # Do NOT create namefiles here. Do it afterwards, instead, after ALL paths have been
+    # shortened sufficiently, and renamed on the disk.
+
+
+def apply_renames_to_disk_by_path(renames_list, progress_reporter, parent_dir="", timer=None):
+    """
+    Perform the renames planned by `plan_paths()` on the disk, in order, by full path. This is the
+    fallback for `apply_renames_to_disk()`.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+
+    for path_chunk_old, path_chunk_new in renames_list:
+        path_chunk_old = Path(parent_dir, path_chunk_old)
+        path_chunk_new = Path(parent_dir, path_chunk_new)
+        throttle_io(timer, num_ops=2)  # the `stat()` and the rename
+
+        # 1. Check for name collisions
+        timer.count("stat_calls")
+        if path_chunk_new.exists():
+            # Only if the dir changed after it was scanned. See `apply_renames_to_disk()`.
+            raise NameCollisionError(f"Path chunk \"{path_chunk_new}\" already exists. "
+                                     + f"Cannot perform the rename.\n" + HASH_LEN_RECOMMENDATION)
+
+        # 2. Perform the actual rename **on the disk!**
+        path_chunk_old.rename(path_chunk_new)
+        timer.count("renames")
+        progress_reporter.update()
+        send_rename_batch_event(timer, progress_reporter, len(renames_list))
+
+    send_rename_batch_event(timer, progress_reporter, len(renames_list), force=True)
+
+
+def write_namefiles(paths_original_list, paths_TO_list, progress_reporter=None, parent_dir="",
+                    timer=None):
+    """
+    Write the namefiles to the disk for all files and dirs which were renamed.
+
+    This must be done AFTER shortening & renaming all paths on the disk. This copies a lot of the
+    logic from `plan_paths()`, but must be done last to avoid this bug:
+    - Ths is a bug fix for the bug described in commit 1c373ffe3640eef5ee422b0e6e42d7f1513634c6:
+      > path_shortener.py et al: identify & reproduce a bug!
+
+    The paths in both lists are relative to `parent_dir`. The namefiles are counted in the
+    `PhaseTimer` `timer`, if given.
+
+    Returns a list of all namefiles written to disk.
+    """
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("namefiles", enabled=False)
+
     namefiles_list = []  # a list of all namefiles written to disk
     paths_FROM_list2 = copy.deepcopy(paths_original_list)
     for i_row, path in enumerate(paths_TO_list):
@@ -999,8 +3439,8 @@ def fix_paths(args, max_path_len_already_used):
             path_chunk_list_new = path[0:i_column + 1]
             path_chunk_list_old = paths_FROM_list2[i_row][0:i_column + 1]
 
-            path_chunk_new = Path(*path_chunk_list_new)
-            path_chunk_old = Path(*path_chunk_list_old)
+            path_chunk_new = Path(parent_dir, *path_chunk_list_new)
+            path_chunk_old = Path(parent_dir, *path_chunk_list_old)
 
             if path_chunk_new != path_chunk_old:
 
@@ -1023,79 +3463,416 @@ def fix_paths(args, max_path_len_already_used):
                 # print(f"namefile_path2: {namefile_path2}")
 
                 write_namefile_to_disk(
-                    namefiles_list, namefile_path1, name_old, path_chunk_new.is_dir())
+                    namefiles_list, namefile_path1, name_old, path_chunk_new.is_dir(), timer)
                 # The second namefile is only valid for directories
                 if path_chunk_new.is_dir():
                     write_namefile_to_disk(
-                        namefiles_list, namefile_path2, name_old, path_chunk_new.is_dir())
+                        namefiles_list, namefile_path2, name_old, path_chunk_new.is_dir(), timer)
 
                 # If the path chunk is a directory, it could exist in other paths in the list,
                 # so fix (rename) it in all other places in these lists:
                 if path_chunk_new.is_dir():
                     update_paths_in_list(paths_FROM_list2, path, path_chunk_list_old, i_column)
 
-    # Write the list of namefiles to a logfile
-    with open(os.path.join(output_dir, "namefiles_created.txt"), "w") as file:
-        file.write("List of auto-created namefiles:\n\n")
-        for namefile_path in namefiles_list:
-            file.write(f"{namefile_path}\n")
+        progress_reporter.update()
 
-    print("\n")
+    return namefiles_list
 
-    # debugging
-    print("\nPrinting paths_longest_namefiles_list:")
-    print_paths_list(paths_longest_namefiles_list)
-    print()
 
+# The name of the dir, inside of each fixed dir, which holds the logs and undo journals
+OUTPUT_DIR_NAME = ".eRCaGuy_PathShortener"
+UNDO_JOURNAL_PREFIX = "undo_journal_"
+UNDO_JOURNAL_UNDONE_SUFFIX = ".undone.json"
 
-    # 3. Double-check that all paths are now valid and short enough by walking the directory tree
-    #    and checking each path length one last time.
-    # - also log some of the stats
 
-    all_paths_set2 = walk_directory(shortened_dir)
-    paths_to_fix_sorted_list2, path_stats2 = get_paths_to_fix(all_paths_set2, args.keep_symlinks)
+def write_undo_journal(dir_path, renames_list, parent_dir="", timer=None):
+    """
+    Before fixing the paths in `dir_path` in place, write an undo journal for the renames in
+    `renames_list`, planned by `plan_paths()`, into the `OUTPUT_DIR_NAME` dir inside of
+    `dir_path`. See `undo_in_place()`. The paths in `renames_list`, and `dir_path`, are relative to
+    `parent_dir`.
+
+    The journal holds one entry per renamed file or dir, from `get_dir_renames()`, with the path to
+    its parent dir relative to `dir_path`, so that it still works if `dir_path` is itself renamed
+    or moved. It is written atomically and synced to the disk before returning, so that it can
+    undo even a run which was interrupted partway through. It is counted in the `PhaseTimer`
+    `timer`, if given.
+
+    Returns the path of the journal.
+    """
+    output_dir = os.path.join(parent_dir, dir_path, OUTPUT_DIR_NAME)
+    os.makedirs(output_dir, exist_ok=True)
 
-    before_and_after_filename = os.path.join(output_dir, "before_and_after_paths.txt")
+    renames_dicts_list = []
+    for parent_parts, name_old, name_new in get_dir_renames(renames_list):
+        renames_dicts_list.append({
+            "parent": list(parent_parts[1:]),
+            "old": name_old,
+            "new": name_new,
+            "is_dir": os.path.isdir(os.path.join(parent_dir, *parent_parts, name_old)),
+        })
+
+    # Newest last, when sorted by name
+    timestamp_str = time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 10**9:09d}"
+    journal_path = os.path.join(output_dir, f"{UNDO_JOURNAL_PREFIX}{timestamp_str}.json")
+    journal_path_tmp = journal_path + ".tmp"
+    with open(journal_path_tmp, "w") as file:
+        json.dump({"dir": dir_path, "renames": renames_dicts_list}, file, indent=4)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(journal_path_tmp, journal_path)
+    if timer is not None:
+        timer.count("files_written")
+
+    return journal_path
+
+
+def undo_in_place(dir_path):
+    """
+    Undo the newest in-place run on `dir_path` which was not undone yet, using the journal written
+    by `write_undo_journal()`: delete the namefiles it wrote, then rename each renamed file and dir
+    back to its original name, shallowest first. The journal is then marked as undone, so that
+    running this again undoes the run before it.
 
-    # begin tee-ing the output to a file
-    tee = Tee.Tee(before_and_after_filename)
-    tee.begin()
+    Files and dirs which were never renamed, such as if the run was interrupted, are skipped, and
+    namefiles are only deleted if they still hold exactly what was written to them.
 
-    print("BEFORE fixing and shortening paths:")
-    path_stats.print()
-    print()
-    print("AFTER fixing and shortening paths:")
-    path_stats2.print()
-    print()
+    Returns a `(rename_count, namefile_count)` tuple of the renames undone and namefiles deleted.
+    """
+    output_dir = os.path.join(dir_path, OUTPUT_DIR_NAME)
+    journal_names_list = []
+    if os.path.isdir(output_dir):
+        journal_names_list = sorted(
+            name for name in os.listdir(output_dir)
+            if name.startswith(UNDO_JOURNAL_PREFIX) and name.endswith(".json")
+            and not name.endswith(UNDO_JOURNAL_UNDONE_SUFFIX))
+    if not journal_names_list:
+        raise PathShortenerError(f"No undo journal found in \"{output_dir}\". Only runs with "
+                                 f"'--in_place' can be undone.")
+
+    journal_path = os.path.join(output_dir, journal_names_list[-1])
+    with open(journal_path) as file:
+        renames_dicts_list = json.load(file)["renames"]
+
+    # 1. Delete the namefiles, from where they were written: after all renames were made.
+    # original parts, relative to `dir_path`, of each renamed file or dir --> its final name
+    final_names_dict = {tuple(rename_dict["parent"]) + (rename_dict["old"],): rename_dict["new"]
+                        for rename_dict in renames_dicts_list}
+
+    namefile_count = 0
+    for rename_dict in renames_dicts_list:
+        parent_parts = rename_dict["parent"]
+        parent_parts_final = [final_names_dict.get(tuple(parent_parts[:i + 1]), name)
+                              for i, name in enumerate(parent_parts)]
+        base_dir = Path(dir_path, *parent_parts_final)
+
+        name_new = rename_dict["new"]
+        is_dir = rename_dict["is_dir"]
+        namefile = paths.make_namefile_name(name_new, is_dir)
+        namefile_paths_list = [base_dir / namefile]
+        if is_dir:
+            namefile_paths_list.append(base_dir / Path(namefile).name[1:])
+
+        # Same as `write_namefile_to_disk()` writes
+        file_or_dir = "directory" if is_dir else "file"
+        contents_expected = f"Original {file_or_dir} name:\n{rename_dict['old']}\n"
+        for namefile_path in namefile_paths_list:
+            try:
+                with open(namefile_path) as file:
+                    contents = file.read()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            if contents == contents_expected:
+                os.remove(namefile_path)
+                namefile_count += 1
+
+    # 2. Rename everything back, shallowest first, so that the path to the parent dir of each one
+    #    always has the original names already.
+    rename_count = 0
+    for rename_dict in reversed(renames_dicts_list):
+        path_new = Path(dir_path, *rename_dict["parent"], rename_dict["new"])
+        path_old = Path(dir_path, *rename_dict["parent"], rename_dict["old"])
+
+        if not os.path.lexists(path_new):
+            if os.path.lexists(path_old):
+                continue  # never renamed
+            raise PathShortenerError(f"Cannot undo the rename of \"{path_old}\" to "
+                                     f"\"{path_new}\": neither of them exists.")
+        if os.path.lexists(path_old):
+            raise NameCollisionError(f"Cannot undo the rename of \"{path_old}\" to "
+                                     f"\"{path_new}\": \"{path_old}\" already exists again.")
+
+        os.rename(path_new, path_old)
+        rename_count += 1
+
+    os.rename(journal_path,
+              journal_path[:-len(".json")] + UNDO_JOURNAL_UNDONE_SUFFIX)
+
+    return rename_count, namefile_count
+
+
+# How many bytes to read at once when hashing a file for `verify_copied_contents()`
+VERIFY_CONTENT_CHUNK_SIZE = 1024*1024
+
+# The name of the file, in the `OUTPUT_DIR_NAME` dir, which lists the files whose copies don't
+# match their sources, found by `verify_copied_contents()`
+CONTENT_MISMATCHES_FILENAME = "content_mismatches.txt"
+
+# The max number of content mismatches and errors to print. All of them are written to the
+# `CONTENT_MISMATCHES_FILENAME` file.
+MAX_CONTENT_MISMATCHES_TO_PRINT = 10
+
+
+def hash_file_contents(path, file_size):
+    """
+    Hash the contents of the file at `path`, of about `file_size` bytes, reading it
+    `VERIFY_CONTENT_CHUNK_SIZE` bytes at a time into one reused buffer.
 
-    if len(paths_to_fix_sorted_list2) == 0:
-        colors.print_green("Path fixing and shortening has been successful!\n"
-            "All paths are now fixed for Windows (illegal chars removed, no symlinks if "
-            "'--keep_symlinks' was NOT used, and short enough).")
-    else:
-        colors.print_red("Error: some paths are still too long after shortening.")
-        print_paths_to_fix(paths_to_fix_sorted_list2)
-        colors.print_red("Saying again: Error: some paths are still too long after shortening.")
-        colors.print_blue("As an intermedite work-around until I can fix this better, run "
-            "this tool again on the shortened directory.")
-        # colors.print_blue("OR use the `--keep_symlinks` flag to keep symlinks as symlinks, on the "
-        #     "first run, to avoid this issue until I can fix it properly.")
-        colors.print_blue("TODO: gracefully handle this instead of exiting here.")
-        colors.print_red("Exiting.")
-        exit(EXIT_FAILURE)
+    Returns a `(hex_digest, num_bytes_read)` tuple.
+    """
+    hash_object = hashlib.sha256()
+    buffer = memoryview(bytearray(max(min(file_size, VERIFY_CONTENT_CHUNK_SIZE), 1)))
+    num_bytes_read = 0
 
-    print("\nMore length stats:")
-    print(f"  Max allowed path len:   {path_stats2.max_allowed_path_len} chars")
-    print(f"  Max len BEFORE:         {path_stats.max_len} + {max_path_len_already_used} = "
-        + f"{path_stats.max_len + max_path_len_already_used}")
-    print(f"  Max len AFTER:          {path_stats2.max_len}")
-    # Get the max length of the namefiles
-    max_namefile_len = max([len(str(Path(*path))) for path in paths_longest_namefiles_list])
-    print(f"  Max namefile len AFTER: {max_namefile_len}")
+    with open(path, "rb", buffering=0) as file:
+        while num_bytes := file.readinto(buffer):
+            hash_object.update(buffer[:num_bytes])
+            num_bytes_read += num_bytes
+
+    return hash_object.hexdigest(), num_bytes_read
+
+
+def verify_file_contents(src_path, dst_path):
+    """
+    Check that the copied file `dst_path` has the same contents as its source file, `src_path`.
+
+    Returns a `(status, num_bytes_read, reason)` tuple, where `status` is one of "match",
+    "mismatch", "error", or "skipped", for entries which aren't copies of regular files: dirs,
+    symlinks kept with `--keep_symlinks`, and the text files which replace broken symlinks and
+    repeated dirs.
+    """
+    try:
+        dst_stat = os.lstat(dst_path)
+        if not stat.S_ISREG(dst_stat.st_mode):
+            return "skipped", 0, None
+
+        try:
+            src_stat = os.stat(src_path)
+        except FileNotFoundError:
+            if os.path.islink(src_path):
+                # A broken symlink
+                return "skipped", 0, None
+            raise
+        if not stat.S_ISREG(src_stat.st_mode):
+            return "skipped", 0, None
+
+        if src_stat.st_size != dst_stat.st_size:
+            return ("mismatch", 0, f"the sizes differ: {src_stat.st_size} bytes in the source, "
+                                   f"and {dst_stat.st_size} bytes in the copy")
+
+        src_digest, src_num_bytes = hash_file_contents(src_path, src_stat.st_size)
+        dst_digest, dst_num_bytes = hash_file_contents(dst_path, dst_stat.st_size)
+    except OSError as e:
+        return "error", 0, str(e)
+
+    if src_digest != dst_digest:
+        return ("mismatch", src_num_bytes + dst_num_bytes,
+                f"the contents differ: SHA-256 {src_digest} in the source, and {dst_digest} in "
+                f"the copy")
+
+    return "match", src_num_bytes + dst_num_bytes, None
+
+
+class ContentVerifyResult:
+    """
+    The result of `verify_copied_contents()`.
+    """
+    def __init__(self):
+        self.file_count = 0  # files whose contents were compared
+        self.byte_count = 0  # bytes read, from the sources and the copies
+        self.skipped_count = 0
+        # (source path, copy path, reason) tuples
+        self.mismatches_list = []
+        self.errors_list = []
+
+    def print(self):
+        print("Content verification:")
+        print(f"  file_count: {self.file_count}")
+        print(f"  bytes read: {progress.format_bytes(self.byte_count)}")
+        print(f"  skipped_count: {self.skipped_count}")
+        print(f"  mismatch_count: {len(self.mismatches_list)}")
+        print(f"  error_count: {len(self.errors_list)}")
+
+    def has_problems(self):
+        return bool(self.mismatches_list or self.errors_list)
+
+    def get_problems_str(self, max_items=None):
+        """
+        Describe all mismatches and errors found, listing up to `max_items` of each kind, or all of
+        them if None.
+        """
+        lines_list = []
+        for title, items_list in [("files don't match their sources", self.mismatches_list),
+                                  ("files could not be compared", self.errors_list)]:
+            if not items_list:
+                continue
+            lines_list.append(f"{len(items_list)} {title}:")
+            for src_path, dst_path, reason in items_list[:max_items]:
+                lines_list.append(f"  \"{dst_path}\"\n    source: \"{src_path}\"\n"
+                                  f"    {reason}")
+            if max_items is not None and len(items_list) > max_items:
+                lines_list.append(f"  ...and {len(items_list) - max_items} more.")
+
+        return "\n".join(lines_list)
+
+    def write(self, file_path, timer=None):
+        """
+        Write all mismatches and errors found to the file at `file_path`, counting it in the
+        `PhaseTimer` `timer`, if given.
+        """
+        with open(file_path, "w") as file:
+            file.write(f"Compared the contents of {self.file_count} copied files with their "
+                       f"sources.\n\n")
+            if self.has_problems():
+                file.write(self.get_problems_str() + "\n")
+            else:
+                file.write("All copied files match their sources.\n")
+        if timer is not None:
+            timer.count("files_written")
+
+    def to_dict(self):
+        return {
+            "file_count": self.file_count,
+            "byte_count": self.byte_count,
+            "skipped_count": self.skipped_count,
+            "mismatches": [list(item) for item in self.mismatches_list],
+            "errors": [list(item) for item in self.errors_list],
+        }
+
+
+def verify_copied_contents(src_dir, dst_dir, paths_copied_set, renames_list, num_threads=8,
+                           progress_reporter=None, parent_dir="", timer=None):
+    """
+    Check that every file copied from `src_dir` into `dst_dir` has the same contents as its
+    source, after the renames in `renames_list`, planned by `plan_paths()`, were made.
+
+    Each file in `dst_dir` is matched with its source using the renames, even if its name, or the
+    names of the dirs it's in, were changed. Then both are hashed with SHA-256, with `num_threads`
+    files being compared at once. `hashlib` releases the GIL while hashing, so the threads hash in
+    parallel, as well as overlapping their reads.
+
+    - paths_copied_set: the paths of all files and dirs in `dst_dir`, beginning with `dst_dir`, as
+      walked before the renames were made, so still with their original names.
+    - parent_dir: the dir which `dst_dir`, and the paths in `paths_copied_set` and `renames_list`,
+      are relative to. "" means the current working dir. `src_dir` is relative to the current
+      working dir.
+    - timer: a `PhaseTimer` to count the files and bytes read in, if given.
+
+    Returns a `ContentVerifyResult` object.
+    """
+    if progress_reporter is None:
+        progress_reporter = progress.ProgressReporter("verify_content", enabled=False)
+
+    # original path of each renamed file or dir --> its new name
+    names_new_dict = {os.path.join(*parent_parts, name_old): name_new
+                      for parent_parts, name_old, name_new in get_dir_renames(renames_list)}
+
+    # Find the new path of each file or dir. Parents sort before their children, so the new path of
+    # each parent dir is always found first.
+    src_paths_list = []
+    dst_paths_list = []
+    paths_new_dict = {}  # original path --> new path
+    for path in sorted(paths_copied_set):
+        dir_path, name = os.path.split(path)
+        path_new = os.path.join(paths_new_dict.get(dir_path, dir_path),
+                                names_new_dict.get(path, name))
+        paths_new_dict[path] = path_new
+
+        src_paths_list.append(src_dir + path[len(dst_dir):])
+        dst_paths_list.append(os.path.join(parent_dir, path_new))
+
+    content_verify_result = ContentVerifyResult()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+        for src_path, dst_path, (status, num_bytes_read, reason) in zip(
+                src_paths_list, dst_paths_list,
+                executor.map(verify_file_contents, src_paths_list, dst_paths_list)):
+            content_verify_result.byte_count += num_bytes_read
+            if status == "skipped":
+                content_verify_result.skipped_count += 1
+            elif status == "error":
+                content_verify_result.errors_list.append((src_path, dst_path, reason))
+            else:
+                content_verify_result.file_count += 1
+                if status == "mismatch":
+                    content_verify_result.mismatches_list.append((src_path, dst_path, reason))
+            progress_reporter.update(num_bytes=num_bytes_read)
+
+    if timer is not None:
+        timer.count("files_read", 2*content_verify_result.file_count)
+        timer.count("bytes_read", content_verify_result.byte_count)
+
+    return content_verify_result
+
+
+def write_broken_symlinks(output_dir, broken_symlinks_list_of_tuples):
+    """
+    Write the `(src, dst, error_str)` tuples of the broken symlinks found by `copy_directory()` to
+    "broken_symlinks.txt" in `output_dir`.
+    """
+    with open (os.path.join(output_dir, "broken_symlinks.txt"), "w") as file:
+        if (len(broken_symlinks_list_of_tuples) > 0):
+            file.write(f"{len(broken_symlinks_list_of_tuples)} broken symlinks found:\n\n")
+
+            i = 0
+            for src, dst, error_str in broken_symlinks_list_of_tuples:
+                file.write(f"{i}:\n")
+                file.write(f"  - src:   {src}\n")
+                file.write(f"  - dst:   {dst}\n")
+                file.write(f"  - error: {error_str}\n")
+                file.write("\n")
+                i += 1
+
+        else:
+            file.write("No broken symlinks found.\n")
+
+
+def write_namefiles_created(output_dir, namefiles_list):
+    """
+    Write the list of namefiles from `write_namefiles()` to "namefiles_created.txt" in
+    `output_dir`.
+    """
+    with open(os.path.join(output_dir, "namefiles_created.txt"), "w") as file:
+        file.write("List of auto-created namefiles:\n\n")
+        for namefile_path in namefiles_list:
+            file.write(f"{namefile_path}\n")
 
 
-    # 4. Print before and after paths. Also write them to files for later `meld` comparison.
+def get_stats_dict(path_stats, path_stats2, path_plan, namefiles_list, optimize,
+                   preflight_result=None, content_verify_result=None):
+    """
+    Get the stats of a run, as written to "stats.json": the `PathStats` before and after fixing,
+    the namefile count, and, if done, the plan counts of `--optimize_plan`, and the results of the
+    preflight check and of `--verify_content`.
+    """
+    stats_dict = {"before": path_stats.to_dict(), "after": path_stats2.to_dict()}
+    if optimize:
+        stats_dict["plan"] = get_plan_counts_dict(path_plan)
+    if preflight_result is not None:
+        stats_dict["preflight"] = preflight_result.to_dict()
+    if content_verify_result is not None:
+        stats_dict["verify_content"] = content_verify_result.to_dict()
+    stats_dict["namefile_count"] = len(namefiles_list)
+    return stats_dict
+
+
+def write_before_and_after_paths(output_dir, paths_original_list, paths_TO_list,
+                                 paths_longest_namefiles_list, timer=None, print_paths=True):
+    """
+    Print the before and after paths, unless `print_paths` is False. Also write them to files,
+    counting them in the `PhaseTimer` `timer`, if given.
 
+    Returns a `(paths_before_filename, paths_after_filename)` tuple.
+    """
     # Write some "about" info
     with open(os.path.join(output_dir, "about.txt"), "w") as file:
         file.write("Paths shorted and fixed by \"eRCaGuy_PathShortener\":\n"
@@ -1105,11 +3882,12 @@ def fix_paths(args, max_path_len_already_used):
     paths_before_filename = os.path.join(output_dir, "paths_list_1_before.txt")
     paths_after_filename  = os.path.join(output_dir, "paths_list_2_after.txt")
 
-    print("\nBefore and after paths:\n"
-        + "Index:        Len: Original path\n"
-        + "   ->         Len: Shortened path\n"
-        + "   namefile:  Len: Longest namefile path, OR the same as the \"shortened path\" if "
-        + "there is no namefile\n")
+    if print_paths:
+        print("\nBefore and after paths:\n"
+            + "Index:        Len: Original path\n"
+            + "   ->         Len: Shortened path\n"
+            + "   namefile:  Len: Longest namefile path, OR the same as the \"shortened path\" if "
+            + "there is no namefile\n")
 
     # Write the before and after paths to files
     with (open(paths_before_filename, "w") as file_before,
@@ -1131,9 +3909,10 @@ def fix_paths(args, max_path_len_already_used):
             TO_path_str = str(Path(*paths_TO_list[i_path]))
             longest_namefile_str = str(Path(*paths_longest_namefiles_list[i_path]))
 
-            print(f"{i_path:4}:        {len(original_path_str):4}: {original_path_str}\n"
-                + f"   ->        {len(TO_path_str):4}: {TO_path_str}\n"
-                + f"   namefile: {len(longest_namefile_str):4}: {longest_namefile_str}\n")
+            if print_paths:
+                print(f"{i_path:4}:        {len(original_path_str):4}: {original_path_str}\n"
+                    + f"   ->        {len(TO_path_str):4}: {TO_path_str}\n"
+                    + f"   namefile: {len(longest_namefile_str):4}: {longest_namefile_str}\n")
 
             file_before.write(f"{i_path:4}: {len(original_path_str):4}: {original_path_str}\n")
             file_after.write(f"{i_path:4}: {len(TO_path_str):4}: {TO_path_str}\n")
@@ -1150,37 +3929,1280 @@ def fix_paths(args, max_path_len_already_used):
             file_after.write(f"{i_path:4}: {len(TO_path_str):4}: {paths_TO_list[i_path]}\n")
 
     # The above files opened via `with` are closed automatically when the `with` block is exited.
+    if timer is not None:
+        timer.count("files_written", 3)
+
+    return paths_before_filename, paths_after_filename
+
+
+class ScanResult:
+    """
+    The result of `PathShortener.scan()`.
+    """
+    def __init__(self, parent_dir, all_paths_set, paths_to_fix_sorted_list, path_stats):
+        # The absolute path of the parent dir of the scanned dir. All of the paths below are
+        # relative to it, and so begin with the name of the scanned dir.
+        self.parent_dir = parent_dir
+        self.all_paths_set = all_paths_set
+        self.paths_to_fix_sorted_list = paths_to_fix_sorted_list
+        self.path_stats = path_stats
+
+
+class PathShortener:
+    """
+    Fix all paths inside of a directory, in place, for use as a library instead of via the CLI.
+
+    Unlike the CLI, this does not copy the directory first, change the working directory, print,
+    or exit. It reads all of its settings from a `config.Settings` object instead of from the
+    globals in 'config.py', and raises a `PathShortenerError` on failure, so many jobs, with
+    different settings, can run in one long-lived process, even at the same time in different
+    threads.
+
+    Since replacing symlinks with real files is done by the CLI's copy, symlinks are left as-is.
+
+    Ex:
+    ```py
+    path_shortener = PathShortener(config.Settings(max_allowed_path_len=150))
+    scan_result = path_shortener.scan("path/to/dir")
+    path_plan = path_shortener.plan(scan_result)
+    namefiles_list = path_shortener.apply(path_plan)
+    ```
+    """
+    def __init__(self, settings=None, num_scan_threads=8, num_jobs=1, executor=None,
+                 optimize=False, path_filter=None, timer=None):
+        """
+        - settings: a `config.Settings` object. Default: the settings in 'config.py'.
+        - num_scan_threads: the number of directories to list at once, while scanning.
+        - num_jobs: the number of worker processes to plan with. See `plan_paths_in_parallel()`.
+        - executor: a `concurrent.futures.ProcessPoolExecutor` to plan on, when `num_jobs` > 1, so
+          that many `PathShortener`s can share one pool of processes. Default: create a new pool
+          for each call to `plan()`.
+        - optimize: plan with `plan_paths_optimized()` instead of `plan_paths()`.
+        - path_filter: a `filters.PathFilter` of the files and dirs to leave as-is, and not even
+          walk. Default: none.
+        - timer: the `PhaseTimer` to count the operations of each call in. Default: a new one, of
+          this `PathShortener`'s own.
+        """
+        if settings is None:
+            settings = config.Settings()
+        if timer is None:
+            timer = PhaseTimer()
+
+        self.settings = settings
+        self.num_scan_threads = num_scan_threads
+        self.num_jobs = num_jobs
+        self.executor = executor
+        self.optimize = optimize
+        self.path_filter = path_filter
+        self.timer = timer
+
+    def scan(self, dir_path):
+        """
+        Walk `dir_path` and find all paths in it which need to be fixed.
+
+        The paths are made relative to the parent dir of `dir_path`, same as the CLI does by
+        changing into that dir, so that only the scanned dir and below count towards the max allowed
+        path length.
+
+        Returns a `ScanResult` object.
+        """
+        dir_path = os.path.abspath(dir_path)
+        if not os.path.isdir(dir_path):
+            raise PathShortenerError(f"Directory \"{dir_path}\" does not exist.")
+
+        parent_dir = os.path.dirname(dir_path)
+        prefix_len = len(os.path.join(parent_dir, ""))  # includes the trailing separator
+        all_paths_set = {path[prefix_len:] for path in walk_directory_concurrently(
+                             dir_path, self.num_scan_threads, self.path_filter, self.timer)}
+
+        paths_to_fix_sorted_list, path_stats = get_paths_to_fix(
+            all_paths_set, keep_symlinks=True, settings=self.settings, timer=self.timer)
+
+        return ScanResult(parent_dir, all_paths_set, paths_to_fix_sorted_list, path_stats)
+
+    def plan(self, scan_result):
+        """
+        Plan how to fix all paths to fix in `scan_result`, without touching the disk other than to
+        check which of them are directories, and which files are hardlinks to the same file. See
+        `get_duplicate_paths_dict()`.
+
+        Returns a `PathPlan` object.
+        """
+        paths_TO_list = [list(Path(path).parts) for path in scan_result.paths_to_fix_sorted_list]
+        is_dir_list = [os.path.isdir(os.path.join(scan_result.parent_dir, path))
+                       for path in scan_result.paths_to_fix_sorted_list]
+        duplicate_paths_dict = get_duplicate_paths_dict(paths_TO_list, is_dir_list,
+                                                        scan_result.parent_dir, self.timer)
+
+        if self.num_jobs > 1:
+            path_plan = plan_paths_in_parallel(
+                paths_TO_list, is_dir_list, self.num_jobs, settings=self.settings,
+                executor=self.executor, optimize=self.optimize,
+                all_paths_set=scan_result.all_paths_set, timer=self.timer,
+                duplicate_paths_dict=duplicate_paths_dict)
+        elif self.optimize:
+            path_plan = plan_paths_optimized(paths_TO_list, is_dir_list, settings=self.settings,
+                                             all_paths_set=scan_result.all_paths_set,
+                                             timer=self.timer,
+                                             duplicate_paths_dict=duplicate_paths_dict)
+        else:
+            path_plan = plan_paths(paths_TO_list, is_dir_list, settings=self.settings,
+                                   all_paths_set=scan_result.all_paths_set, timer=self.timer,
+                                   duplicate_paths_dict=duplicate_paths_dict)
+
+        path_plan.parent_dir = scan_result.parent_dir
+        return path_plan
+
+    def apply(self, path_plan):
+        """
+        Make the renames in `path_plan` on the disk, then write the namefiles for them.
+
+        Returns a list of all namefiles written to disk.
+        """
+        apply_renames_to_disk(path_plan.renames_list, parent_dir=path_plan.parent_dir,
+                              timer=self.timer)
+        return write_namefiles(path_plan.paths_original_list, path_plan.paths_TO_list,
+                               parent_dir=path_plan.parent_dir, timer=self.timer)
+
+
+# The modes a `--serve` job can run in. See `run_job()`.
+JOB_MODES_LIST = ["copy", "in_place", "plan"]
+
+
+def run_job(job_dict, send_progress_event, num_jobs_default=1, num_scan_threads_default=8,
+            executor=None, hooks_list=None):
+    """
+    Run one job sent to the `--serve` daemon. See 'server.py' for the protocol.
+
+    A job request is a JSON object with these keys:
+    - "source_dir" (required): the absolute path of the directory to fix.
+    - "mode": one of:
+      - "copy" (default): same as the CLI: copy "source_dir" to a new dir with the
+        `short_dir_suffix` appended to its name, replacing symlinks with real files unless
+        "keep_symlinks" is true, then fix the paths in the copy.
+      - "in_place": fix the paths in "source_dir" itself, after writing an undo journal for
+        `undo_in_place()`, same as the `--in_place` CLI option.
+      - "plan": only plan the fixes, and return the renames to make, without changing anything.
+    - "settings": a dict of `config.Settings` arguments to override. Ex: `{"hash_len": 4}`.
+    - "keep_symlinks": for the "copy" mode only. Default: false.
+    - "duplicates": for the "copy" mode only: same as the `--duplicates` CLI option. Default:
+      "copy".
+    - "exclude", "include": lists of glob patterns of files and dirs to skip, or to keep, same as
+      the `--exclude` and `--include` CLI options. See 'filters.py'. Default: none.
+    - "preflight": for the "copy" mode only: run `preflight_copy()` before copying, same as the
+      CLI does unless `--no_preflight` is used. Default: true.
+    - "optimize": plan with `plan_paths_optimized()`, same as the `--optimize_plan` CLI option, and
+      add the savings to the result. Default: false.
+    - "verify_content": for the "copy" mode only: check that every copied file has the same
+      contents as its source, with `verify_copied_contents()`, same as the `--verify_content` CLI
+      option. Mismatches fail the job. Default: false.
+    - "verify_threads": same as the `--verify_threads` CLI option. Default: 8.
+    - "verbose": also print the before and after paths, as the CLI always does. Default: false.
+    - "jobs", "scan_threads": same as the `--jobs` and `--scan_threads` CLI options. Default: the
+      values the daemon was started with.
+
+    executor: a `concurrent.futures.ProcessPoolExecutor` shared by all jobs, to plan on when
+    "jobs" > 1. See `PathShortener`.
+
+    hooks_list: event hooks to add to the `PhaseTimer` of this job only, so that they get the
+    events of this job, and not those of any other jobs running at once. See
+    `PhaseTimer.add_hook()`. They are removed again when the job ends. Default: none.
+
+    Except in the "plan" mode, the same logs as the CLI writes are written into the output dir
+    inside of the dir fixed, even if the job fails its final checks, other than
+    "before_and_after_paths.txt", the copy of what the CLI prints. Its path stats are in
+    "stats.json" too.
+
+    Calls `send_progress_event()` with a dict at the end of each phase, and returns a result dict.
+    Raises a `PathShortenerError` if the job fails.
+    """
+    source_dir = job_dict.get("source_dir")
+    if not isinstance(source_dir, str) or not os.path.isabs(source_dir):
+        raise PathShortenerError("\"source_dir\" must be an absolute path.")
+    source_dir = source_dir.rstrip("/")
+
+    mode = job_dict.get("mode", "copy")
+    if mode not in JOB_MODES_LIST:
+        raise PathShortenerError(f"\"mode\" must be one of {JOB_MODES_LIST}, not \"{mode}\".")
+
+    try:
+        settings = config.Settings(**job_dict.get("settings", {}))
+    except TypeError as e:
+        raise PathShortenerError(f"Invalid \"settings\": {e}") from e
+
+    patterns_lists_dict = {key: job_dict.get(key, []) for key in ("exclude", "include")}
+    for key, patterns_list in patterns_lists_dict.items():
+        if (not isinstance(patterns_list, list)
+                or not all(isinstance(pattern, str) for pattern in patterns_list)):
+            raise PathShortenerError(f"\"{key}\" must be a list of glob patterns.")
+    path_filter = filters.PathFilter(patterns_lists_dict["exclude"],
+                                     patterns_lists_dict["include"])
+
+    if hooks_list is None:
+        hooks_list = []
+
+    # This job's own timer, so that jobs running at once don't mix up their counts
+    timer = PhaseTimer()
+    path_shortener = PathShortener(
+        settings,
+        num_scan_threads=job_dict.get("scan_threads", num_scan_threads_default),
+        num_jobs=job_dict.get("jobs", num_jobs_default),
+        executor=executor,
+        optimize=job_dict.get("optimize", False),
+        path_filter=path_filter,
+        timer=timer)
+
+    def send_phase_done_event(phase_stats, **counts_dict):
+        send_progress_event({"phase": phase_stats.name, "elapsed_sec": phase_stats.wall_time_sec,
+                             **counts_dict})
+
+    for hook in hooks_list:
+        timer.add_hook(hook)
+    try:
+        dir_to_fix = source_dir
+        preflight_result = None
+        broken_symlinks_list_of_tuples = []
+        if mode == "copy":
+            if not settings.short_dir_suffix:
+                raise PathShortenerError("\"short_dir_suffix\" must not be empty in the \"copy\" "
+                                         "mode. Use the \"in_place\" mode instead.")
+            dir_to_fix = source_dir + settings.short_dir_suffix
+            copy_args = argparse.Namespace(
+                keep_symlinks=job_dict.get("keep_symlinks", False), progress=False,
+                duplicates=job_dict.get("duplicates", "copy"), path_filter=path_filter)
+            if copy_args.duplicates not in DUPLICATES_MODES_LIST:
+                raise PathShortenerError(f"\"duplicates\" must be one of "
+                                         f"{DUPLICATES_MODES_LIST}, not "
+                                         f"\"{copy_args.duplicates}\".")
+            if job_dict.get("preflight", True):
+                with timer.phase("preflight") as phase_stats:
+                    preflight_result = preflight_copy(source_dir, dir_to_fix,
+                                                      copy_args.keep_symlinks,
+                                                      path_shortener.num_scan_threads,
+                                                      duplicates_mode=copy_args.duplicates,
+                                                      path_filter=path_filter, timer=timer)
+                send_phase_done_event(phase_stats, entry_count=preflight_result.entry_count,
+                                      byte_count=preflight_result.byte_count)
+            with timer.phase("copy") as phase_stats:
+                broken_symlinks_list_of_tuples = copy_directory(source_dir, dir_to_fix, copy_args,
+                                                                timer=timer)
+            send_phase_done_event(phase_stats,
+                                  broken_symlink_count=len(broken_symlinks_list_of_tuples))
+
+        with timer.phase("scan") as phase_stats:
+            scan_result = path_shortener.scan(dir_to_fix)
+        send_phase_done_event(phase_stats,
+                              total_path_count=scan_result.path_stats.total_path_count,
+                              paths_to_fix_count=scan_result.path_stats.paths_to_fix_count)
+
+        with timer.phase("plan") as phase_stats:
+            path_plan = path_shortener.plan(scan_result)
+        send_phase_done_event(phase_stats, rename_count=len(path_plan.renames_list))
+
+        result_dict = {
+            "mode": mode,
+            "source_dir": source_dir,
+            "dir_fixed": dir_to_fix,
+            "path_stats": scan_result.path_stats.to_dict(),
+            "rename_count": len(path_plan.renames_list),
+        }
+        if path_shortener.optimize:
+            result_dict["plan"] = get_plan_counts_dict(path_plan)
+
+        if mode == "plan":
+            result_dict["renames"] = [[str(path_chunk_old), str(path_chunk_new)]
+                                      for path_chunk_old, path_chunk_new in path_plan.renames_list]
+            return result_dict
+
+        output_dir = os.path.join(dir_to_fix, OUTPUT_DIR_NAME)
+        with timer.phase("apply") as phase_stats:
+            if mode == "in_place":
+                result_dict["undo_journal"] = write_undo_journal(
+                    os.path.basename(dir_to_fix), path_plan.renames_list, path_plan.parent_dir,
+                    timer)
+            namefiles_list = path_shortener.apply(path_plan)
+        send_phase_done_event(phase_stats, namefile_count=len(namefiles_list))
+        result_dict["namefile_count"] = len(namefiles_list)
+
+        # Double-check that all paths are now fixed, same as the CLI does
+        with timer.phase("verify") as phase_stats:
+            scan_result2 = path_shortener.scan(dir_to_fix)
+        send_phase_done_event(phase_stats,
+                              paths_to_fix_count=scan_result2.path_stats.paths_to_fix_count)
+        result_dict["path_stats_after"] = scan_result2.path_stats.to_dict()
+
+        # Made after the final check above, so that the logs don't count towards it
+        os.makedirs(output_dir, exist_ok=True)
+        content_verify_result = None
+        if mode == "copy" and job_dict.get("verify_content", False):
+            with timer.phase("verify_content") as phase_stats:
+                content_verify_result = verify_copied_contents(
+                    source_dir, os.path.basename(dir_to_fix), scan_result.all_paths_set,
+                    path_plan.renames_list, job_dict.get("verify_threads", 8),
+                    parent_dir=path_plan.parent_dir, timer=timer)
+                content_verify_result.write(
+                    os.path.join(output_dir, CONTENT_MISMATCHES_FILENAME), timer)
+            send_phase_done_event(phase_stats, file_count=content_verify_result.file_count,
+                                  byte_count=content_verify_result.byte_count)
+            result_dict["verify_content"] = content_verify_result.to_dict()
+
+        # Write the same reports and stats as `fix_paths()` does
+        with timer.phase("report") as phase_stats:
+            write_broken_symlinks(output_dir, broken_symlinks_list_of_tuples)
+            write_namefiles_created(output_dir, namefiles_list)
+            write_before_and_after_paths(
+                output_dir, path_plan.paths_original_list, path_plan.paths_TO_list,
+                path_plan.paths_longest_namefiles_list, timer,
+                print_paths=job_dict.get("verbose", False))
+            diff_report.write_diff_report(output_dir, diff_report.group_renames_by_dir(
+                get_dir_renames(path_plan.renames_list)))
+            stats_dict = get_stats_dict(
+                scan_result.path_stats, scan_result2.path_stats, path_plan, namefiles_list,
+                path_shortener.optimize, preflight_result, content_verify_result)
+            with open(os.path.join(output_dir, "stats.json"), "w") as file:
+                json.dump(stats_dict, file, indent=4)
+            timer.count("files_written", 7)
+        send_phase_done_event(phase_stats)
+
+        success = (scan_result2.path_stats.paths_to_fix_count == 0
+                   and (content_verify_result is None or not content_verify_result.has_problems()))
+        run_metrics = get_run_metrics(
+            argparse.Namespace(base_dir=os.path.basename(source_dir), run_stats_dict=stats_dict),
+            success, timer)
+        run_metrics.write(prom_path=os.path.join(output_dir, "metrics.prom"),
+                          json_path=os.path.join(output_dir, "metrics.json"))
+
+        if scan_result2.path_stats.paths_to_fix_count > 0:
+            raise PathTooLongError(
+                f"{scan_result2.path_stats.paths_to_fix_count} paths in \"{dir_to_fix}\" still "
+                f"need fixing after shortening. Run this job again on that dir.")
+        if content_verify_result is not None and content_verify_result.has_problems():
+            raise PathShortenerError(
+                f"Not all files copied into \"{dir_to_fix}\" match their sources.\n"
+                + content_verify_result.get_problems_str(MAX_CONTENT_MISMATCHES_TO_PRINT))
+
+        return result_dict
+
+    finally:
+        # A hook which raised was already removed by `PhaseTimer.send_event()`
+        for hook in hooks_list:
+            if hook in timer.hooks_list:
+                timer.remove_hook(hook)
+
+
+def get_plan_counts_dict(path_plan):
+    """
+    Get the rename and namefile counts of a plan from `plan_paths_optimized()`, and of the greedy
+    plan it was compared to, as a dict.
+    """
+    return {
+        "rename_count": path_plan.rename_count,
+        "namefile_count": path_plan.namefile_count,
+        "greedy_rename_count": path_plan.greedy_rename_count,
+        "greedy_namefile_count": path_plan.greedy_namefile_count,
+    }
+
+
+def print_plan_savings(path_plan):
+    """
+    Print how many fewer renames and namefiles a plan from `plan_paths_optimized()` needs than the
+    greedy plan from `plan_paths()`.
+    """
+    if path_plan.rename_count is None:
+        return
+
+    print(f"Optimized plan: {path_plan.rename_count} renames and {path_plan.namefile_count} "
+          f"namefiles.")
+    if path_plan.greedy_rename_count is None:
+        print("  The default (greedy) plan could not shorten all paths enough.")
+        return
+
+    print(f"  Default plan:   {path_plan.greedy_rename_count} renames and "
+          f"{path_plan.greedy_namefile_count} namefiles.")
+    print(f"  Saved:          {path_plan.greedy_rename_count - path_plan.rename_count} renames and "
+          f"{path_plan.greedy_namefile_count - path_plan.namefile_count} namefiles.")
+
+
+def plan_paths_with_args(paths_TO_list, is_dir_list, args, progress_reporter=None, settings=None,
+                         executor=None, all_paths_set=None, timer=None,
+                         duplicate_paths_dict=None):
+    """
+    Plan with `plan_paths_in_parallel()`, `plan_paths_optimized()`, or `plan_paths()`, as chosen
+    by the `--jobs` and `--optimize_plan` CLI options in `args`.
+
+    Returns a `PathPlan` object.
+    """
+    if args.jobs > 1:
+        return plan_paths_in_parallel(
+            paths_TO_list, is_dir_list, args.jobs, args.verbose, progress_reporter, settings,
+            executor=executor, optimize=args.optimize_plan, all_paths_set=all_paths_set,
+            timer=timer, duplicate_paths_dict=duplicate_paths_dict)
+    elif args.optimize_plan:
+        return plan_paths_optimized(
+            paths_TO_list, is_dir_list, args.verbose, progress_reporter, settings, all_paths_set,
+            timer, duplicate_paths_dict)
+    else:
+        return plan_paths(paths_TO_list, is_dir_list, args.verbose, progress_reporter, settings,
+                          all_paths_set, timer, duplicate_paths_dict)
+
+
+def fix_paths(args, max_path_len_already_used, settings, timer=None):
+    """
+    Fix the paths in `paths_to_fix_sorted_list`:
+
+    1. Replace symlinks with real files.
+    2. Replace illegal Windows characters with valid ones.
+    3. Shorten the paths to a length that is acceptable on Windows.
+
+    all_paths_set: a set of all original paths in the directory
+
+    paths_original_list   # how the paths first were before doing any renaming
+    paths_FROM_list       # rename paths FROM this
+    paths_TO_list         # rename paths TO this
+    # (removed) paths_noillegals_list # how the paths will look after removing illegal chars,
+                          # but withOUT shortening
+    paths_longest_namefiles_list # A list of the right-most namefiles ONLY, where namefiles are the
+                          #   "my_file_name@ABCD_NAME.txt" and
+                          #   "my_dir_name@ABCD/!my_dir_name@ABCD_NAME.txt" type
+                          #   files which will store the full name of the original
+                          #   file or dir prior to removing illegal chars or shortening.
+                          # - Only the right-most namefiles are needed in this list since
+                          #   they are the longest ones in any given path which will
+                          #   determine the max path length for that path.
+                          # - The path is still stored as a list of path elements, same as the
+                          #   other lists above.
+
+    settings: a `config.Settings` object.
+
+    timer: the `PhaseTimer` of this run, to time its phases in. Default: a new one.
+    """
+    if timer is None:
+        timer = PhaseTimer()
+
+    shortened_dir = args.base_dir + settings.short_dir_suffix
+    preflight_result = None
+    broken_symlinks_list_of_tuples = []
+    if args.in_place:
+        # With '--in_place', the settings have no `short_dir_suffix`, so the dir fixed is `dir`
+        # itself, and nothing is copied.
+        print(f"\nFixing \"{shortened_dir}\" in place, without copying it...")
+    else:
+        if args.preflight:
+            print("\nChecking the source directory before copying it...")
+            with timer.phase("preflight"):
+                preflight_result = preflight_copy(args.base_dir, shortened_dir,
+                                                  args.keep_symlinks, args.scan_threads,
+                                                  duplicates_mode=args.duplicates,
+                                                  path_filter=args.path_filter, timer=timer)
+            preflight_result.print()
+
+        # Note: this also automatically fixes the symlinks by replacing them with real files.
+        print("\nCopying files to a new directory...")
+        with timer.phase("copy"):
+            broken_symlinks_list_of_tuples = copy_directory(args.base_dir, shortened_dir, args,
+                                                            timer=timer)
+
+    # The copy already left out what the filters exclude, but fixing in place does not. Only
+    # fixing in place can use the path list, since the copy is a new dir.
+    paths_all_set, paths_to_fix_sorted_list, path_stats = walk_dir_and_exit_if_done(
+        shortened_dir, args.keep_symlinks, args.scan_threads, settings,
+        path_filter=args.path_filter, types_dict=args.path_types_dict, timer=timer)
+
+    output_dir = os.path.join(shortened_dir, OUTPUT_DIR_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Write the broken symlinks to a file
+    write_broken_symlinks(output_dir, broken_symlinks_list_of_tuples)
+
+    # # debugging
+    # print("\nPaths all set:")
+    # for path in paths_all_set:
+    #     print(path)
+
+    # Copy the sorted list into a regular list of parts (lists) to operate on.
+    # - Paths will be renamed TO this.
+    paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
+
+    # fix the root path
+
+    for path in paths_TO_list:
+        path[0] = shortened_dir
+
+    # # debugging
+    # print("\nPaths TO list:", end="")
+    # print_paths_list(paths_TO_list)
+
+    print()
+
+    # 1. Plan how to fix all paths (illegal Windows characters and path length), then make those
+    #    changes on the disk.
+    with timer.phase("plan"):
+        # Record whether or not each path is a directory, before anything gets renamed, so that
+        # planning does not need to touch the disk.
+        # The path list has no inodes, so only the hardlinks found on disk share their naming
+        duplicate_paths_dict = None
+        if args.path_types_dict is not None:
+            is_dir_list = [args.path_types_dict[path] == "d" for path in paths_to_fix_sorted_list]
+        else:
+            is_dir_list = [paths.is_dir(path) for path in paths_TO_list]
+            timer.count("stat_calls", len(paths_TO_list))
+            duplicate_paths_dict = get_duplicate_paths_dict(paths_TO_list, is_dir_list,
+                                                            timer=timer)
+
+        progress_reporter = progress.ProgressReporter(
+            "plan", total_entries=len(paths_TO_list), enabled=args.progress)
+        path_plan = plan_paths_with_args(
+            paths_TO_list, is_dir_list, args, progress_reporter, settings,
+            all_paths_set=paths_all_set, timer=timer, duplicate_paths_dict=duplicate_paths_dict)
+        progress_reporter.finish()
+
+    if args.optimize_plan:
+        print_plan_savings(path_plan)
+
+    paths_original_list = path_plan.paths_original_list
+    paths_longest_namefiles_list = path_plan.paths_longest_namefiles_list
+
+    if args.in_place:
+        journal_path = write_undo_journal(shortened_dir, path_plan.renames_list, timer=timer)
+        print(f"Undo journal written to \"{journal_path}\". To undo this run, run this tool "
+              f"again on the same dir with '--undo'.")
+
+    with timer.phase("rename"):
+        progress_reporter = progress.ProgressReporter(
+            "rename", total_entries=len(path_plan.renames_list), enabled=args.progress)
+        apply_renames_to_disk(path_plan.renames_list, progress_reporter, timer=timer)
+        progress_reporter.finish()
+
+    # 2. AFTER shortening & renaming all paths above on the disk, write the namefiles to the disk.
+    with timer.phase("namefiles"):
+        progress_reporter = progress.ProgressReporter(
+            "namefiles", total_entries=len(paths_TO_list), enabled=args.progress)
+        namefiles_list = write_namefiles(paths_original_list, paths_TO_list, progress_reporter,
+                                         timer=timer)
+        progress_reporter.finish()
+
+        # Write the list of namefiles to a logfile
+        write_namefiles_created(output_dir, namefiles_list)
+
+    print("\n")
+
+    # debugging
+    if args.verbose:
+        print("\nPrinting paths_longest_namefiles_list:")
+        print_paths_list(paths_longest_namefiles_list)
+        print()
+
+
+    # 3. Double-check that all paths are now valid and short enough by walking the directory tree
+    #    and checking each path length one last time.
+    # - also log some of the stats
+
+    with timer.phase("verify"):
+        if args.path_types_dict is not None:
+            # Find the paths from the plan instead of walking the dir again, same as before fixing
+            all_paths_set2 = get_paths_after_renames(
+                paths_all_set, get_dir_renames(path_plan.renames_list))
+            all_paths_set2.update(str(namefile_path) for namefile_path in namefiles_list)
+        else:
+            all_paths_set2 = walk_directory_concurrently(shortened_dir, args.scan_threads,
+                                                         args.path_filter, timer)
+        paths_to_fix_sorted_list2, path_stats2 = get_paths_to_fix(
+            all_paths_set2, args.keep_symlinks, settings=settings, timer=timer)
+
+    content_verify_result = None
+    if args.verify_content:
+        print("Verifying the contents of the copied files...")
+        with timer.phase("verify_content"):
+            progress_reporter = progress.ProgressReporter(
+                "verify_content", total_entries=len(paths_all_set), enabled=args.progress)
+            content_verify_result = verify_copied_contents(
+                args.base_dir, shortened_dir, paths_all_set, path_plan.renames_list,
+                args.verify_threads, progress_reporter, timer=timer)
+            progress_reporter.finish()
+            content_verify_result.write(os.path.join(output_dir, CONTENT_MISMATCHES_FILENAME),
+                                        timer)
+
+    before_and_after_filename = os.path.join(output_dir, "before_and_after_paths.txt")
+
+    # begin tee-ing the output to a file
+    tee = Tee.Tee(before_and_after_filename)
+    tee.begin()
+
+    print("BEFORE fixing and shortening paths:")
+    path_stats.print()
+    print()
+    print("AFTER fixing and shortening paths:")
+    path_stats2.print()
+    print()
+
+    if len(paths_to_fix_sorted_list2) == 0:
+        colors.print_green("Path fixing and shortening has been successful!\n"
+            "All paths are now fixed for Windows (illegal chars removed, no symlinks if "
+            "'--keep_symlinks' was NOT used, and short enough).")
+    else:
+        colors.print_red("Error: some paths are still too long after shortening.")
+        print_paths_to_fix(paths_to_fix_sorted_list2)
+        colors.print_red("Saying again: Error: some paths are still too long after shortening.")
+        colors.print_blue("As an intermedite work-around until I can fix this better, run "
+            "this tool again on the shortened directory.")
+        # colors.print_blue("OR use the `--keep_symlinks` flag to keep symlinks as symlinks, on the "
+        #     "first run, to avoid this issue until I can fix it properly.")
+        colors.print_blue("TODO: gracefully handle this instead of exiting here.")
+        colors.print_red("Exiting.")
+        exit(EXIT_FAILURE)
+
+    print("\nMore length stats:")
+    print(f"  Max allowed path len:   {path_stats2.max_allowed_path_len} chars")
+    print(f"  Max len BEFORE:         {path_stats.max_len} + {max_path_len_already_used} = "
+        + f"{path_stats.max_len + max_path_len_already_used}")
+    print(f"  Max len AFTER:          {path_stats2.max_len}")
+    # Get the max length of the namefiles
+    max_namefile_len = max([len(str(Path(*path))) for path in paths_longest_namefiles_list])
+    print(f"  Max namefile len AFTER: {max_namefile_len}")
+
+    if content_verify_result is not None:
+        print()
+        content_verify_result.print()
+        if content_verify_result.has_problems():
+            colors.print_red("Error: " + content_verify_result.get_problems_str(
+                MAX_CONTENT_MISMATCHES_TO_PRINT))
+        else:
+            colors.print_green("All copied files match their sources.")
+
+
+    # 4. Print before and after paths, and write them to files. Also write the much smaller
+    #    report of only the renamed names, for `meld` comparison.
+    with timer.phase("report"):
+        write_before_and_after_paths(
+            output_dir, paths_original_list, paths_TO_list, paths_longest_namefiles_list, timer)
+        renames_by_dir_dict = diff_report.group_renames_by_dir(
+            get_dir_renames(path_plan.renames_list))
+        renames_before_filename, renames_after_filename = diff_report.write_diff_report(
+            output_dir, renames_by_dir_dict)
+        timer.count("files_written", 4)
+
+    print(f"\n{sum(len(renames_list) for renames_list in renames_by_dir_dict.values())} files "
+          f"and dirs were renamed, in {len(renames_by_dir_dict)} dirs. See them side by side in "
+          f"\"{os.path.join(output_dir, diff_report.RENAMES_HTML_FILENAME)}\".")
+
+    # Print how long each phase took, and write it, along with the before and after path stats,
+    # to a JSON file too, for other programs to read.
+    path_stats.phase_stats_list = timer.phase_stats_list
+    print()
+    path_stats.print_phase_stats()
+    if args.mem_report:
+        print()
+        path_stats.print_mem_stats()
 
     tee.end()  # end tee-ing the output to a file
 
+    stats_dict = get_stats_dict(path_stats, path_stats2, path_plan, namefiles_list,
+                                args.optimize_plan, preflight_result, content_verify_result)
+    with open(os.path.join(output_dir, "stats.json"), "w") as file:
+        json.dump(stats_dict, file, indent=4)
+
+    # Also write the metrics of the run, for monitoring
+    args.run_stats_dict = stats_dict
+    run_metrics = get_run_metrics(
+        args, success=content_verify_result is None or not content_verify_result.has_problems(),
+        timer=timer)
+    run_metrics.write(prom_path=os.path.join(output_dir, "metrics.prom"),
+                      json_path=os.path.join(output_dir, "metrics.json"))
+
 
     # 5. Perform the `meld` comparison
 
     if args.meld:
-        print("\n'meld'-comparing the original and shortened directories...\n"
-        + f"  Original:  {args.base_dir}/\n"
-        + f"  Shortened: {shortened_dir}/\n"
+        print("\n'meld'-comparing the original and shortened names of the renamed files and "
+        + "dirs...\n"
+        + f"  Original:  {renames_before_filename}\n"
+        + f"  Shortened: {renames_after_filename}\n"
         + f"NB: IN MELD, BE SURE TO CLICK THE \"Keep highlighting\" BUTTON AT THE TOP!\n"
         + f"Manually close 'meld' to continue.\n"
         )
-        subprocess.run(["meld", paths_before_filename, paths_after_filename], check=True)
+        subprocess.run(["meld", renames_before_filename, renames_after_filename], check=True)
 
+    if content_verify_result is not None and content_verify_result.has_problems():
+        colors.print_red(f"Error: not all copied files match their sources. See "
+                         f"\"{os.path.join(output_dir, CONTENT_MISMATCHES_FILENAME)}\".")
+        exit(EXIT_FAILURE)
 
     return output_dir
 
 
+def get_run_metrics(args, success, timer):
+    """
+    Get the metrics of this run, from the stats of its phases so far in its `PhaseTimer` `timer`,
+    and from the stats written to 'stats.json' by `fix_paths()`, if it got that far.
+
+    Returns a `metrics.Metrics` object.
+    """
+    run_metrics = metrics.Metrics(labels_dict={"dir": args.base_dir})
+    run_metrics.add("run_success", success, "1 if the run completed successfully, else 0.")
+    run_metrics.add("run_timestamp_seconds", time.time(), "Unix time at the end of the run.")
+    run_metrics.add("run_duration_seconds", time.time() - timer.time_start,
+                    "Wall time of the whole run.")
+
+    op_counts = collections.Counter()
+    for phase_stats in timer.phase_stats_list:
+        labels_dict = {"phase": phase_stats.name}
+        run_metrics.add("phase_duration_seconds", phase_stats.wall_time_sec,
+                        "Wall time of each phase.", labels_dict)
+        run_metrics.add("phase_cpu_seconds", phase_stats.cpu_time_sec,
+                        "CPU time of each phase, including child processes.", labels_dict)
+        for op_name, count in phase_stats.op_counts_dict.items():
+            run_metrics.add("phase_operations", count, "Operations done in each phase: dirs "
+                            "listed, stat calls, files and bytes copied, renames, files written, "
+                            "etc.", {**labels_dict, "operation": op_name})
+        op_counts.update(phase_stats.op_counts_dict)
+
+    run_metrics.add("bytes_copied", op_counts["bytes_copied"], "Bytes of file data copied.")
+    run_metrics.add("files_copied", op_counts["files_copied"], "Files copied.")
+    run_metrics.add("renames", op_counts["renames"], "Files and dirs renamed.")
+    run_metrics.add("name_collisions_resolved",
+                    op_counts["names_lengthened"] + op_counts["names_counter_suffixed"],
+                    "New names which would have collided with another name in the same dir, and "
+                    "were made unique instead.")
+
+    stats_dict = getattr(args, "run_stats_dict", None)
+    if stats_dict is None:
+        return run_metrics
+
+    run_metrics.add("namefiles", stats_dict["namefile_count"], "Namefiles written.")
+    for stage in ["before", "after"]:
+        path_stats_dict = stats_dict[stage]
+        run_metrics.add("max_path_len", path_stats_dict["max_len"],
+                        "Length of the longest path, before and after fixing.", {"stage": stage})
+        for kind in ["total", "too_long", "symlink", "illegal_windows_char", "to_fix"]:
+            count_name = "paths_to_fix_count" if kind == "to_fix" else f"{kind}_path_count"
+            run_metrics.add("paths", path_stats_dict[count_name], "Paths of each kind, before "
+                            "and after fixing.", {"stage": stage, "kind": kind})
+
+    if "preflight" in stats_dict:
+        run_metrics.add("preflight_bytes_to_copy", stats_dict["preflight"]["byte_count"],
+                        "Bytes to copy, found by the preflight check.")
+    if "verify_content" in stats_dict:
+        verify_content_dict = stats_dict["verify_content"]
+        run_metrics.add("content_mismatches", len(verify_content_dict["mismatches"]),
+                        "Copied files whose contents don't match their sources.")
+        run_metrics.add("content_verify_errors", len(verify_content_dict["errors"]),
+                        "Copied files which could not be compared with their sources.")
+
+    return run_metrics
+
+
+@contextlib.contextmanager
+def monitor_run(args, timer):
+    """
+    Append the events of the `PhaseTimer` `timer` of the run inside this context to
+    `args.events_file`, and write its metrics to `args.metrics_file`, if given, even if it fails or
+    exits early.
+    """
+    with contextlib.ExitStack() as exit_stack:
+        events_hook = None
+        if args.events_file:
+            events_file = exit_stack.enter_context(open(args.events_file, "a", buffering=1))
+
+            def events_hook(event_dict):
+                events_file.write(json.dumps(event_dict) + "\n")
+            timer.add_hook(events_hook)
+
+        success = False
+        try:
+            yield
+            success = True
+        except SystemExit as e:
+            success = e.code in (None, EXIT_SUCCESS)
+            raise
+        finally:
+            # Only this hook, so that any others added to `timer` by the caller are kept. A hook
+            # which raised was already removed by `PhaseTimer.send_event()`.
+            if events_hook in timer.hooks_list:
+                timer.remove_hook(events_hook)
+            if args.metrics_file:
+                get_run_metrics(args, success, timer).write(prom_path=args.metrics_file)
+
+
+def remove_path(path):
+    """
+    Remove a file, symlink, or a whole directory tree.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class ShortDirSyncer:
+    """
+    Keep `<dir>_short` in sync with `dir`, one top-level entry of `dir` at a time, for `--watch`.
+
+    Each top-level entry is copied into an otherwise-empty staging copy of `<dir>_short`, fixed
+    there, and then the results are swapped in for the old ones. Since each top-level subtree is
+    fixed independently of all others (see `partition_rows_by_subtree()`), and the staging copy has
+    the same name, this gives the same results as fixing all of `dir` at once.
+    """
+    def __init__(self, args, settings):
+        self.source_dir = args.base_dir
+        self.short_dir = args.base_dir + settings.short_dir_suffix
+        self.output_dir = os.path.join(self.short_dir, OUTPUT_DIR_NAME)
+        self.staging_parent_dir = os.path.join(self.output_dir, "watch_staging")
+        self.staging_dir = os.path.join(self.staging_parent_dir, self.short_dir)
+
+        self.copy_args = argparse.Namespace(keep_symlinks=args.keep_symlinks, progress=False,
+                                            duplicates=args.duplicates,
+                                            path_filter=args.path_filter)
+        self.preflight = args.preflight
+        self.path_shortener = PathShortener(settings, args.scan_threads, args.jobs,
+                                            optimize=args.optimize_plan,
+                                            path_filter=args.path_filter)
+        # top-level name in the source dir --> list of top-level names it was fixed to in the short
+        # dir, including its namefiles
+        self.output_names_dict = {}
+
+    def start(self):
+        """
+        Create the short dir, and fix all top-level entries of the source dir into it.
+        """
+        if os.path.exists(self.short_dir):
+            raise PathShortenerError(f"Destination directory \"{self.short_dir}\" already "
+                                     f"exists.\nYou may need to manually remove that directory.")
+
+        os.makedirs(self.output_dir)
+        self.sync(set(os.listdir(self.source_dir)))
+
+    def sync(self, names_set):
+        """
+        Re-fix the top-level entries of the source dir named in `names_set`, which were added,
+        changed, or removed. Errors are printed, so that one bad entry doesn't stop the watch.
+        """
+        time_start = time.perf_counter()
+
+        # Also catch any removals which were missed
+        names_set = set(names_set) | {
+            name for name in self.output_names_dict
+            if not os.path.lexists(os.path.join(self.source_dir, name))}
+
+        num_errors = 0
+        for name in sorted(names_set):
+            try:
+                self.sync_entry(name)
+            except (PathShortenerError, OSError) as e:
+                num_errors += 1
+                colors.print_red(f"Error: cannot sync \"{name}\": {e}")
+
+        print(f"Synced {len(names_set)} top-level entries in "
+              f"{time.perf_counter() - time_start:.3f} sec, with {num_errors} errors.", flush=True)
+
+    def sync_entry(self, name):
+        """
+        Re-fix the top-level entry `name` of the source dir into the short dir, or remove it from
+        the short dir if it no longer exists in the source dir.
+        """
+        output_names_list = []
+
+        if os.path.lexists(os.path.join(self.source_dir, name)):
+            # 1. Copy just this entry into an empty staging copy of the short dir, and fix it there
+            if os.path.lexists(self.staging_parent_dir):
+                shutil.rmtree(self.staging_parent_dir)
+            os.makedirs(self.staging_parent_dir)
+
+            if self.preflight:
+                preflight_copy(self.source_dir, self.staging_dir, self.copy_args.keep_symlinks,
+                               self.path_shortener.num_scan_threads, only_names_set={name},
+                               duplicates_mode=self.copy_args.duplicates,
+                               path_filter=self.copy_args.path_filter,
+                               timer=self.path_shortener.timer)
+            copy_directory(self.source_dir, self.staging_dir, self.copy_args,
+                           only_names_set={name}, timer=self.path_shortener.timer)
+            path_plan = self.path_shortener.plan(self.path_shortener.scan(self.staging_dir))
+            self.path_shortener.apply(path_plan)
+
+            scan_result = self.path_shortener.scan(self.staging_dir)
+            if scan_result.path_stats.paths_to_fix_count > 0:
+                raise PathTooLongError(f"{scan_result.path_stats.paths_to_fix_count} paths still "
+                                       f"need fixing after shortening.")
+
+            output_names_list = os.listdir(self.staging_dir)
+
+        # 2. Swap the old results out, and the new ones in
+        for output_name in self.output_names_dict.pop(name, []):
+            remove_path(os.path.join(self.short_dir, output_name))
+
+        for output_name in output_names_list:
+            if os.path.lexists(os.path.join(self.short_dir, output_name)):
+                raise NameCollisionError(
+                    f"\"{output_name}\" already exists in \"{self.short_dir}\", from another "
+                    f"entry.\n" + HASH_LEN_RECOMMENDATION)
+
+        for output_name in output_names_list:
+            os.rename(os.path.join(self.staging_dir, output_name),
+                      os.path.join(self.short_dir, output_name))
+
+        if output_names_list:
+            self.output_names_dict[name] = output_names_list
+
+
+def watch_and_sync(args, settings):
+    """
+    Fix `args.base_dir` into `<dir>_short`, then keep it in sync as `args.base_dir` changes, until
+    interrupted with Ctrl + C.
+    """
+    short_dir_syncer = ShortDirSyncer(args, settings)
+
+    print(f"Fixing \"{args.base_dir}\" into \"{short_dir_syncer.short_dir}\"...", flush=True)
+    short_dir_syncer.start()
+
+    watcher = watch.make_watcher(args.base_dir, args.poll, args.poll_interval_sec)
+    print(f"Watching \"{args.base_dir}\" for changes, with {type(watcher).__name__}. "
+          f"Press Ctrl + C to stop.", flush=True)
+    try:
+        watch.watch_for_changes(watcher, short_dir_syncer.sync, args.debounce_sec)
+    except KeyboardInterrupt:
+        print("\nStopped watching.")
+    finally:
+        watcher.close()
+
+
+def fix_paths_in_batch(args):
+    """
+    Fix the paths in each of the dirs in `args.dirs_list`, the same way as `fix_paths()` does for a
+    single dir: copy the dir to a new dir with the `SHORT_DIR_SUFFIX` appended to its name, then
+    fix the paths in the copy, or, with `args.in_place`, fix the paths in the dir itself.
+
+    Up to `args.roots_in_flight` dirs are fixed at once, all planning on one shared pool of
+    `args.jobs` processes. A failure in one dir is reported, but does not stop the others. Each
+    dir gets the same logs in its output dir as a single dir does, as written by `run_job()`, but
+    only prints its before and after paths with `args.verbose`, since the dirs fixed at once would
+    mix them up.
+
+    Returns True if all dirs were fixed successfully.
+    """
+    num_dirs = len(args.dirs_list)
+    print(f"Fixing {num_dirs} dirs, up to {args.roots_in_flight} at once...\n")
+
+    path_stats_before_list = []
+    path_stats_after_list = []
+    failed_dirs_list = []  # a list of (dir, error) tuples
+
+    def fix_dir(source_dir, executor):
+        job_dict = {"source_dir": source_dir, "mode": "in_place" if args.in_place else "copy",
+                    "keep_symlinks": args.keep_symlinks,
+                    "optimize": args.optimize_plan, "preflight": args.preflight,
+                    "duplicates": args.duplicates, "exclude": args.exclude_patterns_list,
+                    "include": args.include_patterns_list,
+                    "verify_content": args.verify_content,
+                    "verify_threads": args.verify_threads, "verbose": args.verbose}
+        return run_job(job_dict, lambda event_dict: None, args.jobs, args.scan_threads, executor)
+
+    with contextlib.ExitStack() as exit_stack:
+        planning_executor = None
+        if args.jobs > 1:
+            planning_executor = exit_stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+        roots_executor = exit_stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.roots_in_flight))
+
+        futures_dict = {roots_executor.submit(fix_dir, source_dir, planning_executor): source_dir
+                        for source_dir in args.dirs_list}
+
+        for i_done, future in enumerate(concurrent.futures.as_completed(futures_dict), start=1):
+            source_dir = futures_dict[future]
+            try:
+                result_dict = future.result()
+            except (PathShortenerError, OSError) as e:
+                failed_dirs_list.append((source_dir, e))
+                colors.print_red(f"[{i_done}/{num_dirs}] \"{source_dir}\": Error: {e}")
+                continue
+
+            path_stats_before = PathStats.from_dict(result_dict["path_stats"])
+            path_stats_before_list.append(path_stats_before)
+            path_stats_after_list.append(PathStats.from_dict(result_dict["path_stats_after"]))
+            print(f"[{i_done}/{num_dirs}] \"{source_dir}\": fixed "
+                  f"{path_stats_before.paths_to_fix_count} paths, with "
+                  f"{result_dict['rename_count']} renames and {result_dict['namefile_count']} "
+                  f"namefiles, into \"{result_dict['dir_fixed']}\".")
+
+    print(f"\nSummary: {len(path_stats_before_list)} of {num_dirs} dirs fixed successfully.")
+    print("\nBEFORE fixing and shortening paths, across all dirs fixed:")
+    PathStats.combine(path_stats_before_list).print()
+    print("\nAFTER fixing and shortening paths, across all dirs fixed:")
+    PathStats.combine(path_stats_after_list).print()
+
+    if failed_dirs_list:
+        colors.print_red(f"\nError: {len(failed_dirs_list)} dirs failed:")
+        for source_dir, error in failed_dirs_list:
+            colors.print_red(f"  \"{source_dir}\": {error}")
+
+    return not failed_dirs_list
+
+
+def fix_paths_for_budgets(args, timer):
+    """
+    Compare fixing `args.dir` for each path length already used in `args.budgets_list`, ie: for
+    destinations whose base paths have different lengths, from one walk and one classification of
+    the dir, instead of one full run per destination.
+
+    For each budget, the paths to fix, renames, namefiles, and max path len after fixing are
+    printed, and written to "<dir>_short_budgets.json". With `args.budgets_copy`, the dir is also
+    copied into "<dir>_short_<budget>", and the copy fixed, for each budget. The phases are timed
+    in the `PhaseTimer` `timer`.
+
+    Returns True if all budgets could be planned, and, if copied, fixed.
+    """
+    settings = config.Settings()
+
+    with timer.phase("walk"):
+        all_paths_set = walk_directory_concurrently(args.base_dir, args.scan_threads,
+                                                    args.path_filter, timer)
+    with timer.phase("classify"):
+        classification = classify_paths(all_paths_set, args.keep_symlinks, settings, timer)
+    # Used to estimate the progress of each copy
+    args.source_path_count = len(all_paths_set)
+
+    print(f"Planning {len(args.budgets_list)} budgets for the {len(all_paths_set)} paths in "
+          f"\"{args.base_dir}\"...")
+
+    # Source path --> whether it is a dir, for the paths to fix for any budget so far
+    is_dir_dict = {}
+    budget_dicts_list = []
+
+    with contextlib.ExitStack() as exit_stack:
+        executor = None
+        if args.jobs > 1:
+            executor = exit_stack.enter_context(
+                concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+
+        for path_len_already_used in args.budgets_list:
+            # Each budget gets its own output dir, whose longer name is counted too
+            shortened_dir = f"{args.base_dir}{settings.short_dir_suffix}_{path_len_already_used}"
+            budget_settings = config.Settings(
+                max_allowed_path_len=config.WINDOWS_MAX_PATH_LEN - path_len_already_used)
+            max_allowed_path_len = (budget_settings.max_allowed_path_len
+                                    - (len(shortened_dir) - len(args.base_dir)))
+            budget_dict = {"path_len_already_used": path_len_already_used,
+                           "max_allowed_path_len": budget_settings.max_allowed_path_len,
+                           "dir_fixed": None, "error": None}
+            budget_dicts_list.append(budget_dict)
+
+            with timer.phase(f"plan_{path_len_already_used}"):
+                paths_to_fix_sorted_list, path_stats = classification.get_paths_to_fix(
+                    max_allowed_path_len)
+                budget_dict["path_stats"] = path_stats.to_dict()
+
+                for path in paths_to_fix_sorted_list:
+                    if path not in is_dir_dict:
+                        is_dir_dict[path] = os.path.isdir(path)
+                        timer.count("stat_calls")
+                is_dir_list = [is_dir_dict[path] for path in paths_to_fix_sorted_list]
+
+                paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
+                for path in paths_TO_list:
+                    path[0] = shortened_dir
+                # The same paths, in the copy
+                all_paths_set_copy = {shortened_dir + path[len(args.base_dir):]
+                                      for path in all_paths_set}
+
+                try:
+                    path_plan = plan_paths_with_args(paths_TO_list, is_dir_list, args,
+                                                     settings=budget_settings, executor=executor,
+                                                     all_paths_set=all_paths_set_copy,
+                                                     timer=timer)
+                except PathShortenerError as e:
+                    budget_dict["error"] = str(e)
+                    continue
+
+            budget_dict["rename_count"], budget_dict["namefile_count"] = (
+                get_rename_and_namefile_counts(path_plan, is_dir_list))
+            # The paths not fixed keep their lengths, other than the longer output dir name
+            budget_dict["max_len_after"] = max(
+                [len(str(Path(*path))) for path in path_plan.paths_longest_namefiles_list]
+                + [classification.get_max_len_not_fixed(max_allowed_path_len)
+                   + len(shortened_dir) - len(args.base_dir)])
+
+            if not args.budgets_copy:
+                continue
+
+            print(f"\nCopying \"{args.base_dir}\" to \"{shortened_dir}\", and fixing the copy...")
+            try:
+                with timer.phase(f"copy_{path_len_already_used}"):
+                    copy_directory(args.base_dir, shortened_dir, args, timer=timer)
+                with timer.phase(f"fix_{path_len_already_used}"):
+                    progress_reporter = progress.ProgressReporter(
+                        "rename", total_entries=len(path_plan.renames_list),
+                        enabled=args.progress)
+                    apply_renames_to_disk(path_plan.renames_list, progress_reporter, timer=timer)
+                    progress_reporter.finish()
+                    write_namefiles(path_plan.paths_original_list, path_plan.paths_TO_list,
+                                    timer=timer)
+
+                    output_dir = os.path.join(shortened_dir, OUTPUT_DIR_NAME)
+                    os.makedirs(output_dir, exist_ok=True)
+                    diff_report.write_diff_report(output_dir, diff_report.group_renames_by_dir(
+                        get_dir_renames(path_plan.renames_list)))
+                    with open(os.path.join(output_dir, "stats.json"), "w") as file:
+                        json.dump(budget_dict, file, indent=4)
+                    timer.count("files_written", 5)
+
+                with timer.phase(f"verify_{path_len_already_used}"):
+                    paths_to_fix_sorted_list2, _ = get_paths_to_fix(
+                        walk_directory_concurrently(shortened_dir, args.scan_threads,
+                                                    args.path_filter, timer),
+                        args.keep_symlinks, settings=budget_settings, timer=timer)
+            except (PathShortenerError, OSError) as e:
+                budget_dict["error"] = str(e)
+                continue
+
+            if paths_to_fix_sorted_list2:
+                budget_dict["error"] = (f"{len(paths_to_fix_sorted_list2)} paths are still too "
+                                        f"long after shortening.")
+                continue
+            budget_dict["dir_fixed"] = shortened_dir
+
+    print(f"\nBudgets for \"{args.base_dir}\" ({len(all_paths_set)} paths; max len "
+          f"{len(classification.paths_sorted_list[0])} + the path len already used):")
+    print(f"  {'len used':>8} {'max len':>8} {'to fix':>8} {'renames':>8} {'namefiles':>9} "
+          f"{'max len after':>13}")
+    for budget_dict in budget_dicts_list:
+        budget_str = (f"  {budget_dict['path_len_already_used']:8} "
+                      f"{budget_dict['max_allowed_path_len']:8} "
+                      f"{budget_dict['path_stats']['paths_to_fix_count']:8}")
+        if "rename_count" in budget_dict:
+            budget_str += (f" {budget_dict['rename_count']:8} {budget_dict['namefile_count']:9} "
+                           f"{budget_dict['max_len_after']:13}")
+        if budget_dict["error"] is not None:
+            # Only the first line of the error fits in the table. It is all in the JSON file.
+            colors.print_red(f"{budget_str}  Error: {budget_dict['error'].splitlines()[0]}")
+        elif budget_dict["dir_fixed"] is not None:
+            print(f"{budget_str}  --> \"{budget_dict['dir_fixed']}\"")
+        else:
+            print(budget_str)
+
+    path_stats = PathStats()
+    path_stats.phase_stats_list = timer.phase_stats_list
+    print()
+    path_stats.print_phase_stats()
+
+    budgets_filename = f"{args.base_dir}{settings.short_dir_suffix}_budgets.json"
+    with open(budgets_filename, "w") as file:
+        json.dump({"dir": args.base_dir, "total_path_count": len(all_paths_set),
+                   "budgets": budget_dicts_list,
+                   "phases": [phase_stats.to_dict()
+                              for phase_stats in path_stats.phase_stats_list]},
+                  file, indent=4)
+    print(f"\nBudgets written to \"{os.path.abspath(budgets_filename)}\".")
+
+    return all(budget_dict["error"] is None for budget_dict in budget_dicts_list)
+
+
+def read_path_list_arg(args, timer):
+    """
+    Read the path list in `args.path_list` ("-" for stdin), if given, into `args.path_types_dict`,
+    with `read_paths_from_list()`, or exit on failure. The read is timed in the `PhaseTimer`
+    `timer`.
+    """
+    if not args.path_list:
+        return
+
+    print(f"Reading the paths in \"{args.base_dir}\" from the path list...")
+    try:
+        with timer.phase("read_path_list"):
+            with (sys.stdin.buffer if args.path_list == "-"
+                  else open(args.path_list, "rb")) as file:
+                args.path_types_dict = read_paths_from_list(file, args.base_dir, args.path_filter,
+                                                            timer)
+    except (PathShortenerError, OSError) as e:
+        colors.print_red(f"Error: cannot read '--path_list': {e}")
+        exit(EXIT_FAILURE)
+
+
+def plan_fixes_to_file(args, plan_file, timer):
+    """
+    Plan how to fix the paths in `args.dir` in place, without changing anything, then write the
+    renames to the open binary `plan_file` with `path_list.write_rename_plan()`, as absolute paths,
+    so that `xargs -0 -n 2 mv -n --` can make them. The paths come from `args.path_types_dict`, if
+    given, instead of from walking the dir.
+
+    The namefiles are not written, so the original names are only kept in the plan itself. The
+    phases are timed in the `PhaseTimer` `timer`.
+    """
+    settings = config.Settings(short_dir_suffix="")
+    paths_all_set, paths_to_fix_sorted_list, _ = walk_dir_and_exit_if_done(
+        args.base_dir, args.keep_symlinks, args.scan_threads, settings,
+        path_filter=args.path_filter, types_dict=args.path_types_dict, timer=timer)
+
+    with timer.phase("plan"):
+        paths_TO_list = [list(Path(path).parts) for path in paths_to_fix_sorted_list]
+        # The path list has no inodes, so only the hardlinks found on disk share their naming
+        duplicate_paths_dict = None
+        if args.path_types_dict is not None:
+            is_dir_list = [args.path_types_dict[path] == "d" for path in paths_to_fix_sorted_list]
+        else:
+            is_dir_list = [paths.is_dir(path) for path in paths_TO_list]
+            timer.count("stat_calls", len(paths_TO_list))
+            duplicate_paths_dict = get_duplicate_paths_dict(paths_TO_list, is_dir_list,
+                                                            timer=timer)
+
+        progress_reporter = progress.ProgressReporter(
+            "plan", total_entries=len(paths_TO_list), enabled=args.progress)
+        path_plan = plan_paths_with_args(
+            paths_TO_list, is_dir_list, args, progress_reporter, settings,
+            all_paths_set=paths_all_set, timer=timer, duplicate_paths_dict=duplicate_paths_dict)
+        progress_reporter.finish()
+
+    if args.optimize_plan:
+        print_plan_savings(path_plan)
+
+    with timer.phase("report"):
+        path_list.write_rename_plan(plan_file, [
+            (os.path.abspath(path_chunk_old), os.path.abspath(path_chunk_new))
+            for path_chunk_old, path_chunk_new in path_plan.renames_list])
+        plan_file.flush()
+
+    rename_count, namefile_count = get_rename_and_namefile_counts(path_plan, is_dir_list)
+    print(f"\n{len(path_plan.renames_list)} renames written to "
+          f"{'stdout' if args.plan_file == '-' else repr(args.plan_file)}, of {rename_count} "
+          f"files and dirs, which would need {namefile_count} namefiles to keep their original "
+          f"names.")
+
+    path_stats = PathStats()
+    path_stats.phase_stats_list = timer.phase_stats_list
+    print()
+    path_stats.print_phase_stats()
+
+
 def print_sponsor_message():
     print(f"{colors.FBB}Sponsor me for more: https://github.com/sponsors/ElectricRCAircraftGuy{colors.END}")
 
 
-def walk_dir_and_exit_if_done(dir_to_walk, keep_symlinks):
+def walk_dir_and_exit_if_done(dir_to_walk, keep_symlinks, num_scan_threads, settings,
+                              phase_name_suffix="", path_filter=None, types_dict=None,
+                              timer=None):
     """
-    Walk the directory and exit if there is nothing to do.
+    Walk the directory, skipping what `path_filter` excludes, and exit if there is nothing to do.
+    If `types_dict`, from `read_paths_from_list()`, is given, its paths are used instead of
+    walking.
+
+    The walk and the classification of the paths are timed in the `PhaseTimer` `timer` as the
+    "walk" and "classify" phases, with `phase_name_suffix` appended to those names.
     """
-    all_paths_set = walk_directory(dir_to_walk)
+    if timer is None:
+        timer = PhaseTimer()
+
+    symlink_paths_set = None
+    if types_dict is not None:
+        all_paths_set = types_dict.keys()
+        symlink_paths_set = {path for path, entry_type in types_dict.items() if entry_type == "l"}
+    else:
+        with timer.phase("walk" + phase_name_suffix):
+            all_paths_set = walk_directory_concurrently(dir_to_walk, num_scan_threads,
+                                                        path_filter, timer)
     # pprint.pprint(all_paths_set)
-    paths_to_fix_sorted_list, path_stats = get_paths_to_fix(
-        all_paths_set, keep_symlinks, max_path_len_already_used=len(config.SHORT_DIR_SUFFIX))
+    with timer.phase("classify" + phase_name_suffix):
+        paths_to_fix_sorted_list, path_stats = get_paths_to_fix(
+            all_paths_set, keep_symlinks,
+            max_path_len_already_used=len(settings.short_dir_suffix),
+            symlink_paths_set=symlink_paths_set, settings=settings, timer=timer)
     path_stats.print()
     print()
 
@@ -1194,13 +5216,148 @@ def walk_dir_and_exit_if_done(dir_to_walk, keep_symlinks):
     return all_paths_set, paths_to_fix_sorted_list, path_stats
 
 
+def write_profile(profiler, output_dir):
+    """
+    Dump the raw `cProfile` stats, plus a text report of the hot spots sorted by cumulative and by
+    internal time, into `output_dir`.
+    """
+    prof_filename = os.path.join(output_dir, "profile.prof")
+    profiler.dump_stats(prof_filename)
+
+    profile_filename = os.path.join(output_dir, "profile.txt")
+    with open(profile_filename, "w") as file:
+        stats = pstats.Stats(profiler, stream=file)
+        stats.strip_dirs()
+
+        file.write("Sorted by cumulative time:\n")
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(50)
+        file.write("\nSorted by internal time:\n")
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(50)
+
+    print(f"Profile written to \"{profile_filename}\" and \"{prof_filename}\".")
+
+
 def main():
     args = parse_args()
-    print_global_variables(config)
 
-    walk_dir_and_exit_if_done(args.base_dir, args.keep_symlinks)
+    # Shared by all workers, including the jobs of `--serve` and of batches
+    io_throttle.set_limits(args.max_bytes_per_sec, args.max_ops_per_sec)
+    if io_throttle:
+        bytes_limit_str = ("no limit" if args.max_bytes_per_sec is None
+                           else f"{progress.format_bytes(args.max_bytes_per_sec)}/s")
+        ops_limit_str = ("no limit" if args.max_ops_per_sec is None
+                         else f"{args.max_ops_per_sec:g} ops/s")
+        print(f"Limiting the I/O to: data: {bytes_limit_str}; operations: {ops_limit_str}.")
+    if args.idle_io:
+        try:
+            throttle.set_idle_io_priority()
+        except OSError as e:
+            colors.print_yellow(f"WARNING: cannot set the idle I/O priority: {e}")
+
+    if args.serve:
+        # Share one pool of planning processes across all jobs
+        with contextlib.ExitStack() as exit_stack:
+            executor = None
+            if args.jobs > 1:
+                executor = exit_stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs))
+            server.serve(args.serve, args.workers, args.max_queued_jobs,
+                         functools.partial(run_job, num_jobs_default=args.jobs,
+                                           num_scan_threads_default=args.scan_threads,
+                                           executor=executor))
+        return
+
+    if args.batch:
+        all_fixed = fix_paths_in_batch(args)
+        print_sponsor_message()
+        exit(EXIT_SUCCESS if all_fixed else EXIT_FAILURE)
+
+    if args.watch:
+        try:
+            watch_and_sync(args, config.Settings())
+        except (PathShortenerError, OSError) as e:
+            colors.print_red(f"Error: {e}")
+            colors.print_red("Exiting.")
+            exit(EXIT_FAILURE)
+        print_sponsor_message()
+        return
+
+    if args.undo:
+        try:
+            rename_count, namefile_count = undo_in_place(args.base_dir)
+        except (PathShortenerError, OSError) as e:
+            colors.print_red(f"Error: {e}")
+            colors.print_red("Exiting.")
+            exit(EXIT_FAILURE)
+        colors.print_green(f"Undo completed successfully: {rename_count} renames undone, and "
+                           f"{namefile_count} namefiles deleted.")
+        print_sponsor_message()
+        return
+
+    # The timer of this run. The jobs of `--serve` and of batches each have their own instead.
+    timer = PhaseTimer()
+
+    if args.budgets_list:
+        with monitor_run(args, timer):
+            all_fixed = fix_paths_for_budgets(args, timer)
+            print_sponsor_message()
+            exit(EXIT_SUCCESS if all_fixed else EXIT_FAILURE)
+
+    if args.plan_file:
+        with monitor_run(args, timer):
+            read_path_list_arg(args, timer)
+            try:
+                # Opened first, so that a plan with no renames is an empty file too
+                with (contextlib.nullcontext(args.plan_stdout) if args.plan_file == "-"
+                      else open(args.plan_file, "wb")) as plan_file:
+                    plan_fixes_to_file(args, plan_file, timer)
+            except (PathShortenerError, OSError) as e:
+                colors.print_red(f"Error: {e}")
+                colors.print_red("Exiting.")
+                exit(EXIT_FAILURE)
+        print_sponsor_message()
+        return
+
+    with monitor_run(args, timer):
+        print_global_variables(config)
+
+        if args.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        if args.mem_report:
+            PhaseTimer.start_mem_report()
+
+        if args.in_place:
+            # Fix `dir` itself, rather than `<dir>_short`
+            settings = config.Settings(short_dir_suffix="")
+            read_path_list_arg(args, timer)
+        else:
+            settings = config.Settings()
+            if not settings.short_dir_suffix:
+                colors.print_red("Error: `SHORT_DIR_SUFFIX` in 'config.py' must not be empty, or "
+                                 "the copy would overwrite the original dir. Use '--in_place' to "
+                                 "fix the original dir itself, with undo, instead.")
+                exit(EXIT_FAILURE)
+
+            _, _, path_stats = walk_dir_and_exit_if_done(args.base_dir, args.keep_symlinks,
+                                                         args.scan_threads, settings,
+                                                         phase_name_suffix="_source",
+                                                         path_filter=args.path_filter,
+                                                         timer=timer)
+            # Used to estimate the progress of the copy
+            args.source_path_count = path_stats.total_path_count
+
+        try:
+            output_dir = fix_paths(args, len(settings.short_dir_suffix), settings, timer)
+        except PathShortenerError as e:
+            colors.print_red(f"Error: {e}")
+            colors.print_red("Exiting.")
+            exit(EXIT_FAILURE)
 
-    output_dir = fix_paths(args, len(config.SHORT_DIR_SUFFIX))
+        if args.profile:
+            profiler.disable()
+            write_profile(profiler, output_dir)
 
     print(f"{colors.FGR}Completed successfully.{colors.END}")
     print(f"{colors.FGR}See the log files in \"{output_dir}\" for more details.{colors.END}")
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+"""
+Report the progress of a long-running phase: entries and bytes processed, current rate, and ETA.
+
+- On a TTY, the status line is updated in place, at most every `TTY_INTERVAL_SEC` seconds.
+- When the output is redirected to a file or pipe, a single-line status record is printed every
+  `REDIRECTED_INTERVAL_SEC` seconds instead, so log files don't fill up with progress lines.
+
+Example usage:
+```python
+import progress
+
+progress_reporter = progress.ProgressReporter("copy", total_entries=len(files_list))
+for file in files_list:
+    copy(file)
+    progress_reporter.update(num_bytes=file_size)
+progress_reporter.finish()
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import sys
+import time
+
+
+TTY_INTERVAL_SEC = 0.2
+REDIRECTED_INTERVAL_SEC = 10.0
+
+
+def format_bytes(num_bytes):
+    """
+    Format a number of bytes in human-readable binary units. Ex: 1536 --> "1.5 KiB".
+    """
+    for unit in ["B", "KiB", "MiB", "GiB", "TiB"]:
+        if abs(num_bytes) < 1024 or unit == "TiB":
+            break
+        num_bytes /= 1024
+
+    if unit == "B":
+        return f"{num_bytes:.0f} {unit}"
+    return f"{num_bytes:.1f} {unit}"
+
+
+def format_duration(seconds):
+    """
+    Format a number of seconds as "H:MM:SS".
+    """
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02}:{seconds % 60:02}"
+
+
+class ProgressReporter:
+    def __init__(self, phase_name, total_entries=None, enabled=True, stream=None):
+        """
+        Create a progress reporter for the phase called `phase_name`.
+
+        - total_entries: the total number of entries expected, if known, used to show the percent
+          done and the ETA.
+        - enabled: if False, only count, and never print anything.
+        - stream: where to print the progress. Default: `sys.stdout`, as of when `update()` is
+          first called.
+        """
+        self.phase_name = phase_name
+        self.total_entries = total_entries
+        self.enabled = enabled
+        self.stream = stream
+
+        self.entries_done = 0
+        self.bytes_done = 0
+
+        self.time_start = time.monotonic()
+        self.time_last_report = self.time_start
+        # The entries and bytes done as of the last report, to calculate the current rate
+        self.entries_done_last_report = 0
+        self.bytes_done_last_report = 0
+        self.is_tty = None
+        self.interval_sec = None
+        self.num_reports = 0
+
+    def update(self, num_entries=1, num_bytes=0):
+        """
+        Record that `num_entries` more entries and `num_bytes` more bytes were processed, and
+        report the progress if it is time to.
+        """
+        self.entries_done += num_entries
+        self.bytes_done += num_bytes
+
+        if not self.enabled:
+            return
+
+        now = time.monotonic()
+        if self.interval_sec is None:
+            if self.stream is None:
+                self.stream = sys.stdout
+            self.is_tty = self.stream.isatty()
+            self.interval_sec = TTY_INTERVAL_SEC if self.is_tty else REDIRECTED_INTERVAL_SEC
+
+        if now - self.time_last_report >= self.interval_sec:
+            self.report(now)
+
+    def get_status_str(self, now, final=False):
+        elapsed_sec = now - self.time_start
+
+        if final:
+            # Use the average rate over the whole phase
+            entries_per_sec = self.entries_done / elapsed_sec if elapsed_sec > 0 else 0
+            bytes_per_sec = self.bytes_done / elapsed_sec if elapsed_sec > 0 else 0
+        else:
+            # Use the current rate since the last report
+            interval_sec = now - self.time_last_report
+            entries_per_sec = (self.entries_done - self.entries_done_last_report) / interval_sec
+            bytes_per_sec = (self.bytes_done - self.bytes_done_last_report) / interval_sec
+
+        status_str = f"[{self.phase_name}] {self.entries_done}"
+        if self.total_entries:
+            percent = 100 * self.entries_done / self.total_entries
+            status_str += f"/{self.total_entries} entries ({percent:.1f}%)"
+        else:
+            status_str += " entries"
+
+        if self.bytes_done > 0:
+            status_str += f", {format_bytes(self.bytes_done)}"
+
+        status_str += f", {entries_per_sec:.0f} entries/s"
+        if self.bytes_done > 0:
+            status_str += f", {format_bytes(bytes_per_sec)}/s"
+
+        status_str += f", elapsed {format_duration(elapsed_sec)}"
+
+        if not final and self.total_entries and entries_per_sec > 0:
+            entries_left = max(self.total_entries - self.entries_done, 0)
+            status_str += f", ETA {format_duration(entries_left / entries_per_sec)}"
+
+        return status_str
+
+    def report(self, now):
+        status_str = self.get_status_str(now)
+
+        if self.is_tty:
+            # Overwrite the current line. "\033[K" clears to the end of the line.
+            self.stream.write(f"\r{status_str}\033[K")
+        else:
+            self.stream.write(f"{status_str}\n")
+        self.stream.flush()
+
+        self.num_reports += 1
+        self.time_last_report = now
+        self.entries_done_last_report = self.entries_done
+        self.bytes_done_last_report = self.bytes_done
+
+    def finish(self):
+        """
+        Print the final totals for the phase, but only if any progress was reported, so that fast
+        phases stay quiet.
+        """
+        if not self.enabled or self.num_reports == 0:
+            return
+
+        status_str = self.get_status_str(time.monotonic(), final=True)
+        if self.is_tty:
+            self.stream.write(f"\r{status_str}\033[K\n")
+        else:
+            self.stream.write(f"{status_str}\n")
+        self.stream.flush()
+
+
+def main():
+    # Demo: simulate copying 2000 files of 1 MiB each
+    progress_reporter = ProgressReporter("demo", total_entries=2000)
+    for _ in range(2000):
+        time.sleep(0.001)
+        progress_reporter.update(num_bytes=1024*1024)
+    progress_reporter.finish()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+A long-running daemon which runs jobs sent to it over a local Unix socket, so that many small jobs
+don't each pay for Python startup, imports, and argument checks. This is the server behind
+`path_shortener.py --serve`, and, when run directly, a small client to submit jobs to it.
+
+Protocol: newline-delimited JSON ("JSON lines") in both directions. The client sends one job
+request per line, as a JSON object. For each job, the server replies with a stream of events, one
+per line, ending with either a "result" or an "error" event:
+
+```
+{"event": "queued", "job_id": 1}
+{"event": "started", "job_id": 1}
+{"event": "progress", "job_id": 1, ...}     <-- zero or more of these
+{"event": "result", "job_id": 1, "elapsed_sec": 0.012, "result": {...}}
+    OR
+{"event": "error", "job_id": 1, "elapsed_sec": 0.012, "error_type": "...", "message": "..."}
+```
+
+Jobs sent on the same connection run one at a time, in order. Open more connections to run more
+jobs at the same time, up to the number of workers. Jobs beyond that are queued, up to a limit,
+after which they are rejected right away with a "ServerBusy" error.
+
+Example usage:
+```bash
+# Start the daemon (see `path_shortener.py -h` for the options)
+path_shortener --serve /tmp/path_shortener.sock --workers 4
+
+# Submit a job, and print the events streamed back
+./server.py /tmp/path_shortener.sock '{"source_dir": "/abs/path/to/dir", "mode": "plan"}'
+```
+"""
+
+# local imports
+import ansi_colors as colors
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+
+
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+
+class JobRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle one client connection: read job requests, one per line, and run each one on the
+    server's worker pool, streaming its events back to the client.
+    """
+    def setup(self):
+        super().setup()
+        # Set once the client disconnects, so that running jobs stop trying to send events to it
+        self.client_gone = False
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+
+            job_id = next(self.server.job_ids)
+
+            try:
+                job_dict = json.loads(line)
+                if not isinstance(job_dict, dict):
+                    raise ValueError("a job request must be a JSON object")
+            except ValueError as e:
+                self.send_event({"event": "error", "job_id": job_id, "error_type": "InvalidJob",
+                                 "message": f"Invalid job request: {e}"})
+                continue
+
+            # Reject the job right away if too many jobs are already running or queued
+            if not self.server.job_slots.acquire(blocking=False):
+                self.send_event({"event": "error", "job_id": job_id, "error_type": "ServerBusy",
+                                 "message": "Too many jobs are already running or queued. "
+                                            "Try again later."})
+                continue
+
+            try:
+                self.send_event({"event": "queued", "job_id": job_id})
+                future = self.server.executor.submit(self.run_job, job_id, job_dict)
+                future.result()
+            finally:
+                self.server.job_slots.release()
+
+    def run_job(self, job_id, job_dict):
+        """
+        Run one job on a worker thread, sending its events to the client.
+        """
+        self.send_event({"event": "started", "job_id": job_id})
+
+        def send_progress_event(event_dict):
+            self.send_event({"event": "progress", "job_id": job_id, **event_dict})
+
+        time_start = time.perf_counter()
+        try:
+            result_dict = self.server.run_job_func(job_dict, send_progress_event)
+        # Catch everything, so that one bad job can never take down the whole daemon
+        except Exception as e:
+            elapsed_sec = time.perf_counter() - time_start
+            print(f"Job {job_id}: failed after {elapsed_sec:.3f} sec: "
+                  f"{type(e).__name__}: {e}", flush=True)
+            self.send_event({"event": "error", "job_id": job_id, "elapsed_sec": elapsed_sec,
+                             "error_type": type(e).__name__, "message": str(e)})
+        else:
+            elapsed_sec = time.perf_counter() - time_start
+            print(f"Job {job_id}: done in {elapsed_sec:.3f} sec.", flush=True)
+            self.send_event({"event": "result", "job_id": job_id, "elapsed_sec": elapsed_sec,
+                             "result": result_dict})
+
+    def send_event(self, event_dict):
+        if self.client_gone:
+            return
+
+        try:
+            self.wfile.write((json.dumps(event_dict) + "\n").encode("utf-8"))
+            self.wfile.flush()
+        except OSError:
+            # The client disconnected. Let the job finish anyway, since it may already have changed
+            # things on the disk.
+            self.client_gone = True
+
+
+class JobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    A Unix socket server which handles each connection in its own thread, but runs the jobs
+    themselves on a bounded pool of `num_workers` worker threads.
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, num_workers, max_queued_jobs, run_job_func):
+        """
+        - run_job_func: the function to run each job with, as `run_job_func(job_dict,
+          send_progress_event)`, returning a JSON-serializable result dict, or raising an exception
+          on failure. `send_progress_event` takes a dict to send to the client as a "progress"
+          event.
+        """
+        super().__init__(socket_path, JobRequestHandler)
+        self.run_job_func = run_job_func
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=num_workers, thread_name_prefix="job_worker")
+        # Limits the number of jobs running plus queued, across all connections
+        self.job_slots = threading.BoundedSemaphore(num_workers + max_queued_jobs)
+        self.job_ids = itertools.count(1)
+
+    def server_close(self):
+        super().server_close()
+        # Let any running jobs finish, but don't start any queued ones
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+def remove_stale_socket(socket_path):
+    """
+    Remove the socket file at `socket_path` if it was left behind by a daemon which is no longer
+    running. Exit with an error if another daemon is still listening on it, or if it is not a
+    socket.
+    """
+    if not os.path.exists(socket_path):
+        return
+
+    if not stat.S_ISSOCK(os.stat(socket_path).st_mode):
+        colors.print_red(f"Error: \"{socket_path}\" already exists, and is not a socket.")
+        exit(EXIT_FAILURE)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+            return
+
+    colors.print_red(f"Error: another daemon is already listening on \"{socket_path}\".")
+    exit(EXIT_FAILURE)
+
+
+def serve(socket_path, num_workers, max_queued_jobs, run_job_func):
+    """
+    Listen on the Unix socket at `socket_path`, running jobs with `run_job_func`, until interrupted
+    with Ctrl + C or SIGTERM. See `JobServer`.
+    """
+    remove_stale_socket(socket_path)
+
+    server = JobServer(socket_path, num_workers, max_queued_jobs, run_job_func)
+
+    # Shut down cleanly on SIGTERM too, such as from `systemctl stop` or `kill`, the same as on
+    # Ctrl + C.
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    print(f"Listening on \"{socket_path}\", with {num_workers} workers, and up to "
+          f"{max_queued_jobs} queued jobs. Press Ctrl + C to stop.", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nShutting down. Waiting for running jobs to finish...", flush=True)
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def submit_job(socket_path, job_dict):
+    """
+    Send one job to the daemon listening on `socket_path`, and yield each event dict it streams
+    back, until the job's final "result" or "error" event.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(job_dict) + "\n").encode("utf-8"))
+
+        with sock.makefile("r", encoding="utf-8") as file:
+            for line in file:
+                event_dict = json.loads(line)
+                yield event_dict
+                if event_dict["event"] in ("result", "error"):
+                    return
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Submit a job to a daemon started with "
+                                     "`path_shortener.py --serve`, and print the events it "
+                                     "streams back, one JSON object per line.")
+    parser.add_argument("socket_path", help="Path to the daemon's Unix socket")
+    parser.add_argument("job", help="The job request, as a JSON object. Ex: "
+                        "'{\"source_dir\": \"/abs/path/to/dir\", \"mode\": \"plan\"}'")
+    args = parser.parse_args()
+
+    try:
+        job_dict = json.loads(args.job)
+    except ValueError as e:
+        colors.print_red(f"Error: the job is not valid JSON: {e}")
+        exit(EXIT_FAILURE)
+
+    exit_code = EXIT_FAILURE
+    for event_dict in submit_job(args.socket_path, job_dict):
+        print(json.dumps(event_dict))
+        if event_dict["event"] == "result":
+            exit_code = EXIT_SUCCESS
+
+    exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+# Let the tests import the modules at the top of the repo, the same way `path_shortener.py` does
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+# local imports
+import filters
+import path_shortener
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import io
+import os
+
+
+def test_pattern_without_slash_matches_name_at_any_depth():
+    path_filter = filters.PathFilter(["node_modules", "*.pyc"])
+    assert path_filter.is_excluded("node_modules", is_dir=True)
+    assert path_filter.is_excluded("src/web/node_modules", is_dir=True)
+    assert path_filter.is_excluded("src/a.pyc", is_dir=False)
+    assert not path_filter.is_excluded("src/node_modules_old", is_dir=True)
+
+
+def test_pattern_with_slash_matches_relative_path():
+    path_filter = filters.PathFilter(["build/*.o"])
+    assert path_filter.is_excluded("build/a.o", is_dir=False)
+    assert path_filter.is_excluded(os.path.join("build", "a.o"), is_dir=False)
+    assert not path_filter.is_excluded("src/build/a.o", is_dir=False)
+    assert not path_filter.is_excluded("a.o", is_dir=False)
+
+
+def test_dir_only_pattern_matches_dirs_and_symlinks_to_dirs(tmp_path):
+    path_filter = filters.PathFilter(["cache/"])
+    assert path_filter.is_excluded("a/cache", is_dir=True)
+    assert not path_filter.is_excluded("a/cache", is_dir=False)
+
+    (tmp_path / "real").mkdir()
+    (tmp_path / "cache").symlink_to(tmp_path / "real")
+    (tmp_path / "file").write_text("")
+    (tmp_path / "file_cache").symlink_to(tmp_path / "file")
+    assert path_filter.is_path_excluded(str(tmp_path / "cache"), "cache")
+    assert not path_filter.is_path_excluded(str(tmp_path / "file_cache"), "file_cache")
+
+
+def test_read_patterns_file_splits_includes_from_excludes():
+    file = io.StringIO("# build output\n\nbuild/\n!*.txt\n  *.o  \n")
+    exclude_patterns_list, include_patterns_list = filters.read_patterns_file(file)
+    assert exclude_patterns_list == ["build/", "*.o"]
+    assert include_patterns_list == ["*.txt"]
+
+    path_filter = filters.PathFilter(exclude_patterns_list, include_patterns_list)
+    assert path_filter.is_excluded("build", is_dir=True)
+    assert path_filter.is_excluded("src/a.py", is_dir=False)
+    assert not path_filter.is_excluded("src", is_dir=True)
+    assert not path_filter.is_excluded("src/a.txt", is_dir=False)
+
+
+def test_walk_prunes_excluded_dirs(tmp_path):
+    for relative_path in ["keep/a.txt", "keep/b.py", "skip/a.txt", "skip/sub/a.txt"]:
+        (tmp_path / relative_path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / relative_path).write_text("")
+    path_filter = filters.PathFilter(["skip"], ["*.txt"])
+
+    paths_set = path_shortener.walk_directory(str(tmp_path), path_filter)
+    assert paths_set == {str(tmp_path), str(tmp_path / "keep"), str(tmp_path / "keep" / "a.txt")}
+    assert path_shortener.walk_directory_concurrently(str(tmp_path), 4, path_filter) == paths_set
+
+
+def test_path_list_checks_symlinks_to_dirs_as_dirs(tmp_path):
+    dir_path = tmp_path / "dir"
+    (dir_path / "real").mkdir(parents=True)
+    (dir_path / "cache").symlink_to(dir_path / "real")
+    path_filter = filters.PathFilter(["cache/"])
+    # Same as `find dir -mindepth 1 -printf '%y\t%P\0'` writes
+    file = io.BytesIO(b"d\treal\0l\tcache\0")
+
+    types_dict = path_shortener.read_paths_from_list(file, str(dir_path), path_filter)
+    assert set(types_dict) == path_shortener.walk_directory(str(dir_path), path_filter)
+    assert str(dir_path / "cache") not in types_dict
@@ -0,0 +1,431 @@
+# local imports
+import config
+import filters
+import path_shortener
+import progress
+
+# 3rd party imports
+import pytest
+
+# standard library imports
+import filecmp
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+
+def make_file(path, contents_str=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(contents_str)
+
+
+def get_paths_dict(dir_path):
+    """
+    Get each path in `dir_path`, relative to it, other than in the output dir, and the contents of
+    each file, or None for dirs.
+    """
+    paths_dict = {}
+    for dirpath, dirnames, filenames in os.walk(dir_path):
+        if path_shortener.OUTPUT_DIR_NAME in dirnames:
+            dirnames.remove(path_shortener.OUTPUT_DIR_NAME)
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            paths_dict[os.path.relpath(path, dir_path)] = (
+                None if name in dirnames else open(path).read())
+    return paths_dict
+
+
+@pytest.mark.parametrize("keep_symlinks", [True, False])
+def test_classified_paths_to_fix_match_get_paths_to_fix(tmp_path, monkeypatch, keep_symlinks):
+    monkeypatch.chdir(tmp_path)
+    for path in ["dir/" + "a"*20, "dir/" + "b"*20, "dir/c:" + "c"*10, "dir/sub/" + "d"*30]:
+        make_file(path)
+    os.symlink("a"*20, "dir/link")
+    all_paths_set = path_shortener.walk_directory("dir")
+    lengths_set = {len(path) for path in all_paths_set}
+
+    classification = path_shortener.classify_paths(all_paths_set, keep_symlinks)
+    # Every path's own length, so that some paths are exactly at the limit, and the lengths around
+    for max_allowed_path_len in sorted(lengths_set | {length - 1 for length in lengths_set}
+                                       | {0, 1000}):
+        paths_to_fix_sorted_list, path_stats = classification.get_paths_to_fix(
+            max_allowed_path_len)
+        paths_to_fix_sorted_list_expected, path_stats_expected = path_shortener.get_paths_to_fix(
+            all_paths_set, keep_symlinks,
+            settings=config.Settings(max_allowed_path_len=max_allowed_path_len))
+        assert ([len(path) for path in paths_to_fix_sorted_list]
+                == [len(path) for path in paths_to_fix_sorted_list_expected])
+        assert set(paths_to_fix_sorted_list) == set(paths_to_fix_sorted_list_expected)
+        assert vars(path_stats) == vars(path_stats_expected)
+
+
+def test_plan_avoids_names_of_existing_siblings(tmp_path):
+    settings = config.Settings(max_allowed_path_len=40)
+    dir_path = tmp_path / "dir"
+    name_long = "a"*60 + ".txt"
+    make_file(dir_path / name_long, "long")
+
+    # Find the name the long file would get, then put a file with that name next to it first
+    path_shortener_obj = path_shortener.PathShortener(settings)
+    path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+    name_planned = path_plan.paths_TO_list[0][-1]
+    make_file(dir_path / name_planned, "sibling")
+
+    timer = path_shortener.PhaseTimer()
+    path_shortener_obj = path_shortener.PathShortener(settings, timer=timer)
+    scan_result = path_shortener_obj.scan(dir_path)
+    assert scan_result.path_stats.paths_to_fix_count == 1
+    path_plan = path_shortener_obj.plan(scan_result)
+    name_new = path_plan.paths_TO_list[0][-1]
+    assert name_new != name_planned
+    assert timer.op_counts["names_lengthened"] == 1
+    assert timer.op_counts["names_counter_suffixed"] == 0
+    assert len(os.path.join("dir", name_new)) <= settings.max_allowed_path_len
+
+    path_shortener_obj.apply(path_plan)
+    assert (dir_path / name_planned).read_text() == "sibling"
+    assert (dir_path / name_new).read_text() == "long"
+
+
+def test_name_allocator_counts_each_collision_once():
+    settings = config.Settings()
+    name_allocator = path_shortener.NameAllocator(settings, [["dir", "a"*60]], {"dir/taken"})
+
+    def make_name(hash_str):
+        return "taken" if len(hash_str) == settings.hash_len else hash_str
+
+    # Allocated again as the plan is shortened further, but it is still one name
+    for _ in range(3):
+        name_new = name_allocator.allocate(os.path.join("dir", "a"*60), make_name)
+    assert name_new != "taken"
+    timer = path_shortener.PhaseTimer()
+    name_allocator.count_collisions(timer)
+    assert timer.op_counts == {"names_lengthened": 1}
+
+
+def test_plan_in_parallel_avoids_names_of_existing_siblings(tmp_path):
+    settings = config.Settings(max_allowed_path_len=40)
+    dir_path = tmp_path / "dir"
+    for subdir_name in ["sub1", "sub2"]:
+        make_file(dir_path / subdir_name / ("b"*60 + ".txt"))
+
+    path_shortener_obj = path_shortener.PathShortener(settings, num_jobs=2)
+    path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+    names_planned_dict = {path_original[1]: path[-1] for path_original, path
+                          in zip(path_plan.paths_original_list, path_plan.paths_TO_list)}
+    for subdir_name, name_planned in names_planned_dict.items():
+        make_file(dir_path / subdir_name / name_planned)
+
+    path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+    assert len(path_plan.paths_TO_list) == 2
+    for path_original, path in zip(path_plan.paths_original_list, path_plan.paths_TO_list):
+        assert path[-1] != names_planned_dict[path_original[1]]
+    path_shortener_obj.apply(path_plan)
+
+
+@pytest.mark.parametrize("settings, paths_list", [
+    # Several subtrees, with shared dirs to rename, and files deeper than others
+    (config.Settings(max_allowed_path_len=40),
+     [f"dir/sub{i}/" + "b"*(40 + i) + ".txt" for i in range(6)]
+     + [f"dir/{'t'*30}{i}/x.txt" for i in range(3)] + ["dir/sub0/c:" + "c"*40]),
+    # So many top-level names with a 1-char hash that two subtrees pick the same new name
+    (config.Settings(max_allowed_path_len=30, hash_len=1),
+     [f"dir/{'p'*40}{i}.txt" for i in range(20)]),
+])
+def test_plan_in_parallel_gives_the_same_plan_as_plan(settings, paths_list, capsys):
+    paths_list.sort(key=len, reverse=True)
+    paths_TO_lists_list = [[path.split("/") for path in paths_list] for _ in range(2)]
+    is_dir_list = [False]*len(paths_list)
+
+    path_plan = path_shortener.plan_paths(paths_TO_lists_list[0], is_dir_list, settings=settings)
+    path_plan_parallel = path_shortener.plan_paths_in_parallel(
+        paths_TO_lists_list[1], is_dir_list, 4, settings=settings)
+    assert path_plan_parallel.renames_list == path_plan.renames_list
+    assert path_plan_parallel.paths_TO_list == path_plan.paths_TO_list
+    assert (path_plan_parallel.paths_longest_namefiles_list
+            == path_plan.paths_longest_namefiles_list)
+    assert (settings.hash_len == 1) == ("in one process instead" in capsys.readouterr().out)
+
+
+def test_plan_optimized_checks_lengths_of_lengthened_names():
+    settings = config.Settings(max_allowed_path_len=40)
+    # Only renamed to replace the illegal char, and exactly `max_allowed_path_len` chars long after
+    path_original = ["dir", "x:" + "y"*21 + ".txt"]
+
+    path_plan = path_shortener.plan_paths_optimized([list(path_original)], [False],
+                                                    settings=settings)
+    name_planned = path_plan.paths_TO_list[0][-1]
+    assert len(os.path.join(*path_plan.paths_longest_namefiles_list[0])) == 40
+
+    # Taking that name makes the hash of the new name 1 char longer, which must not go unchecked
+    all_paths_set = {"dir", os.path.join("dir", name_planned),
+                     os.path.join("dir", path_original[-1])}
+    path_plan = path_shortener.plan_paths_optimized([list(path_original)], [False],
+                                                    settings=settings, all_paths_set=all_paths_set)
+    assert path_plan.paths_TO_list[0][-1] != name_planned
+    assert len(os.path.join(*path_plan.paths_longest_namefiles_list[0])) <= 40
+
+
+def test_plan_optimized_is_valid_and_no_costlier_than_plan(tmp_path):
+    settings = config.Settings(max_allowed_path_len=80)
+    dir_path = tmp_path / "dir"
+    for i in range(6):
+        make_file(dir_path / ("shared_" + "d"*40) / f"{i}_{'f'*30}.txt", str(i))
+    make_file(dir_path / "one" / ("g"*70 + ".txt"), "g")
+    make_file(dir_path / "sub" / ("h"*30) / ("i"*30) / ("j"*20 + ".txt"), "j")
+    make_file(dir_path / "sub" / ("bad:name" + "k"*50) / "x.txt", "x")
+    paths_before_dict = get_paths_dict(dir_path)
+
+    plans_dict = {}
+    for optimize in [False, True]:
+        path_shortener_obj = path_shortener.PathShortener(settings, optimize=optimize)
+        path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+        for path in path_plan.paths_TO_list + path_plan.paths_longest_namefiles_list:
+            assert len(os.path.join(*path)) <= settings.max_allowed_path_len
+        assert (len({tuple(path) for path in path_plan.paths_TO_list})
+                == len(path_plan.paths_original_list))
+        plans_dict[optimize] = path_plan
+
+        # Made on a copy, where any collision with a name in the same dir would raise
+        copy_path = tmp_path / f"copy_{optimize}"
+        shutil.copytree(dir_path, copy_path / "dir")
+        path_plan.parent_dir = str(copy_path)
+        path_shortener_obj.apply(path_plan)
+        paths_after_dict = {path: contents for path, contents
+                            in get_paths_dict(copy_path / "dir").items()
+                            if not path.endswith("_NAME.txt")}  # not namefiles
+        assert len(paths_after_dict) == len(paths_before_dict)
+        assert (sorted(filter(None, paths_after_dict.values()))
+                == sorted(filter(None, paths_before_dict.values())))
+
+    # The optimized plan minimizes the renames and namefiles, rather than the chars cut
+    path_plan = plans_dict[True]
+    assert path_plan.rename_count <= path_plan.greedy_rename_count
+    assert path_plan.namefile_count <= path_plan.greedy_namefile_count
+    assert path_plan.rename_count < len(plans_dict[False].paths_original_list)
+
+
+def test_renames_by_dir_fd_and_by_path_give_the_same_tree(tmp_path):
+    if not path_shortener.DIR_FD_RENAMES_SUPPORTED:
+        pytest.skip("this OS can't rename relative to a dir file descriptor")
+    settings = config.Settings(max_allowed_path_len=60)
+    dir_path = tmp_path / "dir"
+    make_file(dir_path / ("a"*30) / ("b"*30) / ("c"*30) / "file.txt", "deep")
+    make_file(dir_path / ("a"*30) / ("b"*30) / ("d"*40 + ".txt"), "long")
+    make_file(dir_path / ("a"*30) / ("bad:name" + "e"*30) / "x.txt", "illegal")
+    path_shortener_obj = path_shortener.PathShortener(settings)
+    path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+    assert len({len(rename[0].parts) for rename in path_plan.renames_list}) > 1
+
+    paths_dicts_list = []
+    for apply_func in [path_shortener.apply_renames_to_disk,
+                       path_shortener.apply_renames_to_disk_by_path]:
+        copy_path = tmp_path / apply_func.__name__
+        shutil.copytree(dir_path, copy_path / "dir")
+        apply_func(path_plan.renames_list, progress.ProgressReporter("rename", enabled=False),
+                   parent_dir=str(copy_path))
+        paths_dicts_list.append(get_paths_dict(copy_path / "dir"))
+
+    assert paths_dicts_list[0] == paths_dicts_list[1]
+    for path in paths_dicts_list[0]:
+        assert len(os.path.join("dir", path)) <= settings.max_allowed_path_len
+
+
+def test_run_job_hooks_only_get_events_of_their_own_job(tmp_path):
+    events_lists_dict = {"job1": [], "job2": []}
+    for job_name, events_list in events_lists_dict.items():
+        make_file(tmp_path / job_name / ("c"*60 + ".txt"))
+        result_dict = path_shortener.run_job(
+            {"source_dir": str(tmp_path / job_name), "mode": "plan",
+             "settings": {"max_allowed_path_len": 40}}, lambda event_dict: None,
+            hooks_list=[events_list.append])
+        assert result_dict["rename_count"] == 1
+
+    for events_list in events_lists_dict.values():
+        assert [(event_dict["event"], event_dict["phase"]) for event_dict in events_list] == [
+            ("phase_start", "scan"), ("phase_end", "scan"),
+            ("phase_start", "plan"), ("phase_end", "plan")]
+
+
+def test_run_job_writes_logs_into_output_dir(tmp_path):
+    make_file(tmp_path / "src" / "sub" / ("d"*100 + ".txt"), "long")
+    result_dict = path_shortener.run_job(
+        {"source_dir": str(tmp_path / "src"), "settings": {"max_allowed_path_len": 80}},
+        lambda event_dict: None)
+
+    output_dir = tmp_path / "src_short" / path_shortener.OUTPUT_DIR_NAME
+    assert result_dict["dir_fixed"] == str(tmp_path / "src_short")
+    for filename in ["namefiles_created.txt", "broken_symlinks.txt", "paths_list_1_before.txt",
+                     "paths_list_2_after.txt", "renames.html", "metrics.prom"]:
+        assert (output_dir / filename).is_file()
+    stats_dict = json.loads((output_dir / "stats.json").read_text())
+    assert stats_dict["before"]["paths_to_fix_count"] == 1
+    assert stats_dict["after"]["paths_to_fix_count"] == 0
+    assert stats_dict["namefile_count"] == result_dict["namefile_count"]
+
+
+def test_plan_gives_hardlinked_duplicates_the_same_name(tmp_path):
+    settings = config.Settings(max_allowed_path_len=40)
+    dir_path = tmp_path / "dir"
+    name_long = "e"*60 + ".txt"
+    make_file(dir_path / "sub1" / name_long, "same")
+    os.makedirs(dir_path / "sub2")
+    os.link(dir_path / "sub1" / name_long, dir_path / "sub2" / name_long)
+    make_file(dir_path / "sub3" / name_long, "not the same")
+
+    path_shortener_obj = path_shortener.PathShortener(settings)
+    path_plan = path_shortener_obj.plan(path_shortener_obj.scan(dir_path))
+    names_new_dict = {path_original[1]: path[-1] for path_original, path
+                      in zip(path_plan.paths_original_list, path_plan.paths_TO_list)}
+    assert names_new_dict["sub1"] == names_new_dict["sub2"]
+    assert names_new_dict["sub3"] != names_new_dict["sub1"]
+
+
+def test_undo_in_place_restores_the_original_names(tmp_path):
+    dir_path = tmp_path / "dir"
+    make_file(dir_path / ("f"*60) / ("g"*60 + ".txt"), "long")
+    make_file(dir_path / "illegal:name.txt", "illegal")
+    paths_before_dict = get_paths_dict(dir_path)
+
+    result_dict = path_shortener.run_job(
+        {"source_dir": str(dir_path), "mode": "in_place",
+         "settings": {"max_allowed_path_len": 80}}, lambda event_dict: None)
+    assert result_dict["rename_count"] > 0
+    assert get_paths_dict(dir_path) != paths_before_dict
+
+    rename_count, namefile_count = path_shortener.undo_in_place(str(dir_path))
+    assert rename_count > 0
+    assert namefile_count == result_dict["namefile_count"]
+    assert get_paths_dict(dir_path) == paths_before_dict
+    # Only the newest run not undone yet is undone
+    with pytest.raises(path_shortener.PathShortenerError):
+        path_shortener.undo_in_place(str(dir_path))
+
+
+def test_preflight_finds_circular_symlinks(tmp_path):
+    src_path = tmp_path / "src"
+    make_file(src_path / "a" / "file.txt", "file")
+    os.symlink("..", src_path / "a" / "up")  # to a dir above it
+    os.symlink("loop", src_path / "loop")  # to itself
+
+    with pytest.raises(path_shortener.PathShortenerError) as exc_info:
+        path_shortener.preflight_copy(str(src_path), str(tmp_path / "dst"), keep_symlinks=False)
+    assert "2 circular symlinks found" in str(exc_info.value)
+    assert str(src_path / "a" / "up") in str(exc_info.value)
+    assert str(src_path / "loop") in str(exc_info.value)
+
+    # Copied as symlinks, they are never followed
+    preflight_result = path_shortener.preflight_copy(str(src_path), str(tmp_path / "dst"),
+                                                     keep_symlinks=True)
+    assert not preflight_result.symlink_cycles_list
+
+
+def test_preflight_finds_unreadable_dirs(tmp_path):
+    src_path = tmp_path / "src"
+    make_file(src_path / "locked" / "file.txt", "file")
+    os.chmod(src_path / "locked", 0)
+    try:
+        if os.access(src_path / "locked", os.R_OK | os.X_OK):
+            pytest.skip("this user can list any dir, such as root")
+
+        with pytest.raises(path_shortener.PathShortenerError) as exc_info:
+            path_shortener.preflight_copy(str(src_path), str(tmp_path / "dst"),
+                                          keep_symlinks=False)
+        assert "1 unreadable files or dirs found" in str(exc_info.value)
+        assert str(src_path / "locked") in str(exc_info.value)
+        assert not (tmp_path / "dst").exists()
+    finally:
+        os.chmod(src_path / "locked", 0o755)
+
+
+def test_copy_sparse_file_keeps_holes(tmp_path):
+    src_path = tmp_path / "sparse.img"
+    size = 64*1024*1024
+    with open(src_path, "wb") as file:
+        file.write(b"head")
+        file.seek(size//2)
+        file.write(b"middle")
+        file.truncate(size)
+    if os.stat(src_path).st_blocks*512 >= size:
+        pytest.skip("the filesystem of the temp dir doesn't support sparse files")
+
+    dst_path = tmp_path / "copy.img"
+    num_bytes_copied = path_shortener.copy_sparse_file(src_path, dst_path)
+    assert num_bytes_copied < size//8
+    assert os.stat(dst_path).st_size == size
+    assert os.stat(dst_path).st_blocks*512 < size//8
+    assert filecmp.cmp(src_path, dst_path, shallow=False)
+
+
+def test_verify_copied_contents_reports_a_corrupted_copy(tmp_path):
+    settings = config.Settings(max_allowed_path_len=40)
+    src_path = tmp_path / "src"
+    make_file(src_path / ("a"*30) / ("b"*30 + ".txt"), "renamed")
+    make_file(src_path / "short.txt", "as-is")
+    shutil.copytree(src_path, tmp_path / "dst")
+    path_shortener_obj = path_shortener.PathShortener(settings)
+    scan_result = path_shortener_obj.scan(tmp_path / "dst")
+    path_plan = path_shortener_obj.plan(scan_result)
+    path_shortener_obj.apply(path_plan)
+
+    def verify():
+        return path_shortener.verify_copied_contents(
+            str(src_path), "dst", scan_result.all_paths_set, path_plan.renames_list,
+            parent_dir=str(tmp_path))
+
+    content_verify_result = verify()
+    assert not content_verify_result.has_problems()
+    assert content_verify_result.file_count == 2
+
+    path_corrupted = os.path.join(tmp_path, *path_plan.paths_TO_list[0])
+    with open(path_corrupted, "w") as file:
+        file.write("RENAMED")
+    content_verify_result = verify()
+    assert content_verify_result.has_problems()
+    assert [dst_path for _, dst_path, _ in content_verify_result.mismatches_list] == [
+        path_corrupted]
+    assert path_corrupted in content_verify_result.get_problems_str()
+
+
+def test_plan_file_from_path_list_fixes_the_dir(tmp_path):
+    dir_path = tmp_path / "dir"
+    name_dir = "h"*150
+    name_file = "i"*150 + ".txt"
+    make_file(dir_path / name_dir / name_file, "long")
+    path_list_path = tmp_path / "paths.bin"
+    # Same as `find dir -mindepth 1 -printf '%y\t%P\0'` writes
+    path_list_path.write_bytes(f"d\t{name_dir}\0f\t{name_dir}/{name_file}\0".encode())
+    plan_path = tmp_path / "renames.bin"
+
+    subprocess.run([sys.executable, path_shortener.__file__, str(dir_path), "--path_list",
+                    str(path_list_path), "--plan_file", str(plan_path), "--no_progress"],
+                   check=True, capture_output=True)
+    assert get_paths_dict(dir_path) == {name_dir: None, f"{name_dir}/{name_file}": "long"}
+
+    # Make the renames the same way as `xargs -0 -n 2 mv -n --` would
+    records_list = plan_path.read_bytes().split(b"\0")
+    assert records_list.pop() == b""
+    assert len(records_list) >= 2 and len(records_list) % 2 == 0
+    for path_old, path_new in zip(records_list[0::2], records_list[1::2]):
+        os.rename(os.fsdecode(path_old), os.fsdecode(path_new))
+
+    path_shortener_obj = path_shortener.PathShortener()
+    assert path_shortener_obj.scan(dir_path).path_stats.paths_to_fix_count == 0
+    paths_after_dict = get_paths_dict(dir_path)
+    assert len(paths_after_dict) == 2 and "long" in paths_after_dict.values()
+
+
+def test_walkers_filter_symlinked_dirs_the_same(tmp_path):
+    dir_path = tmp_path / "dir"
+    make_file(dir_path / "real" / "cache" / "a.txt")
+    make_file(dir_path / "d" / "b.txt")
+    os.symlink(dir_path / "real" / "cache", dir_path / "d" / "cache")
+    path_filter = filters.PathFilter(["cache/"])
+
+    paths_set = path_shortener.walk_directory(str(dir_path), path_filter)
+    assert str(dir_path / "d" / "b.txt") in paths_set
+    assert str(dir_path / "d" / "cache") not in paths_set
+    assert path_shortener.walk_directory_concurrently(str(dir_path), 4, path_filter) == paths_set
@@ -0,0 +1,77 @@
+# local imports
+import throttle
+
+# 3rd party imports
+import pytest
+
+# standard library imports
+# NA
+
+
+@pytest.fixture
+def fake_clock(monkeypatch):
+    """
+    Replace the clock which `TokenBucket` reads, and the sleep which it calls, with a fake clock,
+    which only moves forward when slept, or when moved forward by the test itself.
+
+    Returns the fake clock's `[time_now, sleeps_list]`.
+    """
+    clock = [0.0, []]
+
+    def sleep(seconds):
+        clock[1].append(seconds)
+        clock[0] += seconds
+
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(throttle.time, "sleep", sleep)
+    return clock
+
+
+@pytest.mark.parametrize("rate_str, rate", [
+    ("200", 200), ("512K", 512*1024), ("50m", 50*1024**2), ("1.5G", 1.5*1024**3), (" 2K ", 2048),
+])
+def test_parse_rate(rate_str, rate):
+    assert throttle.parse_rate(rate_str) == rate
+
+
+@pytest.mark.parametrize("rate_str", ["0", "-1", "abc", "", "G"])
+def test_parse_rate_rejects_non_positive_rates(rate_str):
+    with pytest.raises(ValueError):
+        throttle.parse_rate(rate_str)
+
+
+def test_token_bucket_refills_up_to_its_capacity(fake_clock):
+    token_bucket = throttle.TokenBucket(rate=100)
+    assert token_bucket.take(100) == 0.0
+
+    fake_clock[0] += 0.25
+    assert token_bucket.take(25) == 0.0
+    assert token_bucket.tokens == 0
+
+    # Idle for far longer than it takes to fill up, but still only 1 second's worth is saved
+    fake_clock[0] += 60
+    assert token_bucket.take(100) == 0.0
+    assert token_bucket.take(50) == pytest.approx(0.5)
+    assert fake_clock[1] == [pytest.approx(0.5)]
+
+
+def test_token_bucket_goes_into_debt(fake_clock):
+    token_bucket = throttle.TokenBucket(rate=100, capacity=10)
+
+    # More than the capacity at once is taken right away, and then paid off by sleeping
+    assert token_bucket.take(210) == pytest.approx(2.0)
+    assert fake_clock[0] == pytest.approx(2.0)
+    assert token_bucket.tokens == pytest.approx(-200)
+
+    # A later caller waits behind the debt, which was paid off while the first caller slept
+    assert token_bucket.take(50) == pytest.approx(0.5)
+    assert fake_clock[1] == [pytest.approx(2.0), pytest.approx(0.5)]
+
+
+def test_io_throttle_waits_for_both_limits(fake_clock):
+    io_throttle = throttle.IoThrottle(max_bytes_per_sec=1000, max_ops_per_sec=10)
+    assert io_throttle
+    assert io_throttle.wait(num_ops=10, num_bytes=1000) == 0.0
+    assert io_throttle.wait(num_ops=5, num_bytes=0) == pytest.approx(0.5)
+    assert io_throttle.wait(num_ops=0, num_bytes=2000) == pytest.approx(1.5)
+    assert not throttle.IoThrottle()
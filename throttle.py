@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+"""
+Limit the bandwidth and the rate of file system operations of a run, so that a big job can run on
+a shared file server during business hours, with a predictable impact on everyone else using it.
+This is what the `--max_bytes_per_sec`, `--max_ops_per_sec`, and `--idle_io` options of
+`path_shortener.py` use.
+
+Each limit is a token bucket, shared by all threads of the process, so that the limits hold for
+the whole run, no matter how many copy, rename, and namefile workers are running at once. Up to 1
+second's worth of tokens can be used in a burst after being idle.
+
+Example usage:
+```python
+import throttle
+
+io_throttle = throttle.IoThrottle(max_bytes_per_sec=throttle.parse_rate("50M"),
+                                  max_ops_per_sec=200)
+for chunk in chunks_list:
+    io_throttle.wait(num_ops=0, num_bytes=len(chunk))
+    file.write(chunk)
+```
+"""
+
+# local imports
+# NA
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import os
+import subprocess
+import threading
+import time
+
+
+# Multipliers of the suffixes which `parse_rate()` accepts
+RATE_SUFFIXES_DICT = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(rate_str):
+    """
+    Parse a rate such as "200", "512K", "50M", or "1.5G", with binary (1024-based) suffixes, into a
+    number per second. Raises a `ValueError` if it is not a positive number.
+    """
+    rate_str = rate_str.strip().upper()
+    suffix = rate_str[-1:] if rate_str[-1:] in RATE_SUFFIXES_DICT else ""
+    rate = float(rate_str[:len(rate_str) - len(suffix)])*RATE_SUFFIXES_DICT[suffix]
+    if not rate > 0:
+        raise ValueError(f"rate must be > 0, not \"{rate_str}\".")
+    return rate
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, which refills at `rate` tokens per second, up to `capacity` tokens.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        capacity: the most tokens which can be taken at once without waiting. Default: `rate`, ie:
+        1 second's worth.
+        """
+        self.rate = rate
+        self.capacity = rate if capacity is None else capacity
+        self.tokens = self.capacity
+        self.time_last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, num_tokens):
+        """
+        Take `num_tokens` tokens, sleeping until they are available.
+
+        More than `capacity` tokens can be taken at once. The tokens are taken right away, leaving
+        the bucket in debt, and the caller then sleeps until the debt is paid off, so that each
+        later caller waits behind it, in the order they called, and no caller can starve.
+
+        Returns the number of seconds slept.
+        """
+        with self.lock:
+            time_now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (time_now - self.time_last)*self.rate)
+            self.time_last = time_now
+            self.tokens -= num_tokens
+            wait_sec = -self.tokens/self.rate if self.tokens < 0 else 0.0
+
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+        return wait_sec
+
+
+class IoThrottle:
+    """
+    A limit on the bytes and on the file system operations per second, each of which is optional.
+    With neither limit, `wait()` never waits.
+    """
+    def __init__(self, max_bytes_per_sec=None, max_ops_per_sec=None):
+        self.set_limits(max_bytes_per_sec, max_ops_per_sec)
+
+    def set_limits(self, max_bytes_per_sec=None, max_ops_per_sec=None):
+        self.max_bytes_per_sec = max_bytes_per_sec
+        self.max_ops_per_sec = max_ops_per_sec
+        self.bytes_bucket = None if max_bytes_per_sec is None else TokenBucket(max_bytes_per_sec)
+        self.ops_bucket = None if max_ops_per_sec is None else TokenBucket(max_ops_per_sec)
+
+    def __bool__(self):
+        """
+        False if nothing is limited.
+        """
+        return self.bytes_bucket is not None or self.ops_bucket is not None
+
+    def wait(self, num_ops=1, num_bytes=0):
+        """
+        Wait until `num_ops` file system operations, moving `num_bytes` bytes of data, are allowed.
+
+        Returns the number of seconds waited.
+        """
+        wait_sec = 0.0
+        if self.ops_bucket is not None and num_ops:
+            wait_sec += self.ops_bucket.take(num_ops)
+        if self.bytes_bucket is not None and num_bytes:
+            wait_sec += self.bytes_bucket.take(num_bytes)
+        return wait_sec
+
+
+def set_idle_io_priority():
+    """
+    Give the I/O of this process, and of the threads and processes it starts afterwards, the
+    "idle" I/O scheduling class, with `ionice`, so that the disk serves it only when no other
+    process needs it. This only works on Linux, with a scheduler which supports I/O priorities,
+    such as BFQ, and only for the local disk, not a network share.
+
+    Raises an `OSError` if `ionice` is missing or fails.
+    """
+    try:
+        subprocess.run(["ionice", "-c", "3", "-p", str(os.getpid())], check=True,
+                       capture_output=True, text=True)
+    except subprocess.CalledProcessError as e:
+        raise OSError(f"`ionice` failed: {e.stderr.strip()}") from e
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+"""
+Watch a directory tree for changes, and report which of its top-level entries changed, once the
+changes have settled down. This is what `path_shortener.py --watch` uses to know what to re-sync.
+
+- On Linux, this uses inotify, through `ctypes`, so no extra packages are needed.
+- Anywhere else, or if inotify is unavailable or runs out of watches, it falls back to polling:
+  re-listing the whole tree every so often and comparing the mtimes and sizes.
+
+Example usage:
+```bash
+# Print the top-level entries of "some_dir" which change, as they change
+./watch.py some_dir
+```
+"""
+
+# local imports
+import ansi_colors as colors
+
+# 3rd party imports
+# NA
+
+# standard library imports
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import select
+import struct
+import sys
+import time
+
+
+# inotify event masks. See `man 7 inotify`.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+# The header of each event read from an inotify file descriptor: wd, mask, cookie, and len, where
+# len is the length of the NUL-padded name which follows it.
+EVENT_HEADER_STRUCT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """
+    Watch all directories under `root_dir` with Linux inotify.
+    """
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+        libc_name = ctypes.util.find_library("c")
+        if sys.platform != "linux" or libc_name is None:
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            error_num = ctypes.get_errno()
+            raise OSError(error_num, os.strerror(error_num))
+
+        self.paths_dict = {}  # watch descriptor --> path of the dir it watches
+        try:
+            self.add_watches_recursively(root_dir)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, dir_path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), WATCH_MASK)
+        if wd < 0:
+            error_num = ctypes.get_errno()
+            # The dir may have been removed or replaced by a file since it was seen; that's fine,
+            # as its removal is an event of its own.
+            if error_num in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(error_num, f"inotify_add_watch({dir_path!r}): {os.strerror(error_num)}")
+
+        self.paths_dict[wd] = dir_path
+
+    def add_watches_recursively(self, dir_path):
+        # `os.walk()` doesn't follow symlinks by default, which is what we want here
+        for dirpath, _, _ in os.walk(dir_path):
+            self.add_watch(dirpath)
+
+    def get_top_level_name(self, path):
+        """
+        Return the name of the top-level entry of `root_dir` which `path` is inside of, or None if
+        `path` is `root_dir` itself.
+        """
+        relative_path = os.path.relpath(path, self.root_dir)
+        if relative_path == os.curdir:
+            return None
+        return relative_path.split(os.sep, 1)[0]
+
+    def wait_for_changes(self, timeout_sec=None):
+        """
+        Wait up to `timeout_sec` seconds (forever if None) for changes.
+
+        Returns the set of names of the top-level entries which changed, which is empty if it timed
+        out with no changes.
+        """
+        readable_list, _, _ = select.select([self.fd], [], [], timeout_sec)
+        if not readable_list:
+            return set()
+
+        changed_names_set = set()
+        data = os.read(self.fd, 64*1024)
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_len = EVENT_HEADER_STRUCT.unpack_from(data, offset)
+            offset += EVENT_HEADER_STRUCT.size
+            name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+            offset += name_len
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so assume that everything changed
+                changed_names_set.update(os.listdir(self.root_dir))
+                continue
+
+            dir_path = self.paths_dict.get(wd)
+            if dir_path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                # The watch was removed, since its dir was deleted or moved away
+                del self.paths_dict[wd]
+                continue
+
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF) and dir_path == self.root_dir:
+                raise FileNotFoundError(errno.ENOENT, "The watched dir was deleted or moved",
+                                        self.root_dir)
+
+            path = os.path.join(dir_path, name) if name else dir_path
+            top_level_name = self.get_top_level_name(path)
+            if top_level_name is not None:
+                changed_names_set.add(top_level_name)
+
+            # Watch new dirs too
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_watches_recursively(path)
+
+        return changed_names_set
+
+
+class PollingWatcher:
+    """
+    Watch `root_dir` by re-listing the whole tree every `poll_interval_sec` seconds, and comparing
+    the type, mtime, and size of every entry in it to the last time.
+    """
+    def __init__(self, root_dir, poll_interval_sec):
+        self.root_dir = root_dir
+        self.poll_interval_sec = poll_interval_sec
+        self.signatures_dict = self.get_signatures()
+
+    def close(self):
+        pass
+
+    def get_signature(self, path):
+        """
+        Return a hash of the type, mtime, and size of `path` and of everything under it.
+        """
+        hash_object = hashlib.sha256()
+        entries_to_visit_list = [path]
+        while entries_to_visit_list:
+            entry_path = entries_to_visit_list.pop()
+            try:
+                stat_result = os.lstat(entry_path)
+            except FileNotFoundError:
+                continue
+            hash_object.update(f"{entry_path}\0{stat_result.st_mode}\0{stat_result.st_mtime_ns}\0"
+                               f"{stat_result.st_size}\0".encode("utf-8", "surrogateescape"))
+
+            if os.path.isdir(entry_path) and not os.path.islink(entry_path):
+                try:
+                    entries_to_visit_list.extend(
+                        os.path.join(entry_path, name) for name in sorted(os.listdir(entry_path)))
+                except (FileNotFoundError, NotADirectoryError):
+                    pass
+
+        return hash_object.hexdigest()
+
+    def get_signatures(self):
+        """
+        Return a dict of top-level entry name --> signature.
+        """
+        return {name: self.get_signature(os.path.join(self.root_dir, name))
+                for name in os.listdir(self.root_dir)}
+
+    def wait_for_changes(self, timeout_sec=None):
+        """
+        Same as `InotifyWatcher.wait_for_changes()`, except that changes are only noticed once per
+        `poll_interval_sec`.
+        """
+        time_end = None if timeout_sec is None else time.monotonic() + timeout_sec
+
+        while True:
+            sleep_sec = self.poll_interval_sec
+            if time_end is not None:
+                sleep_sec = min(sleep_sec, max(time_end - time.monotonic(), 0))
+            time.sleep(sleep_sec)
+
+            signatures_dict = self.get_signatures()
+            changed_names_set = {
+                name for name in signatures_dict.keys() | self.signatures_dict.keys()
+                if signatures_dict.get(name) != self.signatures_dict.get(name)}
+            self.signatures_dict = signatures_dict
+
+            if changed_names_set or (time_end is not None and time.monotonic() >= time_end):
+                return changed_names_set
+
+
+def make_watcher(root_dir, use_polling=False, poll_interval_sec=1.0):
+    """
+    Return an `InotifyWatcher` for `root_dir`, or a `PollingWatcher` if `use_polling` is True or
+    inotify can't be used.
+    """
+    if not use_polling:
+        try:
+            return InotifyWatcher(root_dir)
+        except OSError as e:
+            colors.print_yellow(f"WARNING: cannot use inotify ({e}). Polling every "
+                                f"{poll_interval_sec} sec instead.")
+
+    return PollingWatcher(root_dir, poll_interval_sec)
+
+
+def watch_for_changes(watcher, on_changes, debounce_sec):
+    """
+    Call `on_changes(changed_names_set)` with the names of the top-level entries which changed,
+    each time there has been a burst of changes followed by `debounce_sec` seconds of quiet. Runs
+    until interrupted.
+    """
+    pending_names_set = set()
+    while True:
+        # Only time out while there are changes waiting for things to quiet down
+        timeout_sec = debounce_sec if pending_names_set else None
+        changed_names_set = watcher.wait_for_changes(timeout_sec)
+
+        if changed_names_set:
+            pending_names_set.update(changed_names_set)
+        elif pending_names_set:
+            on_changes(pending_names_set)
+            pending_names_set = set()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print(f"Usage: {sys.argv[0]} DIR")
+        exit(1)
+
+    watcher = make_watcher(sys.argv[1])
+    print(f"Watching \"{sys.argv[1]}\" with {type(watcher).__name__}. Press Ctrl + C to stop.")
+    try:
+        watch_for_changes(watcher, lambda names_set: print(sorted(names_set)), debounce_sec=0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+
+
+if __name__ == "__main__":
+    main()